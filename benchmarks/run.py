@@ -0,0 +1,226 @@
+"""Measure the overhead of theblues clients against a local stand-in server.
+
+Each operation is called repeatedly, and its throughput, its p50 and p99
+latencies and the client CPU time per call are reported. The CPU time spent
+building urls and decoding JSON is also measured on its own. The server runs
+in a child process, so it does not count in the CPU time.
+
+For instance:
+
+    python -m benchmarks.run --latency 5 --results 500 entity search
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import time
+from timeit import default_timer
+
+from benchmarks.server import (
+    DEFAULT_RESULTS,
+    StandInServer,
+)
+from theblues.charmstore import (
+    _decode,
+    CharmStore,
+    DEFAULT_INCLUDES,
+)
+from theblues.identity_manager import IdentityManager
+from theblues.plans import Plans
+from theblues.terms import Terms
+
+
+ENTITY_ID = 'cs:~bench/xenial/mysql-58'
+# The number of entities fetched by the entities benchmark.
+ENTITIES_COUNT = 50
+DEFAULT_ITERATIONS = 200
+DEFAULT_WARMUP = 10
+# The iterations of the url building and JSON decoding benchmarks.
+CPU_ITERATIONS = 2000
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    # Python 2 measures the process CPU time with clock.
+    _cpu_time = time.clock
+
+
+class Clients(object):
+    """The clients benchmarked, connected to the stand-in server."""
+
+    def __init__(self, server):
+        self.charmstore = CharmStore(server.charmstore_url, timeout=30)
+        self.plans = Plans(server.plans_url, timeout=30)
+        self.terms = Terms(server.terms_url, timeout=30)
+        self.identity = IdentityManager(server.identity_url, timeout=30)
+        self.entity_ids = [
+            'cs:~bench/xenial/charm{}-1'.format(i)
+            for i in range(ENTITIES_COUNT)]
+
+
+# The benchmarked operations, mapped to the function calling them.
+OPERATIONS = {
+    'entity': lambda c: c.charmstore.entity(ENTITY_ID),
+    'entities': lambda c: c.charmstore.entities(c.entity_ids),
+    'map_entities': lambda c: c.charmstore.map_entities(c.entity_ids),
+    'search': lambda c: c.charmstore.search('mysql'),
+    'list': lambda c: c.charmstore.list(),
+    'files': lambda c: c.charmstore.files(
+        ENTITY_ID, filename='README.md', read_file=True),
+    'list_wallets': lambda c: c.plans.list_wallets(),
+    'get_terms': lambda c: c.terms.get_terms('bench-terms'),
+    'get_user': lambda c: c.identity.get_user('bench', 'macaroons'),
+}
+DEFAULT_OPERATIONS = [
+    'entity', 'entities', 'search', 'list', 'files', 'list_wallets',
+    'get_terms',
+]
+
+
+def percentile(values, p):
+    """Return the p percentile of values, by the nearest-rank method."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def measure(func, iterations, warmup=DEFAULT_WARMUP, concurrency=1):
+    """Call func repeatedly and return its performance.
+
+    @param func The function to call, without arguments.
+    @param iterations The number of measured calls.
+    @param warmup The number of calls made first, which are not measured.
+    @param concurrency The number of threads calling func.
+    @return a dict with the throughput in calls per second, the p50, p99
+        and maximum latencies in seconds, and the client CPU seconds per
+        call.
+    """
+    for _ in range(warmup):
+        func()
+
+    def timed(_):
+        start = default_timer()
+        func()
+        return default_timer() - start
+
+    cpu = _cpu_time()
+    start = default_timer()
+    if concurrency == 1:
+        latencies = [timed(i) for i in range(iterations)]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    elapsed = default_timer() - start
+    cpu = _cpu_time() - cpu
+    return {
+        'calls': iterations,
+        'throughput': iterations / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+        'cpu': cpu / iterations,
+    }
+
+
+def measure_cpu(func, iterations=CPU_ITERATIONS):
+    """Return the CPU seconds per call of func, which sends no request."""
+    func()
+    cpu = _cpu_time()
+    for _ in range(iterations):
+        func()
+    return (_cpu_time() - cpu) / iterations
+
+
+def client_cpu(clients, server):
+    """Measure the CPU time spent building urls and decoding responses.
+
+    @return a list of (name, CPU seconds per call) tuples.
+    """
+    cs = clients.charmstore
+    benchmarks = [
+        ('url: meta/any', lambda: cs._meta_url(ENTITY_ID, DEFAULT_INCLUDES)),
+        ('url: bulk meta/any', lambda: cs._entities_urls(
+            clients.entity_ids, 2000)),
+        ('url: search', lambda: cs._search_url(
+            'mysql', includes=DEFAULT_INCLUDES, doc_type='charm',
+            tags=['databases'], series='xenial')),
+        ('url: list', lambda: cs._list_url(
+            includes=DEFAULT_INCLUDES, promulgated_only=True)),
+    ]
+    for name, body in server.samples():
+        benchmarks.append(
+            ('json: {} ({} bytes)'.format(name, len(body)),
+             lambda body=body: _decode(body)))
+    return [(name, measure_cpu(func)) for name, func in benchmarks]
+
+
+def report(results, cpu, out=sys.stdout):
+    """Write the results as a table."""
+    out.write('{:<14} {:>10} {:>10} {:>10} {:>10} {:>12}\n'.format(
+        'operation', 'calls/s', 'p50 ms', 'p99 ms', 'max ms', 'cpu ms/call'))
+    for name, result in results:
+        out.write(
+            '{:<14} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.3f}\n'
+            .format(name, result['throughput'], result['p50'] * 1000,
+                    result['p99'] * 1000, result['max'] * 1000,
+                    result['cpu'] * 1000))
+    if cpu:
+        out.write('\n{:<40} {:>12}\n'.format('client cpu', 'us/call'))
+        for name, seconds in cpu:
+            out.write('{:<40} {:>12.2f}\n'.format(name, seconds * 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'operations', nargs='*', metavar='operation',
+        help='the operations to measure, among {}'.format(
+            ', '.join(sorted(OPERATIONS))))
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='the number of threads calling each operation')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='the server response delay in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='the maximum random delay added, in ms')
+    parser.add_argument('--results', type=int, default=DEFAULT_RESULTS,
+                        help='the number of entities served besides mysql-58')
+    parser.add_argument('--padding', type=int, default=0,
+                        help='the bytes added to each entity payload')
+    parser.add_argument('--no-cpu', action='store_true',
+                        help='skip the url building and decoding benchmarks')
+    parser.add_argument('--json', action='store_true',
+                        help='write the results as JSON')
+    options = parser.parse_args(argv)
+    operations = options.operations or DEFAULT_OPERATIONS
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error('unknown operations: {}'.format(
+            ', '.join(sorted(unknown))))
+    server = StandInServer(
+        latency=options.latency / 1000.0, jitter=options.jitter / 1000.0,
+        results=options.results, padding=options.padding)
+    with server:
+        clients = Clients(server)
+        results = []
+        for name in operations:
+            func = OPERATIONS[name]
+            results.append((name, measure(
+                lambda: func(clients), options.iterations, options.warmup,
+                options.concurrency)))
+        cpu = [] if options.no_cpu else client_cpu(clients, server)
+    if options.json:
+        json.dump({'operations': dict(results), 'client_cpu': dict(cpu)},
+                  sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        report(results, cpu)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""A local HTTP stand-in for the charm store, plans, terms and identity APIs.
+
+The server answers the requests sent by theblues clients with the recorded
+payloads in the payloads directory, after a configurable delay. The charm
+store routes are served by a theblues.fakestore.FakeCharmStore holding the
+recorded entity. It runs in a separate process, so that the CPU time
+measured by the benchmarks is the one of the client only.
+
+Run it on its own with:
+
+    python -m benchmarks.server --port 8080 --latency 20
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from theblues.charmstore import DEFAULT_INCLUDES
+from theblues import fakestore
+
+
+PAYLOADS_DIR = os.path.join(os.path.dirname(__file__), 'payloads')
+# The url prefixes of the APIs, to append to the server url.
+CHARMSTORE_PREFIX = '/charmstore/v5'
+PLANS_PREFIX = '/plans'
+TERMS_PREFIX = '/terms'
+IDENTITY_PREFIX = '/identity/v1/'
+# The number of entities served besides the recorded one by default.
+DEFAULT_RESULTS = 100
+# The id of the recorded entity.
+ENTITY_ID = 'cs:~bench/xenial/mysql-58'
+# The requests answered with the sample responses of each kind.
+_SAMPLES = [
+    ('entity', CHARMSTORE_PREFIX + '/~bench/xenial/mysql-58/meta/any',
+     {'include': DEFAULT_INCLUDES}),
+    ('search', CHARMSTORE_PREFIX + '/search',
+     {'include': DEFAULT_INCLUDES}),
+    ('wallets', PLANS_PREFIX + '/v3/wallet', {}),
+    ('terms', TERMS_PREFIX + '/v1/terms/bench-terms', {}),
+    ('user', IDENTITY_PREFIX + 'u/bench', {}),
+]
+
+
+class Payloads(object):
+    """The responses of the stand-in server."""
+
+    def __init__(self, directory=PAYLOADS_DIR, results=DEFAULT_RESULTS,
+                 padding=0):
+        """Initializer.
+
+        @param directory The directory holding the recorded payloads.
+        @param results The number of entities served besides the recorded
+            one, with the same metadata, as cs:~bench/xenial/charm0-1 and
+            so on.
+        @param padding The number of bytes added to the metadata of each
+            entity, to simulate larger payloads.
+        """
+        self.results = results
+
+        def load(name):
+            with open(os.path.join(directory, name), 'rb') as f:
+                return f.read()
+
+        self.entity = json.loads(load('entity.json').decode('utf-8'))
+        if padding:
+            self.entity['Meta']['extra-info']['padding'] = 'x' * padding
+        self.manifest = load('manifest.json')
+        self.readme = load('README.md')
+        self.wallets = load('wallets.json')
+        self.terms = json.loads(load('terms.json').decode('utf-8'))
+        self.user = json.loads(load('user.json').decode('utf-8'))
+
+    def fixtures(self):
+        """Return the fakestore.Fixtures of the charm store entities.
+
+        The archive files have the names and sizes of the recorded manifest.
+        """
+        files = {}
+        for item in json.loads(self.manifest.decode('utf-8')):
+            files[item['Name']] = b'x' * item['Size']
+        files['README.md'] = self.readme
+        meta = self.entity['Meta']
+        fixtures = fakestore.Fixtures()
+        fixtures.add(ENTITY_ID, meta, files)
+        for i in range(self.results):
+            fixtures.add(
+                'cs:~bench/xenial/charm{}-1'.format(i), meta, files)
+        return fixtures
+
+    def get(self, path, query):
+        """Answer a GET request to the plans, terms or identity APIs.
+
+        @param path The request path.
+        @param query The query parameters, as returned by parse_qs.
+        @return the status code, the content type and the body of the
+            response.
+        """
+        if path == PLANS_PREFIX + '/v3/wallet':
+            body = self.wallets
+        elif path.startswith(TERMS_PREFIX + '/v1/terms/'):
+            body = _encode([
+                dict(self.terms[0], name=path.rsplit('/', 1)[1])])
+        elif path.startswith(IDENTITY_PREFIX + 'u/'):
+            body = _encode(
+                dict(self.user, username=path.rsplit('/', 1)[1]))
+        else:
+            return 404, 'application/json', _encode(
+                {'Message': 'not found: ' + path})
+        return 200, 'application/json', body
+
+
+def make_server(host='127.0.0.1', port=0, latency=0, jitter=0,
+                payloads=None):
+    """Return a stand-in fakestore.FakeCharmStore, ready to serve_forever.
+
+    The charm store API is served under CHARMSTORE_PREFIX, and the other
+    APIs by the payloads.
+
+    @param host The address to listen on.
+    @param port The port to listen on, or 0 for any free port.
+    @param latency The delay in seconds before answering each request.
+    @param jitter The maximum random delay in seconds added to the latency.
+    @param payloads The Payloads served, defaulting to the recorded ones.
+    """
+    payloads = payloads or Payloads()
+    return fakestore.FakeCharmStore(
+        payloads.fixtures(),
+        latency=fakestore.uniform(latency, latency + jitter),
+        host=host, port=port, root=CHARMSTORE_PREFIX,
+        fallback=payloads.get)
+
+
+class StandInServer(object):
+    """Run a stand-in server in a child process.
+
+    For instance:
+
+        with StandInServer(latency=0.01) as server:
+            charmstore = CharmStore(server.charmstore_url)
+    """
+
+    def __init__(self, latency=0, jitter=0, results=DEFAULT_RESULTS,
+                 padding=0):
+        """Initializer; see make_server and Payloads for the parameters."""
+        self.latency = latency
+        self.jitter = jitter
+        self.results = results
+        self.padding = padding
+        self.url = None
+        self._process = None
+
+    @property
+    def charmstore_url(self):
+        return self.url + CHARMSTORE_PREFIX
+
+    @property
+    def plans_url(self):
+        return self.url + PLANS_PREFIX
+
+    @property
+    def terms_url(self):
+        return self.url + TERMS_PREFIX
+
+    @property
+    def identity_url(self):
+        return self.url + IDENTITY_PREFIX
+
+    def samples(self):
+        """Return (name, body) tuples for a response of each kind served."""
+        payloads = Payloads(results=self.results, padding=self.padding)
+        store = fakestore.FakeCharmStore(payloads.fixtures())
+        samples = []
+        for name, path, query in _SAMPLES:
+            if path.startswith(CHARMSTORE_PREFIX + '/'):
+                path = path[len(CHARMSTORE_PREFIX) + 1:]
+                body = store.handle(path, query)[3]
+            else:
+                body = payloads.get(path, query)[2]
+            samples.append((name, body))
+        return samples
+
+    def start(self):
+        """Start the server process and wait until it listens."""
+        queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(
+                queue, self.latency, self.jitter, self.results,
+                self.padding))
+        self._process.daemon = True
+        self._process.start()
+        self.url = 'http://127.0.0.1:{}'.format(queue.get(timeout=30))
+
+    def stop(self):
+        """Stop the server process."""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def _serve(queue, latency, jitter, results, padding):
+    """Serve forever, sending the port listened on to the queue."""
+    server = make_server(
+        latency=latency, jitter=jitter,
+        payloads=Payloads(results=results, padding=padding))
+    server.listen()
+    queue.put(urlsplit(server.url).port)
+    server.serve_forever()
+
+
+def _encode(value):
+    """Encode a JSON response body."""
+    return json.dumps(value).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='the response delay in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='the maximum random delay added, in ms')
+    parser.add_argument('--results', type=int, default=DEFAULT_RESULTS,
+                        help='the number of entities served besides mysql-58')
+    parser.add_argument('--padding', type=int, default=0,
+                        help='the bytes added to each entity payload')
+    options = parser.parse_args()
+    server = make_server(
+        options.host, options.port, options.latency / 1000.0,
+        options.jitter / 1000.0,
+        Payloads(results=options.results, padding=options.padding))
+    server.listen()
+    print('serving on ' + server.url[:-len(CHARMSTORE_PREFIX)])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -33,7 +33,11 @@ setup(
         'requests>=2.18.4',
         'jujubundlelib>=0.5.1',
         'macaroonbakery>=0.0.6',
+        'futures>=3.0;python_version<"3"',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+    },
     tests_requires=[
         'httmock==1.2.3',
     ],
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import mmap
+import threading
+import zipfile
+
+
+# The maximum number of archives kept by an ArchiveCache.
+DEFAULT_MAX_ARCHIVES = 8
+
+
+class Archive(object):
+    """A read-only view of a charm or bundle zip archive.
+
+    The archive file is memory-mapped and its central directory is indexed
+    once, so that any member can then be read without further requests.
+    """
+
+    def __init__(self, fileobj):
+        """Initializer.
+
+        @param fileobj A file object open for reading in binary mode and
+            holding the whole archive. It is owned by the archive, which
+            closes it when closed itself.
+        """
+        self._file = fileobj
+        self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self._zip = zipfile.ZipFile(_MappedFile(self._map))
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._zip.NameToInfo
+
+    def names(self):
+        """Return the names of the files in the archive.
+
+        Directory entries are not included.
+        """
+        return [info.filename for info in self._zip.infolist()
+                if not info.filename.endswith('/')]
+
+    def read(self, name):
+        """Return the content of a file in the archive as bytes.
+
+        @param name The name of the file in the archive.
+        @raise KeyError if the archive has no such file.
+        """
+        # Reads seek the shared underlying map, so they are serialized.
+        with self._lock:
+            return self._zip.read(name)
+
+    def read_text(self, name, encoding='utf-8'):
+        """Return the content of a file in the archive decoded as text.
+
+        @param name The name of the file in the archive.
+        @param encoding The encoding of the file.
+        @raise KeyError if the archive has no such file.
+        """
+        return self.read(name).decode(encoding, 'replace')
+
+    def close(self):
+        """Release the memory map and the archive file."""
+        self._zip.close()
+        self._map.close()
+        self._file.close()
+
+
+class _MappedFile(object):
+    """Expose a memory map with the file API expected by zipfile."""
+
+    def __init__(self, map):
+        self._map = map
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._map) - self._map.tell()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=0):
+        try:
+            self._map.seek(offset, whence)
+        except ValueError as err:
+            # Files report seeking out of range as IOError, which zipfile
+            # relies upon to detect short files.
+            raise IOError(*err.args)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class ArchiveCache(object):
+    """A bounded cache of open archives.
+
+    The least recently used archives are discarded past max_entries. They
+    are not closed explicitly, as callers may still be reading them: their
+    resources are released once they are no longer referenced.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ARCHIVES):
+        """Initializer.
+
+        @param max_entries The maximum number of archives to keep open.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the archive stored with the given key, or None."""
+        with self._lock:
+            archive = self._entries.pop(key, None)
+            if archive is not None:
+                self._entries[key] = archive
+            return archive
+
+    def set(self, key, archive):
+        """Store an archive, evicting the least recently used ones.
+
+        @param key The key identifying the archive.
+        @param archive The Archive to store.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = archive
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Discard all the archives."""
+        with self._lock:
+            self._entries.clear()
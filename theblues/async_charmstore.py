@@ -0,0 +1,581 @@
+import asyncio
+from collections import OrderedDict
+import json
+import tempfile
+
+import aiohttp
+from macaroonbakery import (
+    bakery,
+    httpbakery,
+)
+import requests
+from requests.exceptions import RequestException
+
+from .archive import Archive
+from .charmstore import (
+    CharmStore,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_MAX_URL_LENGTH,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_POOL_MAXSIZE,
+    EntityResult,
+    _connection_error,
+    _entity_includes,
+    _get_path,
+    _paged_url,
+    _request_exception_cause,
+    _results,
+    _status_error,
+    _timeout_error,
+    )
+from .errors import (
+    BulkFetchError,
+    EntityNotFound,
+    ServerError,
+    )
+from .records import Entity
+from theblues.utils import DEFAULT_TIMEOUT, API_URL
+
+
+DEFAULT_CONNECTION_LIMIT = 100
+
+
+class AsyncCharmStore(CharmStore):
+    """An asyncio connection to the charmstore.
+
+    The API mirrors CharmStore, but every method performing a request is a
+    coroutine and requests are made with aiohttp, so many lookups can be in
+    flight at once without blocking the event loop. The URL generation
+    methods (e.g. charm_icon_url) are inherited unchanged.
+
+    Archives are streamed to disk with the blocking HTTP client of
+    CharmStore, in the default executor, so that downloads are resumed
+    and verified in the same way.
+
+    The requests are not cached, coalesced, retried, hedged, rate limited
+    nor instrumented: the CharmStore options enabling those (http_cache,
+    cache, coalesce, blob_cache, retry, hedge, circuit_breakers,
+    instrumentation, rate_limits and auth_cache) are rejected with a
+    TypeError. Macaroons are discharged when a request is refused.
+    """
+
+    def __init__(self, url=API_URL, timeout=DEFAULT_TIMEOUT,
+                 verify=True, client=None, cookies=None,
+                 limit=DEFAULT_CONNECTION_LIMIT, interface_index=None,
+                 archive_cache=None, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 **kwargs):
+        """Initializer.
+
+        @param url The base url to the charmstore API.
+        @param timeout How long to wait in seconds before timing out a request;
+            a value of None means no timeout.
+        @param verify Whether to verify the certificate for the charmstore API
+            host.
+        @param client (httpbakery.Client) holds a context for making http
+        requests with macaroons. Discharges are performed in the default
+        executor, as the bakery only speaks blocking HTTP.
+        @param cookies (which act as dict) holds cookies to be sent with the
+        requests.
+        @param limit The maximum number of simultaneous connections.
+        @param interface_index An optional interface_index.InterfaceIndex
+            used to answer fetch_interfaces without querying the charmstore.
+        @param archive_cache The archive.ArchiveCache keeping the archives
+            downloaded to read files from, as for CharmStore.
+        @param pool_maxsize The maximum number of connections kept alive by
+            the blocking client downloading archives.
+        @raise TypeError if any other CharmStore option is given.
+        """
+        if kwargs:
+            raise TypeError('unsupported AsyncCharmStore options: {}'.format(
+                ', '.join(sorted(kwargs))))
+        super(AsyncCharmStore, self).__init__(
+            url=url, timeout=timeout, verify=verify, client=client,
+            cookies=cookies, interface_index=interface_index,
+            archive_cache=archive_cache, pool_maxsize=pool_maxsize,
+            coalesce=False)
+        self.limit = limit
+        self._http = None
+        # The archive downloads in progress, by archive cache key.
+        self._archive_tasks = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        '''Close the underlying HTTP connections.'''
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _http_session(self):
+        '''Return the aiohttp session, creating it if required.
+
+        The session is created lazily so that it is bound to the running
+        event loop.
+        '''
+        if self._http is None:
+            connector_kwargs = {'limit': self.limit}
+            if not self.verify:
+                connector_kwargs['ssl'] = False
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**connector_kwargs),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._http
+
+    def _cookie_header(self, url):
+        '''Return the Cookie header to send to the given url, if any.
+
+        Both the cookies passed to the initializer and the macaroons stored
+        in the bakery client cookie jar are included.
+        '''
+        jar = requests.cookies.RequestsCookieJar()
+        for cookies in (self._client.cookies, self.cookies):
+            if cookies is not None:
+                requests.cookies.merge_cookies(jar, cookies)
+        request = requests.Request('GET', url).prepare()
+        return requests.cookies.get_cookie_header(jar, request)
+
+    async def _fetch(self, url):
+        '''Perform a single GET request and read the whole response.'''
+        headers = {
+            httpbakery.BAKERY_PROTOCOL_HEADER: str(bakery.LATEST_VERSION),
+        }
+        cookie = self._cookie_header(url)
+        if cookie:
+            headers['Cookie'] = cookie
+        async with self._http_session().get(url, headers=headers) as resp:
+            content = await resp.read()
+            return _Response(url, resp.status, resp.headers, content,
+                             resp.charset)
+
+    async def _discharge(self, url, response):
+        '''Discharge the macaroon in the response if one is required.
+
+        @return whether a discharge was performed and the request should be
+            retried.
+        '''
+        if response.status_code not in (401, 407):
+            return False
+        if (response.status_code == 401 and
+                response.headers.get('WWW-Authenticate') != 'Macaroon'):
+            return False
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        if (not isinstance(data, dict) or
+                data.get('Code') != httpbakery.ERR_DISCHARGE_REQUIRED):
+            return False
+        error = httpbakery.Error.from_dict(data)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._client.handle_error, error, url)
+        return True
+
+    async def _get(self, url):
+        """Make a get request against the charmstore.
+
+        This method is used by other API methods to standardize querying.
+        Errors are reported as in CharmStore._get.
+        @param url The full url to query
+            (e.g. https://api.jujucharms.com/charmstore/v4/macaroon)
+        """
+        try:
+            response = await self._fetch(url)
+            if await self._discharge(url, response):
+                response = await self._fetch(url)
+        except asyncio.TimeoutError:
+            raise _timeout_error(url, self.timeout)
+        except aiohttp.ClientError as exc:
+            raise _connection_error(url, exc, exc)
+        except RequestException as exc:
+            raise _connection_error(url, exc, _request_exception_cause(exc))
+        if response.status_code >= 400:
+            raise _status_error(url, response.status_code, response.text)
+        return response
+
+    async def _meta(self, entity_id, includes, channel=None):
+        '''Retrieve metadata about an entity in the charmstore.
+
+        See CharmStore._meta.
+        '''
+        url = self._meta_url(entity_id, includes, channel=channel)
+        data = await self._get(url)
+        return data.json()
+
+    async def entity(self, entity_id, get_files=False, channel=None,
+                     include_stats=True, includes=None):
+        '''Get the default data for any entity (e.g. bundle or charm).
+
+        See CharmStore.entity.
+        '''
+        includes = _entity_includes(includes, get_files, include_stats)
+        return await self._meta(entity_id, includes, channel=channel)
+
+    async def entities(self, entity_ids,
+                       max_url_length=DEFAULT_MAX_URL_LENGTH):
+        '''Get the default data for entities.
+
+        See CharmStore.entities; all the requests run concurrently.
+        '''
+        chunks = self._entities_urls(entity_ids, max_url_length)
+        if len(chunks) == 1:
+            url, _ = chunks[0]
+            data = await self._get(url)
+            return data.json()
+        responses = await asyncio.gather(
+            *[self._get(url) for url, _ in chunks], return_exceptions=True)
+        results, errors = {}, {}
+        for (_, paths), response in zip(chunks, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                results.update(response.json())
+            except (EntityNotFound, ServerError, ValueError) as err:
+                for path in paths:
+                    errors[path] = err
+        if errors:
+            raise BulkFetchError(
+                'cannot fetch {} of {} entities'.format(
+                    len(errors), len(entity_ids)),
+                results, errors)
+        return results
+
+    async def map_entities(self, entity_ids, includes=None, channel=None):
+        '''Get the data of many entities, one request per entity.
+
+        See CharmStore.map_entities; all the requests run concurrently.
+        '''
+        includes = _entity_includes(includes, False, True)
+
+        async def fetch(entity_id):
+            try:
+                entity = await self._meta(entity_id, includes, channel=channel)
+            except (EntityNotFound, ServerError, ValueError) as err:
+                return EntityResult(entity_id, None, err)
+            return EntityResult(entity_id, entity, None)
+
+        return await asyncio.gather(*[
+            fetch(entity_id) for entity_id in entity_ids])
+
+    async def bundle(self, bundle_id, channel=None):
+        '''Get the default data for a bundle.
+
+        @param bundle_id The bundle's id.
+        @param channel Optional channel name.
+        '''
+        return await self.entity(bundle_id, get_files=True, channel=channel)
+
+    async def charm(self, charm_id, channel=None):
+        '''Get the default data for a charm.
+
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        '''
+        return await self.entity(charm_id, get_files=True, channel=channel)
+
+    async def charm_icon(self, charm_id, channel=None):
+        '''Get the charm icon.
+
+        @param charm_id The ID of the charm.
+        @param channel Optional channel name.
+        '''
+        url = self.charm_icon_url(charm_id, channel=channel)
+        response = await self._get(url)
+        return response.content
+
+    async def charm_icons(self, charm_ids, channel=None):
+        '''Get the icons of several charms.
+
+        See CharmStore.charm_icons; all the requests run concurrently.
+        '''
+        charm_ids = list(OrderedDict.fromkeys(charm_ids))
+        icons = await asyncio.gather(*[
+            self.charm_icon(charm_id, channel=channel)
+            for charm_id in charm_ids], return_exceptions=True)
+        results, errors = {}, {}
+        for charm_id, icon in zip(charm_ids, icons):
+            if isinstance(icon, (EntityNotFound, ServerError)):
+                errors[charm_id] = icon
+            elif isinstance(icon, Exception):
+                raise icon
+            else:
+                results[charm_id] = icon
+        if errors:
+            raise BulkFetchError(
+                'cannot fetch {} of {} icons'.format(
+                    len(errors), len(charm_ids)),
+                results, errors)
+        return results
+
+    async def bundle_visualization(self, bundle_id, channel=None):
+        '''Get the bundle visualization.
+
+        @param bundle_id The ID of the bundle.
+        @param channel Optional channel name.
+        '''
+        url = self.bundle_visualization_url(bundle_id, channel=channel)
+        response = await self._get(url)
+        return response.content
+
+    async def entity_readme_content(self, entity_id, channel=None):
+        '''Get the readme for an entity.
+
+        @entity_id The id of the entity (i.e. charm, bundle).
+        @param channel Optional channel name.
+        '''
+        readme_url = self.entity_readme_url(entity_id, channel=channel)
+        response = await self._get(readme_url)
+        return response.text
+
+    async def files(self, entity_id, manifest=None, filename=None,
+                    read_file=False, channel=None, from_archive=False):
+        '''Get the files or file contents of a file for an entity.
+
+        See CharmStore.files.
+        '''
+        if from_archive:
+            archive = await self.archive(entity_id, channel=channel)
+            if filename and read_file:
+                if filename not in archive:
+                    raise EntityNotFound(entity_id, filename)
+                return archive.read_text(filename)
+            if manifest is None:
+                manifest = [{'Name': name} for name in archive.names()]
+        if manifest is None:
+            manifest_url = self._manifest_url(entity_id, channel=channel)
+            manifest = await self._get(manifest_url)
+            manifest = manifest.json()
+        files = self._files_from_manifest(entity_id, manifest, channel)
+
+        if filename:
+            file_url = files.get(filename, None)
+            if file_url is None:
+                raise EntityNotFound(entity_id, filename)
+            if read_file:
+                data = await self._get(file_url)
+                return data.text
+            else:
+                return file_url
+        else:
+            return files
+
+    async def download_archive(self, entity_id, dest, channel=None,
+                               chunk_size=DEFAULT_CHUNK_SIZE):
+        '''Download the archive of an entity.
+
+        See CharmStore.download_archive.
+        '''
+        expected = await self._get(self._hash_url(entity_id, channel))
+        url = self.archive_url(entity_id, channel=channel)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._download_archive, url, dest, expected.json()['Sum'],
+            chunk_size)
+
+    async def archive(self, entity_id, channel=None):
+        '''Get the archive of an entity, to read any of its files locally.
+
+        See CharmStore.archive; concurrent calls for the same archive share
+        a single download.
+        '''
+        key = (self.url, _get_path(entity_id), channel)
+        archive = self.archive_cache.get(key)
+        if archive is not None:
+            return archive
+        task = self._archive_tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_archive(key))
+            self._archive_tasks[key] = task
+            task.add_done_callback(
+                lambda _: self._archive_tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_archive(self, key):
+        '''Download and cache the archive identified by the given key.'''
+        _, path, channel = key
+        fileobj = tempfile.TemporaryFile()
+        try:
+            await self.download_archive(path, fileobj, channel=channel)
+            fileobj.flush()
+            archive = Archive(fileobj)
+        except Exception:
+            fileobj.close()
+            raise
+        self.archive_cache.set(key, archive)
+        return archive
+
+    async def config(self, charm_id, channel=None):
+        '''Get the config data for a charm.
+
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        '''
+        data = await self._get(self._config_url(charm_id, channel=channel))
+        return data.json()
+
+    async def entityId(self, partial, channel=None):
+        '''Get an entity's full id provided a partial one.
+
+        Raises EntityNotFound if partial cannot be resolved.
+        @param partial The partial id (e.g. mysql, precise/mysql).
+        @param channel Optional channel name.
+        '''
+        data = await self._get(self._entity_id_url(partial, channel=channel))
+        return data.json()['Id']
+
+    async def search(self, text, includes=None, doc_type=None, limit=None,
+                     autocomplete=False, promulgated_only=False, tags=None,
+                     sort=None, owner=None, series=None, records=False):
+        '''Search for entities in the charmstore.
+
+        See CharmStore.search.
+        '''
+        url = self._search_url(text, includes, doc_type, limit, autocomplete,
+                               promulgated_only, tags, sort, owner, series)
+        data = await self._get(url)
+        return _results(data.json()['Results'], records)
+
+    async def iter_search(self, text, includes=None, doc_type=None,
+                          limit=None, autocomplete=False,
+                          promulgated_only=False, tags=None, sort=None,
+                          owner=None, series=None,
+                          page_size=DEFAULT_PAGE_SIZE, records=False):
+        '''Asynchronously iterate over the entities matching a search.
+
+        See CharmStore.iter_search.
+        '''
+        url = self._search_url(text, includes, doc_type, None, autocomplete,
+                               promulgated_only, tags, sort, owner, series)
+        async for result in self._iter_pages(url, limit, page_size):
+            yield Entity.from_dict(result) if records else result
+
+    async def _iter_pages(self, url, limit, page_size):
+        '''Iterate over the results of the given url, a page at a time.
+
+        See CharmStore._iter_pages.
+        '''
+        skip = 0
+        previous = None
+        while limit is None or skip < limit:
+            size = page_size
+            if limit is not None:
+                size = min(size, limit - skip)
+            data = await self._get(_paged_url(url, size, skip))
+            results = data.json()['Results']
+            if len(results) > size:
+                # Paging is not supported: this is the whole result set.
+                if limit is not None:
+                    results = results[:limit - skip]
+                for result in results:
+                    yield result
+                return
+            first = results[0].get('Id') if results else None
+            if first is not None and first == previous:
+                # The skip parameter is ignored: the page was already yielded.
+                return
+            previous = first
+            for result in results:
+                yield result
+            if len(results) < size:
+                return
+            skip += size
+
+    async def list(self, includes=None, doc_type=None, promulgated_only=False,
+                   sort=None, owner=None, series=None, records=False):
+        '''List entities in the charmstore.
+
+        See CharmStore.list.
+        '''
+        url = self._list_url(includes, doc_type, promulgated_only, sort,
+                             owner, series)
+        data = await self._get(url)
+        return _results(data.json()['Results'], records)
+
+    async def iter_list(self, includes=None, doc_type=None,
+                        promulgated_only=False, sort=None, owner=None,
+                        series=None, page_size=DEFAULT_PAGE_SIZE,
+                        records=False):
+        '''Asynchronously iterate over the entities in the charmstore.
+
+        See CharmStore.iter_list.
+        '''
+        url = self._list_url(includes, doc_type, promulgated_only, sort,
+                             owner, series)
+        async for result in self._iter_pages(url, None, page_size):
+            yield Entity.from_dict(result) if records else result
+
+    async def fetch_related(self, ids, records=False):
+        """Fetch related entity information.
+
+        See CharmStore.fetch_related.
+        """
+        if not ids:
+            return []
+        data = await self._get(self._fetch_related_url(ids))
+        return _results(data.json().values(), records)
+
+    async def fetch_interfaces(self, interface, way, records=False):
+        """Get the list of charms that provides or requires this interface.
+
+        See CharmStore.fetch_interfaces.
+        """
+        if not interface:
+            return []
+        if self.interface_index is not None:
+            data = {'Results': self.interface_index.charms(interface, way)}
+        else:
+            response = await self._get(
+                self._fetch_interfaces_url(interface, way))
+            data = response.json()
+        if records:
+            return _results(data['Results'], records)
+        return data.values()
+
+    async def _interface_charms(self, interface, way, records):
+        '''Return the list of charms using an interface.'''
+        if self.interface_index is not None:
+            charms = self.interface_index.charms(interface, way)
+        else:
+            response = await self._get(
+                self._fetch_interfaces_url(interface, way))
+            charms = response.json()['Results']
+        return _results(charms, records)
+
+    async def fetch_interfaces_batch(self, interfaces, way, records=False):
+        """Get the charms that provide or require each of the interfaces.
+
+        See CharmStore.fetch_interfaces_batch; all the requests run
+        concurrently.
+        """
+        interfaces = sorted(set(i for i in interfaces if i))
+        results = await asyncio.gather(*[
+            self._interface_charms(i, way, records) for i in interfaces])
+        return dict(zip(interfaces, results))
+
+    async def debug(self):
+        '''Retrieve the debug information from the charmstore.'''
+        data = await self._get(self._debug_url())
+        return data.json()
+
+
+class _Response(object):
+    """A fully read HTTP response, exposing the subset of the requests
+    response API used by the charmstore client."""
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
@@ -0,0 +1,361 @@
+from collections import namedtuple
+import base64
+import datetime
+import json
+import threading
+import time
+import weakref
+try:
+    from urllib.parse import (
+        urljoin,
+        urlparse,
+    )
+except ImportError:
+    from urlparse import (
+        urljoin,
+        urlparse,
+    )
+
+from macaroonbakery import (
+    bakery,
+    checkers,
+    httpbakery,
+)
+from pymacaroons.serializers import JsonSerializer
+import requests
+
+from theblues.errors import log
+from theblues.singleflight import SingleFlight
+
+
+# How long in seconds before their expiry the macaroons are discharged
+# again in the background.
+DEFAULT_REFRESH_MARGIN = 60
+# The name of the cookie holding the macaroons when the service does not
+# suggest a suffix, as used by httpbakery.
+DEFAULT_COOKIE_NAME = 'macaroon-auth'
+
+# The discharged macaroons authorizing requests to a service.
+# The name and value are those of the cookie sent with the requests under
+# path at the given host. Expires is the time in seconds since the epoch of
+# the earliest time-before caveat, or None, and obtained is the time the
+# macaroons were discharged.
+Authorization = namedtuple(
+    'Authorization',
+    ['host', 'path', 'name', 'value', 'expires', 'obtained'])
+AuthStats = namedtuple(
+    'AuthStats', ['hits', 'misses', 'discharges', 'refreshes', 'failures'])
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class AuthCache(object):
+    """Keep the macaroons discharged for each client and service.
+
+    Without a cache, the authorizer returned by httpbakery.Client.auth only
+    discharges macaroons once a request was refused, and the discharged
+    macaroons are not sent with later requests unless the cookie jar of the
+    client is used for them. With a cache, the discharged macaroons are sent
+    with every request to the service until they expire, so that requests
+    are not refused in the first place.
+
+    Concurrent requests refused at the same time, for instance by threads
+    starting at once, wait for a single discharge and share it. Macaroons
+    expiring within refresh_margin seconds are discharged again in the
+    background, while the current ones are still used.
+
+    Share a cache between clients to share the macaroons:
+
+        auth_cache = AuthCache()
+        charmstore = CharmStore(client=client, auth_cache=auth_cache)
+        plans = Plans(url, client=client,
+                      transport=Transport(auth_cache=auth_cache))
+
+    The cache is safe to share between threads.
+    """
+
+    def __init__(self, refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 background=True, clock=time.time):
+        """Initializer.
+
+        @param refresh_margin How long in seconds before their expiry the
+            macaroons are discharged again, or None to only discharge them
+            once they are refused.
+        @param background Whether the macaroons are refreshed in a
+            background thread, rather than by the request finding them
+            about to expire.
+        @param clock A function returning the current time in seconds.
+        """
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Map clients to the _Entry of each (host, path) they are authorized
+        # for; entries are dropped with their client.
+        self._clients = weakref.WeakKeyDictionary()
+        self._single_flight = SingleFlight()
+        self._hits = self._misses = self._discharges = 0
+        self._refreshes = self._failures = 0
+
+    def auth(self, client, url):
+        """Return an authorizer for a request, to pass as requests auth.
+
+        @param client The httpbakery.Client discharging the macaroons.
+        @param url The url of the request.
+        """
+        return _CachedAuth(self, client, url)
+
+    def get(self, client, url):
+        """Return the valid Authorization for a url, or None."""
+        entry = self._lookup(client, url)
+        return None if entry is None else entry.authorization
+
+    def authorizations(self, client):
+        """Return the valid Authorizations of a client."""
+        now = self._clock()
+        with self._lock:
+            entries = list(self._clients.get(client, {}).values())
+        return [entry.authorization for entry in entries
+                if entry.valid(now)]
+
+    def invalidate(self, client, url=None):
+        """Forget the macaroons of a client, for a url or for all urls."""
+        with self._lock:
+            entries = self._clients.get(client)
+            if not entries:
+                return
+            if url is None:
+                entries.clear()
+                return
+            host, path = _split(url)
+            for key in list(entries):
+                if key[0] == host and path.startswith(key[1]):
+                    del entries[key]
+
+    def stats(self):
+        """Return an AuthStats tuple counting the cache lookups (hits and
+        misses), the discharges, the refreshes and the failed discharges.
+        """
+        with self._lock:
+            return AuthStats(
+                hits=self._hits, misses=self._misses,
+                discharges=self._discharges, refreshes=self._refreshes,
+                failures=self._failures)
+
+    def _lookup(self, client, url, count=False):
+        """Return the _Entry of the valid macaroons for a url, or None.
+
+        When the macaroons are about to expire, a refresh is started.
+        @param count Whether to count the lookup as a hit or miss.
+        """
+        host, path = _split(url)
+        now = self._clock()
+        with self._lock:
+            best = None
+            for (h, p), entry in self._clients.get(client, {}).items():
+                if (h == host and path.startswith(p) and entry.valid(now) and
+                        (best is None or len(p) > len(best.key[1]))):
+                    best = entry
+            if count:
+                if best is None:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+            refresh = best is not None and self._should_refresh(best, now)
+        if refresh:
+            self._start_refresh(client, best)
+        return best
+
+    def _should_refresh(self, entry, now):
+        """Return whether to refresh an entry, with the lock held."""
+        expires = entry.authorization.expires
+        if (self.refresh_margin is None or expires is None or
+                entry.refreshing or expires - now > self.refresh_margin):
+            return False
+        entry.refreshing = True
+        return True
+
+    def _start_refresh(self, client, entry):
+        if not self.background:
+            self._refresh(client, entry)
+            return
+        thread = threading.Thread(
+            target=self._refresh, args=(client, entry),
+            name='theblues-auth-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, client, entry):
+        """Discharge the macaroon of an entry again."""
+        with self._lock:
+            self._refreshes += 1
+        try:
+            self._discharge(client, entry.url, entry.error)
+        except Exception as err:
+            # The current macaroons are used until they expire.
+            log.warning('cannot refresh macaroons for {}: {}'.format(
+                entry.url, err))
+
+    def _authorize(self, client, url, error, sent_at):
+        """Return the Authorization for a request refused with error.
+
+        The macaroons are discharged, unless they were since the request
+        was sent. Concurrent callers share a single discharge.
+        @param sent_at The time the refused request was sent.
+        """
+        entry = self._lookup(client, url)
+        if entry is not None and entry.authorization.obtained >= sent_at:
+            return entry.authorization
+        host, _ = _split(url)
+        key = (id(client), host, _macaroon_path(url, error))
+        return self._single_flight.do(
+            key, self._discharge, client, url, error).authorization
+
+    def _discharge(self, client, url, error):
+        """Discharge the macaroon in error and store the result.
+
+        @return the new _Entry.
+        """
+        try:
+            discharges = bakery.discharge_all(
+                error.info.macaroon, client.acquire_discharge, client.key)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+            raise
+        now = self._clock()
+        value = base64.urlsafe_b64encode(json.dumps([
+            json.loads(m.serialize(JsonSerializer())) for m in discharges
+        ]).encode('utf-8')).decode('ascii')
+        expires = checkers.macaroons_expiry_time(
+            checkers.Namespace(), discharges)
+        if expires is not None:
+            expires = (expires - _EPOCH).total_seconds()
+        host, _ = _split(url)
+        path = _macaroon_path(url, error)
+        name = DEFAULT_COOKIE_NAME
+        if error.info.cookie_name_suffix is not None:
+            name = 'macaroon-' + error.info.cookie_name_suffix
+        entry = _Entry(
+            Authorization(host, path, name, value, expires, now), url, error)
+        with self._lock:
+            self._discharges += 1
+            entries = self._clients.setdefault(client, {})
+            previous = entries.get(entry.key)
+            # Do not refresh again macaroons whose expiry is not extended by
+            # a new discharge, e.g. as that of the service macaroon comes
+            # first.
+            if (previous is not None and previous.refreshing and
+                    expires is not None and
+                    previous.authorization.expires is not None and
+                    expires <= previous.authorization.expires):
+                entry.refreshing = True
+            entries[entry.key] = entry
+        return entry
+
+
+class _Entry(object):
+    """The macaroons discharged for a client and service."""
+
+    def __init__(self, authorization, url, error):
+        self.authorization = authorization
+        self.key = (authorization.host, authorization.path)
+        # The url and discharge-required error the macaroons were obtained
+        # with, to discharge them again.
+        self.url = url
+        self.error = error
+        self.refreshing = False
+
+    def valid(self, now):
+        expires = self.authorization.expires
+        return expires is None or now < expires
+
+
+class _CachedAuth(object):
+    """A requests authorizer sending the cached macaroons.
+
+    Requests refused with a discharge-required error are sent again once
+    the macaroons are discharged, like httpbakery does.
+    """
+
+    def __init__(self, cache, client, url):
+        self._cache = cache
+        self._client = client
+        self._url = url
+
+    def __call__(self, request):
+        request.headers[httpbakery.BAKERY_PROTOCOL_HEADER] = str(
+            bakery.LATEST_VERSION)
+        sent_at = self._cache._clock()
+        entry = self._cache._lookup(self._client, self._url, count=True)
+        if entry is not None:
+            _set_cookie(request, entry.authorization)
+
+        def hook(response, **kwargs):
+            return self._handle_response(response, sent_at, **kwargs)
+
+        request.register_hook('response', hook)
+        return request
+
+    def _handle_response(self, response, sent_at, **kwargs):
+        error = _discharge_required(response)
+        if error is None:
+            return response
+        authorization = self._cache._authorize(
+            self._client, response.request.url, error, sent_at)
+        # Read the refused response so that its connection can be reused.
+        response.content
+        response.close()
+        request = response.request.copy()
+        _set_cookie(request, authorization)
+        if response.connection is not None:
+            retried = response.connection.send(request, **kwargs)
+        else:
+            with requests.Session() as session:
+                retried = session.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
+
+
+def _discharge_required(response):
+    """Return the httpbakery.Error of a discharge-required response, or None.
+    """
+    if response.status_code not in (401, 407):
+        return None
+    if (response.status_code == 401 and
+            response.headers.get('WWW-Authenticate') != 'Macaroon'):
+        return None
+    if response.headers.get('Content-Type') != 'application/json':
+        return None
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    if data.get('Code') != httpbakery.ERR_DISCHARGE_REQUIRED:
+        return None
+    error = httpbakery.Error.from_dict(data)
+    if error.info is None or error.info.macaroon is None:
+        return None
+    return error
+
+
+def _set_cookie(request, authorization):
+    """Add the macaroons cookie to a prepared request, replacing any."""
+    prefix = authorization.name + '='
+    cookies = [
+        cookie for cookie in request.headers.get('Cookie', '').split('; ')
+        if cookie and not cookie.startswith(prefix)]
+    cookies.append(prefix + authorization.value)
+    request.headers['Cookie'] = '; '.join(cookies)
+
+
+def _split(url):
+    """Return the host and path of a url."""
+    parts = urlparse(url)
+    return parts.netloc, parts.path or '/'
+
+
+def _macaroon_path(url, error):
+    """Return the path under which the discharged macaroons are valid."""
+    return urlparse(urljoin(url, error.info.macaroon_path or '/')).path
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import copy
+import json
+import threading
+
+from theblues.charmstore import (
+    _entity_includes,
+    _get_path,
+    _meta_cache_key,
+)
+from theblues.errors import EntityNotFound
+
+
+# The maximum number of ids resolved by a single bulk request.
+DEFAULT_MAX_BATCH_SIZE = 100
+
+
+class EntityBatcher(object):
+    """Resolve independent entity lookups with bulk meta/any requests.
+
+    Lookups are queued and return a concurrent.futures.Future. Queued
+    lookups sharing the same includes and channel are resolved by a single
+    multi-id meta/any request when the batch is flushed: either explicitly,
+    when leaving the batcher context, or automatically after a short window
+    following the first queued lookup.
+
+    For instance:
+
+        with EntityBatcher(charmstore) as batch:
+            mysql = batch.entity('mysql')
+            wordpress = batch.entity('wordpress')
+        print(mysql.result(), wordpress.result())
+    """
+
+    def __init__(self, charmstore, window=None,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        """Initializer.
+
+        @param charmstore The CharmStore used to make the requests.
+        @param window If not None, how long in seconds to wait after the
+            first queued lookup before flushing the batch automatically.
+        @param max_batch_size The maximum number of ids per request.
+        """
+        self.charmstore = charmstore
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def entity(self, entity_id, get_files=False, channel=None,
+               include_stats=True, includes=None):
+        '''Queue a lookup of the default data for an entity.
+
+        The parameters are the same as for CharmStore.entity.
+        @return a Future resolving to the entity data, or raising
+            EntityNotFound or ServerError.
+        '''
+        includes = _entity_includes(includes, get_files, include_stats)
+        path = _get_path(entity_id)
+        future = Future()
+        cache = self.charmstore.cache
+        if cache is not None:
+            content = cache.get(_meta_cache_key(
+                self.charmstore.url, path, includes, channel))
+            if content is not None:
+                future.set_result(json.loads(content.decode('utf-8')))
+                return future
+        group = (tuple(sorted(set(includes))), channel)
+        with self._lock:
+            self._pending.setdefault(group, OrderedDict()).setdefault(
+                path, []).append(future)
+            if self.window is not None and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def load(self, entity_id, **kwargs):
+        '''Get the default data for an entity through the batch.
+
+        This blocks until the batch is flushed, so it is only useful when a
+        window is set and other threads share the batcher.
+        @param entity_id The entity's id either as a reference or a string.
+        @param kwargs The other parameters accepted by entity.
+        '''
+        return self.entity(entity_id, **kwargs).result()
+
+    def flush(self):
+        '''Resolve all the queued lookups.'''
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for (includes, channel), futures in pending.items():
+            paths = list(futures)
+            for i in range(0, len(paths), self.max_batch_size):
+                chunk = paths[i:i + self.max_batch_size]
+                self._resolve(chunk, list(includes), channel, futures)
+
+    def _resolve(self, paths, includes, channel, futures):
+        '''Fetch the given entities and resolve their futures.
+
+        Futures cancelled by their caller are skipped.
+        '''
+        url = self.charmstore._bulk_meta_url(paths, includes, channel)
+        try:
+            data = self.charmstore._json(self.charmstore._get(url))
+        except Exception as err:
+            for path in paths:
+                for future in _running(futures[path]):
+                    future.set_exception(err)
+            return
+        cache = self.charmstore.cache
+        for path in paths:
+            entity = data.get(path)
+            if entity is not None and cache is not None:
+                cache.set(
+                    _meta_cache_key(
+                        self.charmstore.url, path, includes, channel),
+                    json.dumps(entity).encode('utf-8'))
+            for i, future in enumerate(_running(futures[path])):
+                if entity is None:
+                    future.set_exception(EntityNotFound(path))
+                else:
+                    # Callers asking for the same entity get their own copy.
+                    future.set_result(entity if i == 0 else
+                                      copy.deepcopy(entity))
+
+
+def _running(futures):
+    '''Return the futures which were not cancelled, marked as running.'''
+    return [
+        future for future in futures
+        if future.set_running_or_notify_cancel()]
@@ -0,0 +1,650 @@
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+import errno
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from theblues.errors import log
+
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BLOB_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 300
+# How long to wait for another process to release the database lock.
+DEFAULT_SQLITE_TIMEOUT = 5
+# The access time of disk entries is only updated when older than this many
+# seconds, so that cache hits rarely need to write to the database.
+ACCESS_TIME_RESOLUTION = 60
+
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['etag', 'last_modified', 'content', 'headers', 'encoding'])
+CacheStats = namedtuple(
+    'CacheStats',
+    ['hits', 'misses', 'evictions', 'expirations', 'entries', 'size'])
+
+
+class HTTPCache(object):
+    """A cache of responses keyed by URL, revalidated with the server.
+
+    Only responses carrying an ETag or Last-Modified validator are stored.
+    The validators are sent back with the next request for the same URL, and
+    the stored body is reused when the server answers 304 Not Modified.
+    The least recently used entries are discarded past max_entries.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """Initializer.
+
+        @param max_entries The maximum number of responses to keep.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def headers(self, url):
+        """Return the conditional request headers for the given url.
+
+        @param url The url about to be requested.
+        @return a dict of headers, empty if nothing is cached for the url.
+        """
+        entry = self._get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, url, response):
+        """Store a successful response if it can be revalidated.
+
+        @param url The requested url.
+        @param response The requests response received for the url.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        entry = CachedResponse(
+            etag=etag, last_modified=last_modified, content=response.content,
+            headers=dict(response.headers), encoding=response.encoding)
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def not_modified(self, url, response):
+        """Return the cached response to use in place of a 304 response.
+
+        @param url The requested url.
+        @param response The 304 response received for the url.
+        @return a 200 requests response holding the cached body, or None if
+            the url is no longer cached.
+        """
+        entry = self._get(url)
+        if entry is None:
+            return None
+        cached = requests.Response()
+        cached.status_code = 200
+        cached.reason = 'OK'
+        cached.url = response.url
+        cached.request = response.request
+        cached.headers = CaseInsensitiveDict(entry.headers)
+        cached.encoding = entry.encoding
+        cached._content = entry.content
+        return cached
+
+    def clear(self):
+        """Remove all the cached responses."""
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, url):
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._entries[url] = entry
+            return entry
+
+
+class MemoryCache(object):
+    """An in-process cache of byte strings with expiry and LRU eviction.
+
+    Every entry expires after a time to live. When either the number of
+    entries or their approximate total size (the length of keys and values)
+    exceeds its bound, the least recently used entries are evicted.
+    The cache is safe to share between threads.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, clock=time.time):
+        """Initializer.
+
+        @param ttl The default time to live of entries in seconds; a value
+            of None means entries never expire.
+        @param max_entries The maximum number of entries to keep.
+        @param max_bytes The maximum approximate size of the entries.
+        @param clock A function returning the current time in seconds.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        # Map keys to (value, expiry time) tuples, least recently used first.
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = self._misses = self._evictions = self._expirations = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored for the given key.
+
+        @param key The string key.
+        @return the value, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires <= self._clock():
+                self._size -= _entry_size(key, value)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value.
+
+        @param key The string key.
+        @param value The byte string to store.
+        @param ttl The time to live in seconds, defaulting to the cache ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self._clock() + ttl
+        size = _entry_size(key, value)
+        with self._lock:
+            self._delete(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires)
+            self._size += size
+            while (len(self._entries) > self.max_entries or
+                   self._size > self.max_bytes):
+                old_key, (old_value, _) = self._entries.popitem(last=False)
+                self._size -= _entry_size(old_key, old_value)
+                self._evictions += 1
+
+    def delete(self, key):
+        """Remove the entry for the given key, if any.
+
+        @param key The string key.
+        """
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return a CacheStats tuple with the cache counters."""
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions, expirations=self._expirations,
+                entries=len(self._entries), size=self._size)
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= _entry_size(key, entry[0])
+
+
+def _entry_size(key, value):
+    """Return the approximate size of a cache entry."""
+    return len(key) + len(value)
+
+
+class SQLiteCache(object):
+    """A cache of byte strings stored in a SQLite database file.
+
+    The cache has the same interface as MemoryCache. Several processes (for
+    instance web server workers) can use the same file concurrently: the
+    database is opened in write-ahead logging mode, so readers do not block
+    the writer, and entries survive restarts. Each thread uses its own
+    connection. Database errors are logged and reported as cache misses.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, timeout=DEFAULT_SQLITE_TIMEOUT,
+                 clock=time.time):
+        """Initializer.
+
+        @param path The path to the database file, created if required.
+        @param ttl The default time to live of entries in seconds; a value
+            of None means entries never expire.
+        @param max_entries The maximum number of entries to keep.
+        @param max_bytes The maximum approximate size of the entries.
+        @param timeout How long to wait in seconds for a locked database.
+        @param clock A function returning the current time in seconds.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = self._expirations = 0
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                'expires REAL, accessed REAL NOT NULL, '
+                'size INTEGER NOT NULL)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_accessed '
+                'ON cache (accessed)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_expires '
+                'ON cache (expires)')
+            # The number and size of the entries are kept up to date by
+            # triggers, so that writes do not need to scan the table to
+            # know whether it must be pruned.
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_totals ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                'entries INTEGER NOT NULL, size INTEGER NOT NULL)')
+            conn.execute(
+                'INSERT OR IGNORE INTO cache_totals (id, entries, size) '
+                'SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM cache')
+            conn.execute(
+                'CREATE TRIGGER IF NOT EXISTS cache_insert '
+                'AFTER INSERT ON cache BEGIN '
+                'UPDATE cache_totals SET entries = entries + 1, '
+                'size = size + NEW.size; END')
+            conn.execute(
+                'CREATE TRIGGER IF NOT EXISTS cache_delete '
+                'AFTER DELETE ON cache BEGIN '
+                'UPDATE cache_totals SET entries = entries - 1, '
+                'size = size - OLD.size; END')
+
+    def __len__(self):
+        return self.stats().entries
+
+    def get(self, key):
+        """Return the value stored for the given key.
+
+        @param key The string key.
+        @return the value, or None if it is missing or expired.
+        """
+        now = self._clock()
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    'SELECT value, expires, accessed FROM cache '
+                    'WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self._count(misses=1)
+                    return None
+                value, expires, accessed = row
+                if expires is not None and expires <= now:
+                    conn.execute(
+                        'DELETE FROM cache WHERE key = ? AND expires = ?',
+                        (key, expires))
+                    self._count(misses=1, expirations=1)
+                    return None
+                if now - accessed > ACCESS_TIME_RESOLUTION:
+                    conn.execute(
+                        'UPDATE cache SET accessed = ? WHERE key = ?',
+                        (now, key))
+        except sqlite3.Error as err:
+            log.warning('cannot read cache {}: {}'.format(self.path, err))
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return bytes(value)
+
+    def set(self, key, value, ttl=None):
+        """Store a value.
+
+        @param key The string key.
+        @param value The byte string to store.
+        @param ttl The time to live in seconds, defaulting to the cache ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = self._clock()
+        expires = None if ttl is None else now + ttl
+        size = _entry_size(key, value)
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+        try:
+            with self._connection() as conn:
+                # The entry is deleted first, as a replacement does not run
+                # the delete trigger.
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                conn.execute(
+                    'INSERT INTO cache '
+                    '(key, value, expires, accessed, size) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, sqlite3.Binary(value), expires, now, size))
+                self._prune(conn, now)
+        except sqlite3.Error as err:
+            log.warning('cannot write cache {}: {}'.format(self.path, err))
+
+    def delete(self, key):
+        """Remove the entry for the given key, if any.
+
+        @param key The string key.
+        """
+        try:
+            with self._connection() as conn:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as err:
+            log.warning('cannot write cache {}: {}'.format(self.path, err))
+
+    def clear(self):
+        """Remove all the entries."""
+        try:
+            with self._connection() as conn:
+                conn.execute('DELETE FROM cache')
+        except sqlite3.Error as err:
+            log.warning('cannot write cache {}: {}'.format(self.path, err))
+
+    def stats(self):
+        """Return a CacheStats tuple with the cache counters.
+
+        Hits, misses, evictions and expirations are counted for this
+        instance only; entries and size describe the whole database, and
+        are zero when it cannot be read.
+        """
+        try:
+            with self._connection() as conn:
+                entries, size = self._totals(conn)
+        except sqlite3.Error as err:
+            log.warning('cannot read cache {}: {}'.format(self.path, err))
+            entries = size = 0
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions, expirations=self._expirations,
+                entries=entries, size=size)
+
+    def _connection(self):
+        """Return the database connection for the current thread.
+
+        Connections are not reused across a fork.
+        """
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def _totals(self, conn):
+        """Return the number and size of the entries in the database."""
+        return conn.execute(
+            'SELECT entries, size FROM cache_totals').fetchone()
+
+    def _prune(self, conn, now):
+        """Remove expired entries, then least recently used ones, if the
+        cache does not fit in its bounds."""
+        entries, size = self._totals(conn)
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        expired = max(conn.execute(
+            'DELETE FROM cache WHERE expires <= ?', (now,)).rowcount, 0)
+        entries, size = self._totals(conn)
+        evicted = []
+        if entries > self.max_entries or size > self.max_bytes:
+            rows = conn.execute(
+                'SELECT key, size FROM cache ORDER BY accessed')
+            for key, entry_size in rows:
+                if entries <= self.max_entries and size <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                entries -= 1
+                size -= entry_size
+            rows.close()
+            conn.executemany('DELETE FROM cache WHERE key = ?', evicted)
+        self._count(evictions=len(evicted), expirations=expired)
+
+    def _count(self, hits=0, misses=0, evictions=0, expirations=0):
+        with self._lock:
+            self._hits += hits
+            self._misses += misses
+            self._evictions += evictions
+            self._expirations += expirations
+
+
+class BlobCache(object):
+    """A content-addressed disk cache of binary responses.
+
+    Keys (for instance an entity path and channel) refer to the SHA256
+    digest of their content, and each distinct content is stored once as a
+    file named after its digest, so that the icon shared by many charms
+    takes space only once. The references are stored in a SQLiteCache in
+    the same directory, with its time to live and entry bound. When the
+    content files exceed max_bytes, the least recently used are removed,
+    and the keys referring to them become misses.
+
+    The interface is the same as MemoryCache. The cache is safe to share
+    between threads and processes.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_BLOB_MAX_BYTES, clock=time.time):
+        """Initializer.
+
+        @param directory The directory holding the cache, created if
+            required.
+        @param ttl The default time to live of keys in seconds; a value of
+            None means keys never expire.
+        @param max_entries The maximum number of keys to keep.
+        @param max_bytes The maximum total size of the stored contents.
+        @param clock A function returning the current time in seconds.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blobs = os.path.join(directory, 'blobs')
+        if not os.path.isdir(self._blobs):
+            try:
+                os.makedirs(self._blobs)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self._refs = SQLiteCache(
+            os.path.join(directory, 'refs.db'), ttl=ttl,
+            max_entries=max_entries, clock=clock)
+        self._lock = threading.Lock()
+        # The total size of the contents, computed on the first write.
+        self._size = None
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._refs)
+
+    def get(self, key):
+        """Return the content stored for the given key.
+
+        @param key The string key.
+        @return the content, or None if it is missing, expired or evicted.
+        """
+        digest = self._refs.get(key)
+        if digest is None:
+            return None
+        path = self._path(digest.decode('ascii'))
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            if time.time() - os.path.getmtime(path) > ACCESS_TIME_RESOLUTION:
+                os.utime(path, None)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                log.warning('cannot read cache {}: {}'.format(path, err))
+            self._refs.delete(key)
+            return None
+        if hashlib.sha256(value).hexdigest() != digest.decode('ascii'):
+            log.warning('invalid content in cache {}'.format(path))
+            self._refs.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store a content.
+
+        @param key The string key.
+        @param value The byte string to store.
+        @param ttl The time to live in seconds, defaulting to the cache ttl.
+        """
+        if len(value) > self.max_bytes:
+            self._refs.delete(key)
+            return
+        digest = hashlib.sha256(value).hexdigest()
+        path = self._path(digest)
+        try:
+            if os.path.exists(path):
+                os.utime(path, None)
+            else:
+                self._write(path, value)
+        except (IOError, OSError) as err:
+            log.warning('cannot write cache {}: {}'.format(path, err))
+            return
+        self._refs.set(key, digest.encode('ascii'), ttl=ttl)
+
+    def delete(self, key):
+        """Remove the entry for the given key, if any.
+
+        The content is kept until evicted, as other keys may refer to it.
+
+        @param key The string key.
+        """
+        self._refs.delete(key)
+
+    def clear(self):
+        """Remove all the entries and contents."""
+        self._refs.clear()
+        with self._lock:
+            for path, _, _ in self._files():
+                _remove(path)
+            self._size = 0
+
+    def stats(self):
+        """Return a CacheStats tuple with the cache counters.
+
+        Entries count the keys, and size is the total size of the distinct
+        contents. Evictions count the contents removed by this instance.
+        """
+        refs = self._refs.stats()
+        with self._lock:
+            size = sum(size for _, size, _ in self._files())
+            return refs._replace(
+                evictions=refs.evictions + self._evictions, size=size)
+
+    def _path(self, digest):
+        """Return the path of the file storing the content with a digest."""
+        return os.path.join(self._blobs, digest[:2], digest)
+
+    def _write(self, path, value):
+        """Atomically write a content file, then prune the cache."""
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.mkdir(parent)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(tmp, path)
+        except BaseException:
+            _remove(tmp)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += len(value)
+            if self._size > self.max_bytes:
+                self._prune()
+
+    def _files(self):
+        """Return (path, size, access time) tuples for the content files."""
+        files = []
+        for parent, _, names in os.walk(self._blobs):
+            for name in names:
+                if len(name) != 64:
+                    # Skip the temporary files being written.
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _prune(self):
+        """Remove the least recently used contents until the cache fits in
+        its bounds, with the lock held.
+
+        Files are scanned again, as other processes may share the cache.
+        """
+        files = self._files()
+        size = sum(file_size for _, file_size, _ in files)
+        for path, file_size, _ in sorted(files, key=lambda f: f[2]):
+            if size <= self.max_bytes:
+                break
+            if _remove(path):
+                self._evictions += 1
+            size -= file_size
+        self._size = size
+
+
+def _remove(path):
+    """Remove a file, returning whether it existed."""
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            log.warning('cannot remove cache file {}: {}'.format(path, err))
+        return False
+    return True
@@ -1,11 +1,24 @@
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+from concurrent.futures import (
+    as_completed,
+    ThreadPoolExecutor,
+)
+from contextlib import contextmanager
+import functools
+import hashlib
+import json
 import logging
+import os
+import tempfile
 try:
     from urllib import urlencode
 except:
     from urllib.parse import urlencode
 
 from macaroonbakery import httpbakery
-import requests
 from requests.exceptions import (
     HTTPError,
     RequestException,
@@ -13,10 +26,36 @@ from requests.exceptions import (
     )
 
 from .errors import (
+    BulkFetchError,
     EntityNotFound,
     ServerError,
     )
-from theblues.utils import DEFAULT_TIMEOUT, API_URL
+from theblues.archive import (
+    Archive,
+    ArchiveCache,
+)
+from theblues.jsonstream import iter_items
+from theblues.metrics import (
+    bind,
+    CACHE_HIT,
+    CACHE_MISS,
+    CACHE_REVALIDATED,
+    current_operation,
+    instrumented,
+    observe_decode,
+    observe_request,
+)
+from theblues.records import (
+    iter_records,
+    to_records,
+)
+from theblues.singleflight import SingleFlight
+from theblues.utils import (
+    API_URL,
+    DEFAULT_POOL_MAXSIZE,
+    DEFAULT_TIMEOUT,
+    make_session,
+)
 
 
 DEFAULT_INCLUDES = [
@@ -34,13 +73,37 @@ DEFAULT_INCLUDES = [
     'supported-series',
     'terms',
 ]
+# Bulk requests are split so that their url is at most this long, as longer
+# urls are rejected by some servers and proxies.
+DEFAULT_MAX_URL_LENGTH = 2000
+# The maximum number of bulk requests performed concurrently.
+DEFAULT_WORKERS = 4
+# The size of the chunks read when streaming archives.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# The number of results requested per page when iterating search results.
+DEFAULT_PAGE_SIZE = 100
+
+
+# The outcome of fetching an entity with CharmStore.map_entities: the id as
+# given, and either the entity data or the error raised.
+EntityResult = namedtuple('EntityResult', ['id', 'entity', 'error'])
 
 
 class CharmStore(object):
-    """A connection to the charmstore."""
+    """A connection to the charmstore.
+
+    A CharmStore is safe to share between threads, which then share its
+    connection pool and caches; pool_maxsize should be at least the number
+    of threads sending requests at once.
+    """
 
     def __init__(self, url=API_URL, timeout=DEFAULT_TIMEOUT,
-                 verify=True, client=None, cookies=None):
+                 verify=True, client=None, cookies=None, http_cache=None,
+                 cache=None, coalesce=True, archive_cache=None,
+                 interface_index=None, blob_cache=None, retry=None,
+                 hedge=None, circuit_breakers=None, instrumentation=None,
+                 rate_limits=None, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 auth_cache=None):
         """Initializer.
 
         @param url The base url to the charmstore API.  Defaults
@@ -53,62 +116,201 @@ class CharmStore(object):
         requests with macaroons.
         @param cookies (which act as dict) holds cookies to be sent with the
         requests.
+        @param http_cache An optional cache.HTTPCache used to revalidate
+            previously fetched responses instead of downloading them again.
+        @param cache An optional cache (e.g. cache.MemoryCache or
+            cache.SQLiteCache) used to serve entity metadata, search and list
+            results, icons and diagrams without contacting the charmstore.
+        @param coalesce Whether concurrent requests for the same url share a
+            single request to the charmstore.
+        @param archive_cache The archive.ArchiveCache keeping the archives
+            downloaded to read files from. By default the most recently used
+            archives are kept.
+        @param interface_index An optional interface_index.InterfaceIndex
+            used to answer fetch_interfaces without querying the charmstore.
+        @param blob_cache An optional cache.BlobCache used to serve icons and
+            diagrams in place of the cache above.
+        @param retry An optional retry.RetryPolicy used to retry requests
+            failing with transient errors.
+        @param hedge An optional retry.HedgePolicy used to send a second
+            request when a response is slow. Streamed downloads are not
+            hedged.
+        @param circuit_breakers An optional
+            circuitbreaker.CircuitBreakerRegistry used to fail fast with
+            CircuitOpenError when the charmstore keeps failing.
+        @param instrumentation An optional metrics.Instrumentation (e.g. a
+            metrics.Collector) to which the requests, JSON decode times and
+            cache lookups of each operation are reported.
+        @param rate_limits An optional ratelimit.RateLimiterRegistry
+            bounding the request rate and concurrency to the charmstore.
+            Requests over the limits wait, or fail with RateLimitError.
+        @param pool_maxsize The maximum number of connections to the
+            charmstore kept alive for reuse.
+        @param auth_cache An optional auth.AuthCache keeping the macaroons
+            discharged for the client, so that they are sent with every
+            request instead of being discharged again when refused.
         """
         super(CharmStore, self).__init__()
         self.url = url
         self.verify = verify
-        self.session = requests.Session()
+        self.session = make_session(pool_maxsize=pool_maxsize)
         self.timeout = timeout
         self.cookies = cookies
         if client is None:
             client = httpbakery.Client()
         self._client = client
+        self.http_cache = http_cache
+        self.cache = cache
+        self._single_flight = SingleFlight() if coalesce else None
+        if archive_cache is None:
+            archive_cache = ArchiveCache()
+        self.archive_cache = archive_cache
+        self.interface_index = interface_index
+        self.blob_cache = blob_cache
+        self.retry = retry
+        self.hedge = hedge
+        self.circuit_breakers = circuit_breakers
+        self.rate_limits = rate_limits
+        self.instrumentation = instrumentation
+        self.auth_cache = auth_cache
 
     def _get(self, url):
         """Make a get request against the charmstore.
 
         This method is used by other API methods to standardize querying.
+        When coalescing is enabled, callers requesting a url already being
+        fetched wait for that request and share its response or error.
         @param url The full url to query
             (e.g. https://api.jujucharms.com/charmstore/v4/macaroon)
         """
-        try:
-            response = self.session.get(url, verify=self.verify,
-                                    cookies=self.cookies, timeout=self.timeout,
-                                    auth=self._client.auth())
+        if self._single_flight is None:
+            return self._do_get(url)
+        return self._single_flight.do(url, self._do_get, url)
+
+    def _do_get(self, url):
+        """Make a get request against the charmstore; see _get.
+
+        @param url The full url to query.
+        """
+        with self._request_errors(url):
+            headers = {}
+            if self.http_cache is not None:
+                headers = self.http_cache.headers(url)
+            response = self._request(url, headers)
+            if response.status_code == 304 and headers:
+                cached = self.http_cache.not_modified(url, response)
+                if cached is not None:
+                    self._observe_cache(CACHE_REVALIDATED)
+                    return cached
+                # The entry was evicted meanwhile: fetch the whole body.
+                response = self._request(url, {})
             response.raise_for_status()
+            if self.http_cache is not None:
+                self.http_cache.store(url, response)
             return response
+
+    @contextmanager
+    def _request_errors(self, url):
+        """Translate the errors raised in the block into charmstore errors.
+
+        @param url The url being requested.
+        @raise EntityNotFound if the entity does not exist.
+        @raise ServerError if any other error occurs.
+        """
+        try:
+            yield
         except HTTPError as exc:
-            if exc.response.status_code in (404, 407):
-                raise EntityNotFound(url)
-            else:
-                message = ('Error during request: {url} '
-                           'status code:({code}) '
-                           'message: {message}').format(
-                               url=url,
-                               code=exc.response.status_code,
-                               message=exc.response.text)
-                logging.error(message)
-                raise ServerError(exc.response.status_code,
-                                  exc.response.text,
-                                  message)
+            raise _status_error(
+                url, exc.response.status_code, exc.response.text)
         except Timeout:
-            message = 'Request timed out: {url} timeout: {timeout}'
-            message = message.format(url=url, timeout=self.timeout)
-            logging.error(message)
-            raise ServerError(message)
+            raise _timeout_error(url, self.timeout)
         except RequestException as exc:
-            message = ('Error during request: {url} '
-                       'message: {message}').format(
-                           url=url,
-                           message=exc)
-            logging.error(message)
-            raise ServerError(exc.args[0][1].errno,
-                              exc.args[0][1].strerror,
-                              message)
+            raise _connection_error(url, exc, _request_exception_cause(exc))
+
+    def _request(self, url, headers, stream=False):
+        """Send a single get request to the charmstore.
+
+        @param url The full url to query.
+        @param headers A dict of additional request headers.
+        @param stream Whether to defer downloading the response body.
+        """
+        def send():
+            return self.session.get(
+                url, verify=self.verify, headers=headers,
+                cookies=self.cookies, timeout=self.timeout,
+                auth=self._auth(url), stream=stream)
+
+        if self.rate_limits is not None:
+            limiter = self.rate_limits.for_url(url)
+            send = functools.partial(
+                limiter.call, send, instrumentation=self.instrumentation)
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.for_url(url)
+            send = functools.partial(breaker.call, send)
+        if self.hedge is not None and not stream:
+            # The hedged requests run in the executor of the policy.
+            send = functools.partial(self.hedge.call, bind(send))
+        if self.retry is not None:
+            send = functools.partial(self.retry.call, 'GET', send, url)
+        if self.instrumentation is None:
+            return send()
+        return observe_request(
+            self.instrumentation, 'GET', url, send, stream=stream)
+
+    def _auth(self, url):
+        """Return the requests authorizer for a request to the given url."""
+        if self.auth_cache is None:
+            return self._client.auth()
+        return self.auth_cache.auth(self._client, url)
+
+    def _observe_cache(self, outcome):
+        """Report a cache lookup outcome to the instrumentation, if any."""
+        if self.instrumentation is not None:
+            self.instrumentation.cache(current_operation(), outcome)
+
+    def _json(self, response):
+        """Decode a JSON response, reporting the time spent doing so."""
+        return observe_decode(self.instrumentation, response.json)
+
+    def _decode(self, content):
+        """Decode a JSON response body, reporting the time spent doing so."""
+        return observe_decode(self.instrumentation, _decode, content)
 
     def _meta(self, entity_id, includes, channel=None):
         '''Retrieve metadata about an entity in the charmstore.
 
+        @param entity_id The ID either a reference or a string of the entity
+               to get.
+        @param includes Which metadata fields to include in the response.
+        @param channel Optional channel name, e.g. `stable`.
+        '''
+        url = self._meta_url(entity_id, includes, channel=channel)
+        key = _meta_cache_key(self.url, entity_id, includes, channel)
+        return self._decode(self._get_content(url, key=key))
+
+    def _get_content(self, url, key=None):
+        """Return the body of a get request against the charmstore.
+
+        The cache is used if one was provided.
+        @param url The full url to query.
+        @param key The cache key for the response, defaulting to the url.
+        """
+        if self.cache is None:
+            return self._get(url).content
+        if key is None:
+            key = url
+        content = self.cache.get(key)
+        if content is not None:
+            self._observe_cache(CACHE_HIT)
+            return content
+        self._observe_cache(CACHE_MISS)
+        content = self._get(url).content
+        self.cache.set(key, content)
+        return content
+
+    def _meta_url(self, entity_id, includes, channel=None):
+        '''Generate the meta/any url for an entity.
+
         @param entity_id The ID either a reference or a string of the entity
                to get.
         @param includes Which metadata fields to include in the response.
@@ -124,9 +326,9 @@ class CharmStore(object):
                                              urlencode(queries))
         else:
             url = '{}/{}/meta/any'.format(self.url, _get_path(entity_id))
-        data = self._get(url)
-        return data.json()
+        return url
 
+    @instrumented('charmstore.entity')
     def entity(self, entity_id, get_files=False, channel=None,
                include_stats=True, includes=None):
         '''Get the default data for any entity (e.g. bundle or charm).
@@ -138,27 +340,115 @@ class CharmStore(object):
         @param includes An optional list of meta info to include, as a
             sequence of strings. If None, the default include list is used.
         '''
-        if includes is None:
-            includes = DEFAULT_INCLUDES[:]
-        if get_files and 'manifest' not in includes:
-            includes.append('manifest')
-        if include_stats and 'stats' not in includes:
-            includes.append('stats')
+        includes = _entity_includes(includes, get_files, include_stats)
         return self._meta(entity_id, includes, channel=channel)
 
-    def entities(self, entity_ids):
+    @instrumented('charmstore.entities')
+    def entities(self, entity_ids, max_url_length=DEFAULT_MAX_URL_LENGTH,
+                 workers=DEFAULT_WORKERS):
         '''Get the default data for entities.
 
+        The ids are split into requests whose url is at most max_url_length
+        characters long, which are performed concurrently and whose results
+        are merged. When several requests are required and some of them fail,
+        a BulkFetchError is raised, holding the merged results of the
+        successful requests and the error for each id of the failed ones.
+
         @param entity_ids A list of entity ids either as strings or references.
+        @param max_url_length The maximum length of a request url.
+        @param workers The maximum number of concurrent requests.
+        '''
+        chunks = self._entities_urls(entity_ids, max_url_length)
+        if len(chunks) == 1:
+            url, _ = chunks[0]
+            return self._json(self._get(url))
+        results, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(bind(self._get), url), paths)
+                for url, paths in chunks)
+            for future in as_completed(futures):
+                try:
+                    results.update(self._json(future.result()))
+                except (EntityNotFound, ServerError, ValueError) as err:
+                    for path in futures[future]:
+                        errors[path] = err
+        if errors:
+            raise BulkFetchError(
+                'cannot fetch {} of {} entities'.format(
+                    len(errors), len(entity_ids)),
+                results, errors)
+        return results
+
+    @instrumented('charmstore.map_entities')
+    def map_entities(self, entity_ids, includes=None, workers=DEFAULT_WORKERS,
+                     channel=None):
+        '''Get the data of many entities, one request per entity.
+
+        Unlike entities, the requests go through the cache and request
+        coalescing like those of entity, and an error only affects its own
+        entity. The requests are performed concurrently.
+
+        @param entity_ids The entity ids either as strings or references.
+        @param includes Which metadata fields to include, defaulting to
+            DEFAULT_INCLUDES. The stats are included, as by entity.
+        @param workers The maximum number of concurrent requests; it should
+            not exceed the pool_maxsize of the charmstore.
+        @param channel Optional channel name.
+        @return a list of EntityResult, in the order of entity_ids.
         '''
-        url = '%s/meta/any?include=id&' % self.url
+        includes = _entity_includes(includes, False, True)
+
+        def fetch(entity_id):
+            try:
+                entity = self._meta(entity_id, includes, channel=channel)
+            except (EntityNotFound, ServerError, ValueError) as err:
+                return EntityResult(entity_id, None, err)
+            return EntityResult(entity_id, entity, None)
+
+        entity_ids = list(entity_ids)
+        if len(entity_ids) < 2:
+            return [fetch(entity_id) for entity_id in entity_ids]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(bind(fetch), entity_ids))
+
+    def _entities_urls(self, entity_ids, max_url_length):
+        '''Split the multi-id meta/any url for the given entities.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param max_url_length The maximum length of each url; a url always
+            includes at least one id.
+        @return a list of (url, entity paths) tuples.
+        '''
+        base = '%s/meta/any?include=id' % self.url
+        chunks = []
+        url, paths = base, []
         for entity_id in entity_ids:
-            url += 'id=%s&' % _get_path(entity_id)
-        # Remove the trailing '&' from the URL.
-        url = url[:-1]
-        data = self._get(url)
-        return data.json()
+            path = _get_path(entity_id)
+            param = '&id=%s' % path
+            if paths and len(url) + len(param) > max_url_length:
+                chunks.append((url, paths))
+                url, paths = base, []
+            url += param
+            paths.append(path)
+        chunks.append((url, paths))
+        return chunks
+
+    def _bulk_meta_url(self, entity_ids, includes, channel=None):
+        '''Generate the multi-id meta/any url for the given entities.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param includes Which metadata fields to include in the response.
+        @param channel Optional channel name.
+        '''
+        queries = [('id', _get_path(entity_id)) for entity_id in entity_ids]
+        if includes is not None:
+            queries.extend([('include', include) for include in includes])
+        if channel is not None:
+            queries.append(('channel', channel))
+        return '{}/meta/any?{}'.format(self.url, urlencode(queries))
 
+    @instrumented('charmstore.bundle')
     def bundle(self, bundle_id, channel=None):
         '''Get the default data for a bundle.
 
@@ -167,6 +457,7 @@ class CharmStore(object):
         '''
         return self.entity(bundle_id, get_files=True, channel=channel)
 
+    @instrumented('charmstore.charm')
     def charm(self, charm_id, channel=None):
         '''Get the default data for a charm.
 
@@ -185,6 +476,7 @@ class CharmStore(object):
         url = '{}/{}/icon.svg'.format(self.url, _get_path(charm_id))
         return _add_channel(url, channel)
 
+    @instrumented('charmstore.charm_icon')
     def charm_icon(self, charm_id, channel=None):
         '''Get the charm icon.
 
@@ -192,9 +484,43 @@ class CharmStore(object):
         @param channel Optional channel name.
         '''
         url = self.charm_icon_url(charm_id, channel=channel)
-        response = self._get(url)
-        return response.content
+        return self._get_blob(url, 'icon', charm_id, channel)
 
+    @instrumented('charmstore.charm_icons')
+    def charm_icons(self, charm_ids, channel=None, workers=DEFAULT_WORKERS):
+        '''Get the icons of several charms.
+
+        Icons missing from the caches are fetched concurrently.
+
+        @param charm_ids The IDs of the charms.
+        @param channel Optional channel name.
+        @param workers The maximum number of requests performed
+            concurrently.
+        @return a dict mapping each charm ID, as given, to its icon.
+        @raise BulkFetchError if some icons cannot be fetched; the icons
+            fetched and the errors for the others are attached to it.
+        '''
+        charm_ids = list(OrderedDict.fromkeys(charm_ids))
+        results, errors = {}, {}
+        fetch = bind(self.charm_icon)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(fetch, charm_id, channel), charm_id)
+                for charm_id in charm_ids)
+            for future in as_completed(futures):
+                charm_id = futures[future]
+                try:
+                    results[charm_id] = future.result()
+                except (EntityNotFound, ServerError) as err:
+                    errors[charm_id] = err
+        if errors:
+            raise BulkFetchError(
+                'cannot fetch {} of {} icons'.format(
+                    len(errors), len(charm_ids)),
+                results, errors)
+        return results
+
+    @instrumented('charmstore.bundle_visualization')
     def bundle_visualization(self, bundle_id, channel=None):
         '''Get the bundle visualization.
 
@@ -202,8 +528,29 @@ class CharmStore(object):
         @param channel Optional channel name.
         '''
         url = self.bundle_visualization_url(bundle_id, channel=channel)
-        response = self._get(url)
-        return response.content
+        return self._get_blob(url, 'diagram', bundle_id, channel)
+
+    def _get_blob(self, url, kind, entity_id, channel):
+        '''Return the binary content of a get request against the charmstore.
+
+        The blob cache is used if one was provided, otherwise the cache.
+        @param url The full url to query.
+        @param kind The kind of content (e.g. icon), used in the cache key.
+        @param entity_id The ID of the entity the content belongs to.
+        @param channel Optional channel name.
+        '''
+        if self.blob_cache is None:
+            return self._get_content(url)
+        key = '{}:{}:{}:{}'.format(
+            self.url, kind, _get_path(entity_id), channel or '')
+        content = self.blob_cache.get(key)
+        if content is not None:
+            self._observe_cache(CACHE_HIT)
+            return content
+        self._observe_cache(CACHE_MISS)
+        content = self._get(url).content
+        self.blob_cache.set(key, content)
+        return content
 
     def bundle_visualization_url(self, bundle_id, channel=None):
         '''Generate the path to the visualization for bundles.
@@ -224,6 +571,7 @@ class CharmStore(object):
         url = '{}/{}/readme'.format(self.url, _get_path(entity_id))
         return _add_channel(url, channel)
 
+    @instrumented('charmstore.entity_readme_content')
     def entity_readme_content(self, entity_id, channel=None):
         '''Get the readme for an entity.
 
@@ -244,6 +592,188 @@ class CharmStore(object):
         url = '{}/{}/archive'.format(self.url, _get_path(entity_id))
         return _add_channel(url, channel)
 
+    @instrumented('charmstore.download_archive')
+    def download_archive(self, entity_id, dest, channel=None,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+        '''Download the archive of an entity.
+
+        The archive is streamed in chunks, so it is never held in memory,
+        and its SHA256 hash is checked against the one reported by the
+        charmstore.
+
+        When dest is a path, the archive is first written to dest + ".part",
+        which is renamed to dest once complete and verified. If that partial
+        file already exists, the download resumes from its end by requesting
+        the remaining bytes with an HTTP Range header. The hash and ETag of
+        the archive being downloaded are kept in dest + ".part.info", so
+        that the bytes of another archive (e.g. a new revision of an
+        unrevisioned id) are never appended to the partial file. If resuming
+        fails, the partial file is dropped and the download starts again.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param dest The path of the file to create, or a file-like object
+            open for writing in binary mode.
+        @param channel Optional channel name.
+        @param chunk_size The size of the chunks read from the response.
+        @return the hex encoded SHA256 hash of the archive.
+        @raise ServerError if the download fails or the hash does not match.
+            A partial file is kept to resume the download unless its
+            content is invalid.
+        '''
+        expected = self._json(self._get(self._hash_url(entity_id, channel)))
+        url = self.archive_url(entity_id, channel=channel)
+        return self._download_archive(url, dest, expected['Sum'], chunk_size)
+
+    def _hash_url(self, entity_id, channel=None):
+        '''Generate the url for the SHA256 hash of the archive of an entity.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param channel Optional channel name.
+        '''
+        return _add_channel(
+            '{}/{}/meta/hash256'.format(self.url, _get_path(entity_id)),
+            channel)
+
+    def _download_archive(self, url, dest, expected, chunk_size):
+        '''Download an archive and check its hash; see download_archive.
+
+        @param url The url of the archive.
+        @param dest The path of the file to create, or a file-like object.
+        @param expected The hex encoded SHA256 hash of the archive.
+        @param chunk_size The size of the chunks read from the response.
+        @return the hex encoded SHA256 hash of the archive.
+        '''
+        if hasattr(dest, 'write'):
+            digest = hashlib.sha256()
+            self._stream(url, dest, digest, 0, chunk_size)
+            _check_hash(url, digest, expected)
+            return expected
+        part = dest + '.part'
+        info = _read_part_info(part)
+        if info.get('Sum', expected) != expected:
+            _remove_part(part)
+        digest, offset = _part_digest(part, chunk_size)
+        if digest.hexdigest() != expected and offset:
+            try:
+                digest = self._download_part(
+                    url, part, expected, digest, offset, info.get('ETag'),
+                    chunk_size)
+                _check_hash(url, digest, expected)
+            except ServerError as err:
+                # The partial file cannot be completed, for instance as it
+                # is longer than the archive (416) or corrupt.
+                logging.warning(
+                    'cannot resume download of {}: {}'.format(url, err))
+                _remove_part(part)
+                digest, offset = hashlib.sha256(), 0
+        if digest.hexdigest() != expected:
+            digest = self._download_part(
+                url, part, expected, digest, 0, None, chunk_size)
+        try:
+            _check_hash(url, digest, expected)
+        except ServerError:
+            _remove_part(part)
+            raise
+        os.rename(part, dest)
+        _remove_part_info(part)
+        return expected
+
+    def _download_part(self, url, part, expected, digest, offset, etag,
+                       chunk_size):
+        '''Download the archive at url to a partial file, from offset.
+
+        @param url The url of the archive.
+        @param part The path of the partial file.
+        @param expected The hex encoded SHA256 hash of the archive.
+        @param digest The hash object of the partial file content.
+        @param offset The size of the partial file.
+        @param etag The ETag of the archive the partial file was downloaded
+            from, or None.
+        @param chunk_size The size of the chunks read from the response.
+        @return the hash object of the downloaded archive.
+        '''
+        def started(response):
+            _write_part_info(part, expected, response.headers.get('ETag'))
+
+        with open(part, 'ab') as f:
+            return self._stream(url, f, digest, offset, chunk_size,
+                                validator=etag, started=started)
+
+    @instrumented('charmstore.archive')
+    def archive(self, entity_id, channel=None):
+        '''Get the archive of an entity, to read any of its files locally.
+
+        The archive is downloaded once to an anonymous temporary file, which
+        is memory-mapped, and kept in the archive cache.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param channel Optional channel name.
+        @return an archive.Archive.
+        '''
+        key = (self.url, _get_path(entity_id), channel)
+        archive = self.archive_cache.get(key)
+        if archive is not None:
+            self._observe_cache(CACHE_HIT)
+            return archive
+        self._observe_cache(CACHE_MISS)
+        if self._single_flight is None:
+            return self._fetch_archive(key)
+        return self._single_flight.do(
+            ('archive', key), self._fetch_archive, key)
+
+    def _fetch_archive(self, key):
+        '''Download and cache the archive identified by the given key.'''
+        _, path, channel = key
+        fileobj = tempfile.TemporaryFile()
+        try:
+            self.download_archive(path, fileobj, channel=channel)
+            fileobj.flush()
+            archive = Archive(fileobj)
+        except Exception:
+            fileobj.close()
+            raise
+        self.archive_cache.set(key, archive)
+        return archive
+
+    def _stream(self, url, fileobj, digest, offset, chunk_size,
+                validator=None, started=None):
+        '''Stream the response body for the given url to a file.
+
+        @param url The url to get.
+        @param fileobj The file-like object to write to.
+        @param digest The hash object updated with the data written.
+        @param offset How many bytes of the response body were already
+            written to the file; if the server does not honor the range
+            request, the file is truncated and written from the start.
+        @param chunk_size The size of the chunks read from the response.
+        @param validator The optional ETag sent as If-Range with the range
+            request, so that the whole body is sent if it changed.
+        @param started An optional function called with the response before
+            its body is written.
+        @return the digest, which is a new one if the file was truncated.
+        '''
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if validator is not None:
+                headers['If-Range'] = validator
+        with self._request_errors(url):
+            response = self._request(url, headers, stream=True)
+            try:
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    fileobj.seek(0)
+                    fileobj.truncate()
+                    digest = hashlib.sha256()
+                if started is not None:
+                    started(response)
+                for chunk in response.iter_content(chunk_size):
+                    fileobj.write(chunk)
+                    digest.update(chunk)
+            finally:
+                response.close()
+        return digest
+
     def file_url(self, entity_id, filename, channel=None):
         '''Generate a URL for a file in an archive without requesting it.
 
@@ -255,8 +785,9 @@ class CharmStore(object):
                                         filename)
         return _add_channel(url, channel)
 
+    @instrumented('charmstore.files')
     def files(self, entity_id, manifest=None, filename=None,
-              read_file=False, channel=None):
+              read_file=False, channel=None, from_archive=False):
         '''
         Get the files or file contents of a file for an entity.
 
@@ -277,19 +808,24 @@ class CharmStore(object):
         @param read_file Whether to get the url for the file or the file
             contents.
         @param channel Optional channel name.
+        @param from_archive Whether to download the whole archive once and
+            read the files and their names from it, rather than requesting
+            the manifest and each file separately. This is faster when
+            reading more than a couple of files from the same entity.
         '''
+        if from_archive:
+            archive = self.archive(entity_id, channel=channel)
+            if filename and read_file:
+                if filename not in archive:
+                    raise EntityNotFound(entity_id, filename)
+                return archive.read_text(filename)
+            if manifest is None:
+                manifest = [{'Name': name} for name in archive.names()]
         if manifest is None:
-            manifest_url = '{}/{}/meta/manifest'.format(self.url,
-                                                        _get_path(entity_id))
-            manifest_url = _add_channel(manifest_url, channel)
+            manifest_url = self._manifest_url(entity_id, channel=channel)
             manifest = self._get(manifest_url)
-            manifest = manifest.json()
-        files = {}
-        for f in manifest:
-            manifest_name = f['Name']
-            file_url = self.file_url(_get_path(entity_id), manifest_name,
-                                     channel=channel)
-            files[manifest_name] = file_url
+            manifest = self._json(manifest)
+        files = self._files_from_manifest(entity_id, manifest, channel)
 
         if filename:
             file_url = files.get(filename, None)
@@ -303,6 +839,30 @@ class CharmStore(object):
         else:
             return files
 
+    def _manifest_url(self, entity_id, channel=None):
+        '''Generate the url for the manifest of an entity.
+
+        @param entity_id The id of the entity to get the manifest for.
+        @param channel Optional channel name.
+        '''
+        url = '{}/{}/meta/manifest'.format(self.url, _get_path(entity_id))
+        return _add_channel(url, channel)
+
+    def _files_from_manifest(self, entity_id, manifest, channel=None):
+        '''Map the file names in a manifest to their archive urls.
+
+        @param entity_id The id of the entity the manifest belongs to.
+        @param manifest The manifest of files for the entity.
+        @param channel Optional channel name.
+        '''
+        files = {}
+        for f in manifest:
+            manifest_name = f['Name']
+            file_url = self.file_url(_get_path(entity_id), manifest_name,
+                                     channel=channel)
+            files[manifest_name] = file_url
+        return files
+
     def resource_url(self, entity_id, name, revision):
         '''
         Return the resource url for a given resource on an entity.
@@ -316,30 +876,50 @@ class CharmStore(object):
                                              name,
                                              revision)
 
+    @instrumented('charmstore.config')
     def config(self, charm_id, channel=None):
         '''Get the config data for a charm.
 
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        '''
+        data = self._get(self._config_url(charm_id, channel=channel))
+        return self._json(data)
+
+    def _config_url(self, charm_id, channel=None):
+        '''Generate the url for the config data of a charm.
+
         @param charm_id The charm's id.
         @param channel Optional channel name.
         '''
         url = '{}/{}/meta/charm-config'.format(self.url, _get_path(charm_id))
-        data = self._get(_add_channel(url, channel))
-        return data.json()
+        return _add_channel(url, channel)
 
+    @instrumented('charmstore.entityId')
     def entityId(self, partial, channel=None):
         '''Get an entity's full id provided a partial one.
 
         Raises EntityNotFound if partial cannot be resolved.
+        @param partial The partial id (e.g. mysql, precise/mysql).
+        @param channel Optional channel name.
+        '''
+        data = self._get(self._entity_id_url(partial, channel=channel))
+        return self._json(data)['Id']
+
+    def _entity_id_url(self, partial, channel=None):
+        '''Generate the url used to resolve a partial entity id.
+
         @param partial The partial id (e.g. mysql, precise/mysql).
         @param channel Optional channel name.
         '''
         url = '{}/{}/meta/any'.format(self.url, _get_path(partial))
-        data = self._get(_add_channel(url, channel))
-        return data.json()['Id']
+        return _add_channel(url, channel)
 
+    @instrumented('charmstore.search')
     def search(self, text, includes=None, doc_type=None, limit=None,
                autocomplete=False, promulgated_only=False, tags=None,
-               sort=None, owner=None, series=None):
+               sort=None, owner=None, series=None, stream=False,
+               records=False):
         '''
         Search for entities in the charmstore.
 
@@ -356,7 +936,83 @@ class CharmStore(object):
             include entities that owner can view.
         @param series The series to filter; can be a list of series or a
             single series.
+        @param stream Whether to return an iterator decoding the results one
+            at a time as the response is read, rather than a list. Streamed
+            responses are never cached.
+        @param records Whether to return compact records.Entity objects
+            rather than dicts.
+        '''
+        url = self._search_url(text, includes, doc_type, limit, autocomplete,
+                               promulgated_only, tags, sort, owner, series)
+        if stream:
+            return _results(self._stream_results(url), records, lazy=True)
+        data = self._decode(self._get_content(url))
+        return _results(data['Results'], records)
+
+    @instrumented('charmstore.iter_search')
+    def iter_search(self, text, includes=None, doc_type=None, limit=None,
+                    autocomplete=False, promulgated_only=False, tags=None,
+                    sort=None, owner=None, series=None,
+                    page_size=DEFAULT_PAGE_SIZE, records=False):
+        '''Iterate over the entities matching a search in the charmstore.
+
+        Results are requested a page at a time, as they are consumed, so that
+        large result sets are processed in bounded memory. The parameters are
+        the same as for search, with limit being the maximum number of
+        results yielded overall.
+
+        @param page_size The number of results requested at a time.
+        @param records Whether to yield compact records.Entity objects
+            rather than dicts.
+        '''
+        url = self._search_url(text, includes, doc_type, None, autocomplete,
+                               promulgated_only, tags, sort, owner, series)
+        return _results(
+            self._iter_pages(url, limit, page_size), records, lazy=True)
+
+    def _iter_pages(self, url, limit, page_size):
+        '''Iterate over the results of the given url, a page at a time.
+
+        Pages are requested with the limit and skip query parameters. When
+        the charmstore ignores them and returns more results than requested,
+        those are all the results and no more pages are requested. When it
+        only ignores skip, which is detected as a page starting with the same
+        entity as the previous one, the iteration stops after the first page.
+
+        @param url The url of the search or list request.
+        @param limit The maximum number of results to yield, or None.
+        @param page_size The number of results requested at a time.
         '''
+        skip = 0
+        previous = None
+        while limit is None or skip < limit:
+            size = page_size
+            if limit is not None:
+                size = min(size, limit - skip)
+            results = self._decode(self._get_content(
+                _paged_url(url, size, skip)))['Results']
+            if len(results) > size:
+                # Paging is not supported: this is the whole result set.
+                if limit is not None:
+                    results = results[:limit - skip]
+                for result in results:
+                    yield result
+                return
+            first = results[0].get('Id') if results else None
+            if first is not None and first == previous:
+                # The skip parameter is ignored: the page was already yielded.
+                return
+            previous = first
+            for result in results:
+                yield result
+            if len(results) < size:
+                return
+            skip += size
+
+    def _search_url(self, text, includes=None, doc_type=None, limit=None,
+                    autocomplete=False, promulgated_only=False, tags=None,
+                    sort=None, owner=None, series=None):
+        '''Generate the search url; see search for the parameters.'''
         queries = self._common_query_parameters(doc_type, includes, owner,
                                                 promulgated_only, series, sort)
         if len(text):
@@ -373,11 +1029,12 @@ class CharmStore(object):
             url = '{}/search?{}'.format(self.url, urlencode(queries))
         else:
             url = '{}/search'.format(self.url)
-        data = self._get(url)
-        return data.json()['Results']
+        return url
 
+    @instrumented('charmstore.list')
     def list(self, includes=None, doc_type=None, promulgated_only=False,
-             sort=None, owner=None, series=None):
+             sort=None, owner=None, series=None, stream=False,
+             records=False):
         '''
         List entities in the charmstore.
 
@@ -390,15 +1047,69 @@ class CharmStore(object):
             include entities that owner can view.
         @param series The series to filter; can be a list of series or a
             single series.
+        @param stream Whether to return an iterator decoding the entities one
+            at a time as the response is read, rather than a list. This keeps
+            memory use low when listing the whole charmstore. Streamed
+            responses are never cached.
+        @param records Whether to return compact records.Entity objects
+            rather than dicts, which take a fraction of the memory when
+            keeping the results.
+        '''
+        url = self._list_url(includes, doc_type, promulgated_only, sort,
+                             owner, series)
+        if stream:
+            return _results(self._stream_results(url), records, lazy=True)
+        data = self._decode(self._get_content(url))
+        return _results(data['Results'], records)
+
+    def _stream_results(self, url, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''Iterate over the results of a search or list request.
+
+        The response body is read in chunks and the results are decoded one
+        at a time, so that neither the body nor the results are held in
+        memory at once.
+
+        @param url The url of the search or list request.
+        @param chunk_size The size of the chunks read from the response.
+        '''
+        with self._request_errors(url):
+            response = self._request(url, {}, stream=True)
+            try:
+                response.raise_for_status()
+                chunks = response.iter_content(chunk_size)
+                for result in iter_items(chunks, 'Results'):
+                    yield result
+            finally:
+                response.close()
+
+    @instrumented('charmstore.iter_list')
+    def iter_list(self, includes=None, doc_type=None, promulgated_only=False,
+                  sort=None, owner=None, series=None,
+                  page_size=DEFAULT_PAGE_SIZE, records=False):
+        '''Iterate over the entities in the charmstore.
+
+        Entities are requested a page at a time, as they are consumed; see
+        iter_search. The parameters are the same as for list.
+
+        @param page_size The number of entities requested at a time.
+        @param records Whether to yield compact records.Entity objects
+            rather than dicts.
         '''
+        url = self._list_url(includes, doc_type, promulgated_only, sort,
+                             owner, series)
+        return _results(
+            self._iter_pages(url, None, page_size), records, lazy=True)
+
+    def _list_url(self, includes=None, doc_type=None, promulgated_only=False,
+                  sort=None, owner=None, series=None):
+        '''Generate the list url; see list for the parameters.'''
         queries = self._common_query_parameters(doc_type, includes, owner,
                                                 promulgated_only, series, sort)
         if len(queries):
             url = '{}/list?{}'.format(self.url, urlencode(queries))
         else:
             url = '{}/list'.format(self.url)
-        data = self._get(url)
-        return data.json()['Results']
+        return url
 
     def _common_query_parameters(self, doc_type, includes, owner,
                                  promulgated_only, series, sort):
@@ -434,50 +1145,278 @@ class CharmStore(object):
 
     # XXX j.c.sackett 2016-04-15 this should be updated to just accept a list
     # of id strings, and client code should be updated to pass that.
-    def fetch_related(self, ids):
+    @instrumented('charmstore.fetch_related')
+    def fetch_related(self, ids, records=False):
         """Fetch related entity information.
 
         Fetches metadata, stats and extra-info for the supplied entities.
 
         @param ids The entity ids to fetch related information for. A list of
             entity id dicts from the charmstore.
+        @param records Whether to return a list of compact records.Entity
+            objects rather than the entity dicts.
         """
         if not ids:
             return []
+        data = self._get(self._fetch_related_url(ids))
+        if records:
+            return to_records(self._json(data).values())
+        return self._json(data).values()
+
+    def _fetch_related_url(self, ids):
+        """Generate the url used to fetch related entity information.
+
+        @param ids The entity ids to fetch related information for. A list of
+            entity id dicts from the charmstore.
+        """
         meta = '&id='.join(id['Id'] for id in ids)
-        url = ('{url}/meta/any?id={meta}'
-               '&include=bundle-metadata&include=stats'
-               '&include=supported-series&include=extra-info'
-               '&include=bundle-unit-count&include=owner').format(
-                   url=self.url, meta=meta)
-        data = self._get(url)
-        return data.json().values()
-
-    def fetch_interfaces(self, interface, way):
+        return ('{url}/meta/any?id={meta}'
+                '&include=bundle-metadata&include=stats'
+                '&include=supported-series&include=extra-info'
+                '&include=bundle-unit-count&include=owner').format(
+                    url=self.url, meta=meta)
+
+    @instrumented('charmstore.fetch_interfaces')
+    def fetch_interfaces(self, interface, way, records=False):
         """Get the list of charms that provides or requires this interface.
 
         @param interface The interface for the charm relation.
         @param way The type of relation, either "provides" or "requires".
+        @param records Whether to return a list of compact records.Entity
+            objects for the charms, rather than the search response values.
         @return List of charms
         """
         if not interface:
             return []
+        if self.interface_index is not None:
+            data = {'Results': self.interface_index.charms(interface, way)}
+        else:
+            url = self._fetch_interfaces_url(interface, way)
+            data = self._json(self._get(url))
+        if records:
+            return to_records(data['Results'])
+        return data.values()
+
+    @instrumented('charmstore.fetch_interfaces_batch')
+    def fetch_interfaces_batch(self, interfaces, way, records=False,
+                               workers=DEFAULT_WORKERS):
+        """Get the charms that provide or require each of the interfaces.
+
+        The charms are looked up in the interface index when there is one,
+        and are otherwise fetched with concurrent requests.
+
+        @param interfaces The interface names.
+        @param way The type of relation, either "provides" or "requires".
+        @param records Whether to return compact records.Entity objects
+            rather than dicts.
+        @param workers The maximum number of requests performed
+            concurrently.
+        @return a dict mapping each interface to the list of its charms.
+        """
+        interfaces = set(i for i in interfaces if i)
+        if self.interface_index is not None:
+            return dict(
+                (i, _results(self.interface_index.charms(i, way), records))
+                for i in interfaces)
+
+        @bind
+        def fetch(interface):
+            url = self._fetch_interfaces_url(interface, way)
+            return _results(self._json(self._get(url))['Results'], records)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (i, executor.submit(fetch, i)) for i in interfaces)
+            return dict((i, f.result()) for i, f in futures.items())
+
+    def _fetch_interfaces_url(self, interface, way):
+        """Generate the search url for charms using the given interface.
+
+        @param interface The interface for the charm relation.
+        @param way The type of relation, either "provides" or "requires".
+        """
         if way == 'requires':
             request = '&requires=' + interface
         else:
             request = '&provides=' + interface
-        url = (self.url + '/search?' +
-               'include=charm-metadata&include=stats&include=supported-series'
-               '&include=extra-info&include=bundle-unit-count'
-               '&limit=1000&include=owner' + request)
-        data = self._get(url)
-        return data.json().values()
+        return (self.url + '/search?' +
+                'include=charm-metadata&include=stats&include=supported-series'
+                '&include=extra-info&include=bundle-unit-count'
+                '&limit=1000&include=owner' + request)
 
+    @instrumented('charmstore.debug')
     def debug(self):
         '''Retrieve the debug information from the charmstore.'''
-        url = '{}/debug/status'.format(self.url)
-        data = self._get(url)
-        return data.json()
+        data = self._get(self._debug_url())
+        return self._json(data)
+
+    def _debug_url(self):
+        '''Generate the url for the debug information of the charmstore.'''
+        return '{}/debug/status'.format(self.url)
+
+
+def _entity_includes(includes, get_files, include_stats):
+    '''Return the meta includes to request for an entity.
+
+    @param includes The requested includes, or None for the defaults.
+    @param get_files Whether the manifest must be included.
+    @param include_stats Whether the stats must be included.
+    '''
+    if includes is None:
+        includes = DEFAULT_INCLUDES[:]
+    if get_files and 'manifest' not in includes:
+        includes.append('manifest')
+    if include_stats and 'stats' not in includes:
+        includes.append('stats')
+    return includes
+
+
+def _status_error(url, status_code, text):
+    '''Return the error to raise for a response with an error status.
+
+    Errors other than a missing entity are logged.
+    @param url The requested url.
+    @param status_code The status code of the response.
+    @param text The body of the response.
+    '''
+    if status_code in (404, 407):
+        return EntityNotFound(url)
+    message = ('Error during request: {url} '
+               'status code:({code}) '
+               'message: {message}').format(
+                   url=url, code=status_code, message=text)
+    logging.error(message)
+    return ServerError(status_code, text, message)
+
+
+def _timeout_error(url, timeout):
+    '''Return the error to raise, and log, for a request timing out.'''
+    message = 'Request timed out: {url} timeout: {timeout}'.format(
+        url=url, timeout=timeout)
+    logging.error(message)
+    return ServerError(message)
+
+
+def _connection_error(url, exc, cause):
+    '''Return the error to raise, and log, for a request without response.
+
+    @param url The requested url.
+    @param exc The exception raised by the HTTP client.
+    @param cause The underlying error, whose errno and strerror are
+        reported if it has them.
+    '''
+    message = 'Error during request: {url} message: {message}'.format(
+        url=url, message=exc)
+    logging.error(message)
+    return ServerError(getattr(cause, 'errno', None),
+                       getattr(cause, 'strerror', None) or str(cause),
+                       message)
+
+
+def _request_exception_cause(exc):
+    '''Return the underlying error of a requests exception.
+
+    Connection errors wrap a urllib3 error, whose arguments are a message
+    and the socket error, if any.
+    '''
+    cause = exc.args[0] if exc.args else exc
+    args = getattr(cause, 'args', ())
+    if len(args) > 1 and isinstance(args[1], Exception):
+        return args[1]
+    return cause
+
+
+def _check_hash(url, digest, expected):
+    '''Check that the downloaded data has the expected SHA256 hash.
+
+    @param url The url the data was downloaded from.
+    @param digest The SHA256 hash object of the data.
+    @param expected The hex encoded hash reported by the charmstore.
+    @raise ServerError if the hashes differ.
+    '''
+    got = digest.hexdigest()
+    if got != expected:
+        message = 'Invalid archive hash: {url} expected: {} got: {}'.format(
+            expected, got, url=url)
+        logging.error(message)
+        raise ServerError(message)
+
+
+def _part_digest(part, chunk_size):
+    '''Return the SHA256 hash object and the size of a partial download.
+
+    @param part The path of the partial file, which may not exist.
+    @param chunk_size The size of the chunks read from the file.
+    '''
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+                offset += len(chunk)
+    return digest, offset
+
+
+def _read_part_info(part):
+    '''Return the hash and ETag recorded for a partial download.
+
+    @param part The path of the partial file.
+    @return a dict with the Sum and ETag keys, empty if nothing was
+        recorded, e.g. for files partially downloaded by older versions.
+    '''
+    try:
+        with open(part + '.info') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_part_info(part, expected, etag):
+    '''Record the hash and ETag of the archive downloaded to part.'''
+    with open(part + '.info', 'w') as f:
+        json.dump({'Sum': expected, 'ETag': etag}, f)
+
+
+def _remove_part_info(part):
+    '''Remove the information recorded for a partial download, if any.'''
+    try:
+        os.remove(part + '.info')
+    except OSError:
+        pass
+
+
+def _remove_part(part):
+    '''Remove a partial download and its information, if any.'''
+    try:
+        os.remove(part)
+    except OSError:
+        pass
+    _remove_part_info(part)
+
+
+def _decode(content):
+    '''Decode a JSON response body.
+
+    @param content The response body as bytes.
+    '''
+    return json.loads(content.decode('utf-8'))
+
+
+def _meta_cache_key(url, entity_id, includes, channel):
+    '''Return the cache key for the metadata of an entity.
+
+    The key does not depend on the form of the id or the includes order.
+    Like the other cache keys, it starts with the base url of the
+    charmstore, so that clients of different charmstores can share a cache.
+    @param url The base url of the charmstore.
+    @param entity_id The ID either a reference or a string of the entity.
+    @param includes The metadata fields included in the response.
+    @param channel The channel name, or None.
+    '''
+    return '{}:meta:{}:{}:{}'.format(
+        url, _get_path(entity_id), ','.join(sorted(set(includes or ()))),
+        channel or '')
 
 
 def _get_path(entity_id):
@@ -496,6 +1435,32 @@ def _get_path(entity_id):
     return path
 
 
+def _results(results, records, lazy=False):
+    '''Return the given entity dicts, converted to records if requested.
+
+    @param results An iterable of entity dicts.
+    @param records Whether to convert the dicts to records.Entity objects.
+    @param lazy Whether the results are an iterator to convert lazily.
+    '''
+    if not records:
+        return results
+    if lazy:
+        return iter_records(results)
+    return to_records(results)
+
+
+def _paged_url(url, limit, skip):
+    '''Return the given url requesting a single page of results.
+
+    @param url The url of the search or list request.
+    @param limit The number of results in the page.
+    @param skip The number of results preceding the page.
+    '''
+    separator = '&' if '?' in url else '?'
+    return '{}{}{}'.format(
+        url, separator, urlencode([('limit', limit), ('skip', skip)]))
+
+
 def _add_channel(url, channel=None):
     '''Add channel query parameters when present.
 
@@ -0,0 +1,193 @@
+from collections import namedtuple
+import threading
+import time
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from requests.exceptions import RequestException
+
+from theblues.errors import (
+    CircuitOpenError,
+    log,
+)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_HALF_OPEN_CALLS = 1
+
+CircuitState = namedtuple(
+    'CircuitState', ['name', 'state', 'failures', 'opened_at'])
+
+
+class CircuitBreaker(object):
+    """Fail fast when a backend keeps failing.
+
+    The circuit is closed while requests succeed. After failure_threshold
+    consecutive failures (connection errors, timeouts and 5xx responses)
+    it opens, and requests fail immediately with CircuitOpenError. After
+    reset_timeout seconds it becomes half-open: up to half_open_calls probe
+    requests are let through, and the circuit closes again if they succeed,
+    or opens for another reset_timeout if one fails.
+
+    A breaker is safe to share between threads.
+    """
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 half_open_calls=DEFAULT_HALF_OPEN_CALLS, clock=time.time):
+        """Initializer.
+
+        @param name The name of the protected backend, usually its host.
+        @param failure_threshold The number of consecutive failures opening
+            the circuit.
+        @param reset_timeout How long in seconds the circuit stays open
+            before probe requests are allowed.
+        @param half_open_calls The maximum number of concurrent probes.
+        @param clock A function returning the current time in seconds.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+
+    @property
+    def state(self):
+        """The current state: CLOSED, OPEN or HALF_OPEN."""
+        with self._lock:
+            return self._current_state()
+
+    def stats(self):
+        """Return a CircuitState tuple describing the breaker."""
+        with self._lock:
+            return CircuitState(
+                name=self.name, state=self._current_state(),
+                failures=self._failures, opened_at=self._opened_at)
+
+    def call(self, func):
+        """Call func unless the circuit is open.
+
+        @param func A function sending a request and returning the requests
+            response.
+        @return the response.
+        @raise CircuitOpenError if the circuit is open.
+        @raise any error raised by func.
+        """
+        probe = self._before_call()
+        try:
+            response = func()
+        except RequestException:
+            self._record(False, probe)
+            raise
+        except BaseException:
+            # Errors unrelated to the backend do not change the state.
+            self._release(probe)
+            raise
+        self._record(response.status_code < 500, probe)
+        return response
+
+    def reset(self):
+        """Close the circuit and forget the failures."""
+        with self._lock:
+            self._close()
+
+    def _current_state(self):
+        if (self._state == OPEN and
+                self._clock() - self._opened_at >= self.reset_timeout):
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def _before_call(self):
+        """Check that a request may be sent.
+
+        @return whether the request is a probe of a half-open circuit.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            failures = self._failures
+        raise CircuitOpenError(
+            'Circuit open for {}: request not sent after {} failures'.format(
+                self.name, failures),
+            self.name)
+
+    def _record(self, success, probe):
+        with self._lock:
+            if probe:
+                self._probes -= 1
+            if success:
+                if self._state != CLOSED:
+                    log.info('circuit closed for {}'.format(self.name))
+                self._close()
+                return
+            self._failures += 1
+            if (self._state == HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                if self._state != OPEN:
+                    log.warning('circuit open for {} after {} failures'.format(
+                        self.name, self._failures))
+                self._state = OPEN
+                self._opened_at = self._clock()
+
+    def _release(self, probe):
+        if probe:
+            with self._lock:
+                self._probes -= 1
+
+    def _close(self):
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+
+
+class CircuitBreakerRegistry(object):
+    """The circuit breakers of the backend hosts, created on demand.
+
+    Share a registry between clients (e.g. through a utils.Transport) so
+    that they all fail fast when a host is down.
+    """
+
+    def __init__(self, **kwargs):
+        """Initializer.
+
+        @param kwargs The CircuitBreaker parameters used for new breakers.
+        """
+        self._kwargs = kwargs
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """Return the breaker of the given host, creating it if required."""
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(
+                    host, **self._kwargs)
+            return breaker
+
+    def for_url(self, url):
+        """Return the breaker of the host of the given url."""
+        return self.get(urlparse(url).netloc)
+
+    def states(self):
+        """Return a dict mapping each host to its CircuitState."""
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return dict((b.name, b.stats()) for b in breakers)
@@ -16,6 +16,42 @@ class ServerError(Exception):
     pass
 
 
+class BulkFetchError(ServerError):
+    """Some of the requests made to fetch many entities failed.
+
+    The results attribute holds the data successfully fetched, and the errors
+    attribute maps the ids whose request failed to the error raised.
+    """
+
+    def __init__(self, message, results, errors):
+        super(BulkFetchError, self).__init__(message)
+        self.results = results
+        self.errors = errors
+
+
+class CircuitOpenError(ServerError):
+    """A request was not sent as its host recently failed repeatedly.
+
+    The host attribute holds the host whose circuit breaker is open.
+    """
+
+    def __init__(self, message, host):
+        super(CircuitOpenError, self).__init__(message)
+        self.host = host
+
+
+class RateLimitError(ServerError):
+    """A request was not sent as its host's rate or concurrency limit was
+    reached, and the limiter does not wait (or waited for too long).
+
+    The host attribute holds the host whose limit was reached.
+    """
+
+    def __init__(self, message, host):
+        super(RateLimitError, self).__init__(message)
+        self.host = host
+
+
 def timeout_error(url, timeout):
     """Raise a server error indicating a request timeout to the given URL."""
     msg = 'Request timed out: {} timeout: {}s'.format(url, timeout)
@@ -0,0 +1,732 @@
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import socket
+import threading
+import time
+import zipfile
+try:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from SocketServer import ThreadingMixIn
+    from urlparse import (
+        parse_qs,
+        urlsplit,
+    )
+    from urllib import unquote
+except ImportError:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (
+        parse_qs,
+        unquote,
+        urlsplit,
+    )
+
+from theblues.charmstore import DEFAULT_INCLUDES
+from theblues.errors import EntityNotFound
+from theblues.records import _parse_id
+from theblues.search_index import SearchIndex
+
+
+# The name of the metadata file of each entity in a fixture directory.
+META_FILE = 'meta.json'
+# The name of the directory holding the archive files of an entity.
+ARCHIVE_DIR = 'archive'
+# The name of the bundle diagram file of an entity.
+DIAGRAM_FILE = 'diagram.svg'
+# The routes served, as counted in the server stats.
+ROUTES = (
+    'meta', 'bulk-meta', 'search', 'list', 'archive', 'archive-file',
+    'icon', 'diagram', 'readme', 'debug', 'not-found', 'bad-request')
+# The status of the faults closing the connection without a response.
+RESET = None
+# The url path of the charm store API served by default.
+DEFAULT_ROOT = '/v5'
+# The number of encoded responses kept by default.
+DEFAULT_MAX_RESPONSES = 1000
+# The search parameters filtering charms by interface, mapped to the
+# charm-metadata key listing the relations.
+_INTERFACE_WAYS = (
+    ('provides', 'Provides'),
+    ('requires', 'Requires'),
+)
+# The timestamp of the files in the generated archives, so that archives and
+# their hashes do not depend on when they are built.
+_ARCHIVE_DATE = (2018, 1, 1, 0, 0, 0)
+
+# A fault injected in a fraction of the responses.
+# The rate is the probability for a request to fail. The status is the
+# response status code, or RESET to close the connection without a
+# response. The routes are the names of the routes affected (see ROUTES),
+# or None for all of them.
+Fault = namedtuple('Fault', ['rate', 'status', 'routes'])
+Fault.__new__.__defaults__ = (503, None)
+
+# The requests served by a FakeCharmStore.
+FakeStoreStats = namedtuple(
+    'FakeStoreStats',
+    ['requests', 'faults', 'rejected', 'max_in_flight', 'routes',
+     'statuses'])
+
+
+class Fixtures(object):
+    """The entities served by a FakeCharmStore.
+
+    In a fixture directory, each entity is a directory named after its id,
+    like ~bench/xenial/mysql-58 or xenial/wordpress-3, holding:
+
+        meta.json     the metadata of the entity, mapping each include
+                      name (e.g. charm-metadata) to its value;
+        archive/      the files of the archive, if any, including the
+                      README and icon.svg of charms;
+        diagram.svg   the diagram of bundles, if any.
+
+    Directories in the form produced by record() can be used as is.
+    """
+
+    def __init__(self):
+        self._entities = {}
+        self._index = SearchIndex()
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Load the fixtures in a directory.
+
+        @param directory The fixture directory.
+        """
+        fixtures = cls()
+        for root, dirs, filenames in os.walk(directory):
+            if META_FILE not in filenames:
+                continue
+            dirs[:] = []
+            path = os.path.relpath(root, directory).replace(os.sep, '/')
+            with open(os.path.join(root, META_FILE), 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            files = {}
+            archive = os.path.join(root, ARCHIVE_DIR)
+            for base, _, names in os.walk(archive):
+                for name in names:
+                    full = os.path.join(base, name)
+                    key = os.path.relpath(full, archive).replace(os.sep, '/')
+                    with open(full, 'rb') as f:
+                        files[key] = f.read()
+            diagram = None
+            if os.path.exists(os.path.join(root, DIAGRAM_FILE)):
+                with open(os.path.join(root, DIAGRAM_FILE), 'rb') as f:
+                    diagram = f.read()
+            fixtures.add(path, meta, files, diagram)
+        return fixtures
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, entity_id):
+        return _path(entity_id) in self._entities
+
+    def add(self, entity_id, meta, files=None, diagram=None):
+        """Add an entity, replacing any with the same id.
+
+        @param entity_id The id of the entity, e.g. cs:~bench/xenial/mysql-1.
+        @param meta A dict mapping include names to their value.
+        @param files A dict mapping the archive file names to their content.
+        @param diagram The content of the bundle diagram, if any.
+        """
+        path = _path(entity_id)
+        entity = _Entity('cs:' + path, meta, files or {}, diagram)
+        self._entities[path] = entity
+        self._index.add({'Id': entity.id, 'Meta': meta})
+
+    def get(self, entity_id):
+        """Return the entity with the given id.
+
+        Ids without revision resolve to the latest revision, and ids
+        without series to any series.
+        @raise EntityNotFound if there is no such entity.
+        """
+        path = _path(entity_id)
+        entity = self._entities.get(path)
+        if entity is not None:
+            return entity
+        owner, series, name, revision = _parse_id(path)
+        candidates = [
+            e for e in self._entities.values()
+            if e.name == name and e.owner == owner and
+            (series is None or e.series == series) and
+            (revision is None or e.revision == revision)]
+        if not candidates:
+            raise EntityNotFound(entity_id)
+        return max(candidates, key=lambda e: (e.revision or 0, e.id))
+
+    def search(self, **kwargs):
+        """Search the entities; see SearchIndex.search for the parameters.
+
+        @return the matching entities.
+        """
+        return [self._entities[_path(result['Id'])]
+                for result in self._index.search(**kwargs)]
+
+
+def record(charmstore, entity_ids, directory, includes=None):
+    """Save entities of a charm store as fixtures in a directory.
+
+    The metadata, the archive files and the diagrams of bundles are saved.
+
+    @param charmstore The CharmStore to fetch the entities from.
+    @param entity_ids The ids of the entities to save.
+    @param directory The fixture directory.
+    @param includes The metadata saved, defaulting to DEFAULT_INCLUDES plus
+        stats. The manifest is computed from the archive files.
+    @return the paths of the entities saved.
+    """
+    if includes is None:
+        includes = DEFAULT_INCLUDES + ['stats']
+    paths = []
+    for entity_id in entity_ids:
+        data = charmstore.entity(
+            entity_id, includes=list(includes), include_stats=False)
+        path = _path(data['Id'])
+        root = os.path.join(directory, *path.split('/'))
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        with open(os.path.join(root, META_FILE), 'w') as f:
+            json.dump(data.get('Meta') or {}, f, indent=2, sort_keys=True)
+        archive = charmstore.archive(path)
+        for name in archive.names():
+            if name.endswith('/'):
+                continue
+            target = os.path.join(root, ARCHIVE_DIR, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, 'wb') as f:
+                f.write(archive.read(name))
+        if 'bundle-metadata' in (data.get('Meta') or {}):
+            diagram = charmstore.bundle_visualization(path)
+            with open(os.path.join(root, DIAGRAM_FILE), 'wb') as f:
+                f.write(diagram)
+        paths.append(path)
+    return paths
+
+
+def constant(seconds):
+    """Return a latency distribution always returning the given delay."""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """Return a latency distribution uniform between low and high seconds.
+    """
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    """Return an exponential latency distribution with the given mean."""
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """Return a log-normal latency distribution.
+
+    Most request latencies follow it: most requests are close to the median,
+    with a long tail of slow ones, which grows with sigma.
+    @param median The median latency in seconds.
+    @param sigma The standard deviation of the underlying normal.
+    """
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class FakeCharmStore(object):
+    """An in-process HTTP server answering like the charm store.
+
+    It serves the meta/any (single and multiple ids), meta/manifest,
+    meta/hash256, search, list, archive, icon.svg, diagram.svg and readme
+    routes used by theblues.charmstore.CharmStore, from fixtures. Each
+    connection is served by a thread, and connections are kept alive. The
+    most recent responses are encoded once and cached, so that the server
+    can answer thousands of requests per second; call clear_cache after
+    changing the fixtures.
+
+    Requests outside of the charm store API can be answered by a fallback
+    function, e.g. to serve other APIs from the same server.
+
+    For instance:
+
+        fixtures = Fixtures.from_directory('fixtures')
+        with FakeCharmStore(fixtures, latency=lognormal(0.02, 0.5),
+                            faults=[Fault(0.01, 503)]) as store:
+            charmstore = CharmStore(store.url)
+            ...
+        print(store.stats())
+    """
+
+    def __init__(self, fixtures, latency=0, faults=(), max_concurrency=None,
+                 reject_over_capacity=False, backlog=128, seed=None,
+                 host='127.0.0.1', port=0, root=DEFAULT_ROOT, fallback=None,
+                 max_responses=DEFAULT_MAX_RESPONSES):
+        """Initializer.
+
+        @param fixtures The Fixtures served.
+        @param latency The delay before each response, in seconds, or a
+            distribution like lognormal(0.02, 0.5) returning it.
+        @param faults A sequence of Fault to inject.
+        @param max_concurrency The maximum number of requests processed at
+            once, or None for no limit.
+        @param reject_over_capacity Whether to answer 503 to the requests
+            over max_concurrency, rather than making them wait.
+        @param backlog The number of pending connections the socket accepts.
+        @param seed The seed of the random latencies and faults, to repeat
+            a run.
+        @param host The address to listen on.
+        @param port The port to listen on, or 0 for any free port.
+        @param root The url path of the charm store API.
+        @param fallback A function answering the requests outside of the
+            charm store API, called with the url path and the query
+            parameters as returned by parse_qs, and returning the status
+            code, the content type and the body of the response. The
+            latency applies to its responses, but not the faults. Without
+            it, those requests are answered 404.
+        @param max_responses The maximum number of encoded responses kept.
+        """
+        self.fixtures = fixtures
+        if not callable(latency):
+            latency = constant(latency)
+        self.latency = latency
+        self.faults = tuple(faults)
+        self.max_concurrency = max_concurrency
+        self.reject_over_capacity = reject_over_capacity
+        self.backlog = backlog
+        self.host = host
+        self.port = port
+        self.root = root.rstrip('/')
+        self.fallback = fallback
+        self.max_responses = max_responses
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._slots = None
+        if max_concurrency is not None:
+            self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._archives = {}
+        self._responses = OrderedDict()
+        self._server = None
+        self._thread = None
+        self.reset_stats()
+
+    @property
+    def url(self):
+        """The url of the charm store API, to pass to CharmStore."""
+        if self._server is None:
+            raise RuntimeError('the server is not running')
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, self.root)
+
+    def listen(self):
+        """Bind the socket without serving yet, so that url is known.
+
+        Call start or serve_forever to serve the requests.
+        """
+        server = _Server((self.host, self.port), _Handler, self.backlog)
+        server.store = self
+        self._server = server
+
+    def start(self):
+        """Start serving in a background thread."""
+        if self._server is None:
+            self.listen()
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serve in the current thread, until stop is called from another.
+        """
+        if self._server is None:
+            self.listen()
+        self._server.serve_forever(poll_interval=0.05)
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if self._thread is not None:
+                self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self):
+        """Return the FakeStoreStats of the requests served so far."""
+        with self._lock:
+            return FakeStoreStats(
+                requests=self._requests,
+                faults=self._faults,
+                rejected=self._rejected,
+                max_in_flight=self._max_in_flight,
+                routes=dict(self._routes),
+                statuses=dict(self._statuses))
+
+    def reset_stats(self):
+        """Forget the requests served so far."""
+        with self._lock:
+            self._requests = self._faults = self._rejected = 0
+            self._in_flight = self._max_in_flight = 0
+            self._routes = {}
+            self._statuses = {}
+
+    def handle(self, path, query):
+        """Answer a GET request, without the latency and faults.
+
+        @param path The url path, relative to the API root.
+        @param query The query parameters, as returned by parse_qs.
+        @return the route name, the status code, the content type and the
+            body of the response.
+        """
+        key = (path, tuple(sorted(
+            (name, tuple(values)) for name, values in query.items())))
+        with self._lock:
+            response = self._responses.pop(key, None)
+            if response is not None:
+                self._responses[key] = response
+        if response is not None:
+            return response
+        try:
+            response = self._handle(path, query)
+        except EntityNotFound as err:
+            response = 'not-found', 404, 'application/json', _error(
+                'no matching charm or bundle for {}'.format(err.args[0]),
+                'not found')
+        except ValueError as err:
+            response = 'bad-request', 400, 'application/json', _error(
+                str(err), 'bad request')
+        with self._lock:
+            self._responses.pop(key, None)
+            self._responses[key] = response
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+        return response
+
+    def clear_cache(self):
+        """Forget the encoded responses, after changing the fixtures."""
+        with self._lock:
+            self._responses.clear()
+            self._archives.clear()
+
+    def _handle(self, path, query):
+        if path in ('search', 'list'):
+            return path, 200, 'application/json', self._search(path, query)
+        if path == 'debug/status':
+            return 'debug', 200, 'application/json', _encode({})
+        if path == 'meta/any':
+            results = {}
+            for id in query.get('id', []):
+                try:
+                    entity = self.fixtures.get(id)
+                except EntityNotFound:
+                    continue
+                results[id] = entity.meta_any(query.get('include', []))
+            return 'bulk-meta', 200, 'application/json', _encode(results)
+        for marker, route in _ROUTE_MARKERS:
+            entity_path, sep, rest = path.partition(marker)
+            if sep and entity_path and (rest == '' or marker[-1] == '/'):
+                entity = self.fixtures.get(entity_path)
+                return self._entity_route(route, entity, rest, query)
+        raise EntityNotFound(path)
+
+    def _entity_route(self, route, entity, rest, query):
+        """Answer a request for an entity."""
+        if route == 'meta':
+            if rest == 'any':
+                body = entity.meta_any(query.get('include', []))
+            elif rest == 'manifest':
+                body = entity.manifest()
+            elif rest == 'hash256':
+                body = {'Sum': self._archive(entity)[1]}
+            elif rest in entity.meta:
+                body = entity.meta[rest]
+            else:
+                raise EntityNotFound(entity.id, rest)
+            return route, 200, 'application/json', _encode(body)
+        if route == 'archive':
+            if rest:
+                if rest not in entity.files:
+                    raise EntityNotFound(entity.id, rest)
+                return ('archive-file', 200, 'application/octet-stream',
+                        entity.files[rest])
+            return (route, 200, 'application/zip', self._archive(entity)[0])
+        if route == 'icon':
+            if 'icon.svg' not in entity.files:
+                raise EntityNotFound(entity.id, 'icon.svg')
+            return route, 200, 'image/svg+xml', entity.files['icon.svg']
+        if route == 'diagram':
+            if entity.diagram is None:
+                raise EntityNotFound(entity.id, 'diagram.svg')
+            return route, 200, 'image/svg+xml', entity.diagram
+        readme = entity.readme()
+        if readme is None:
+            raise EntityNotFound(entity.id, 'readme')
+        return route, 200, 'text/plain', readme
+
+    def _search(self, route, query):
+        """Return the body of a search or list response."""
+        def first(name, default=None):
+            return query[name][0] if name in query else default
+
+        limit, skip = first('limit'), int(first('skip', 0))
+        entities = self.fixtures.search(
+            text=first('text', '') if route == 'search' else '',
+            doc_type=first('type'),
+            autocomplete=bool(first('autocomplete')),
+            promulgated_only=bool(first('promulgated')),
+            tags=first('tags'), sort=first('sort'), owner=first('owner'),
+            series=first('series'))
+        for way, key in _INTERFACE_WAYS:
+            if way in query:
+                names = set(query[way])
+                entities = [
+                    entity for entity in entities
+                    if names.intersection(entity.interfaces(key))]
+        end = None if limit is None else skip + int(limit)
+        includes = query.get('include', [])
+        return _encode({'Results': [
+            entity.meta_any(includes) for entity in entities[skip:end]]})
+
+    def _archive(self, entity):
+        """Return the archive of an entity and its SHA256 hash."""
+        with self._lock:
+            archive = self._archives.get(entity.id)
+        if archive is None:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for name in sorted(entity.files):
+                    zf.writestr(zipfile.ZipInfo(name, _ARCHIVE_DATE),
+                                entity.files[name])
+            content = buf.getvalue()
+            archive = (content, hashlib.sha256(content).hexdigest())
+            with self._lock:
+                self._archives[entity.id] = archive
+        return archive
+
+    def _delay(self):
+        """Return the latency of a response."""
+        with self._random_lock:
+            return max(0, self.latency(self._random))
+
+    def _fault(self, route):
+        """Return the fault to inject in a response, or None."""
+        if not self.faults:
+            return None
+        with self._random_lock:
+            draw = self._random.random()
+        for fault in self.faults:
+            if fault.routes is not None and route not in fault.routes:
+                continue
+            if draw < fault.rate:
+                return fault
+            draw -= fault.rate
+        return None
+
+    def _enter(self):
+        """Count a request in flight, waiting for a slot if needed.
+
+        @return whether the request may proceed.
+        """
+        if self._slots is not None:
+            if not self._slots.acquire(not self.reject_over_capacity):
+                with self._lock:
+                    self._requests += 1
+                    self._rejected += 1
+                    self._statuses[503] = self._statuses.get(503, 0) + 1
+                return False
+        with self._lock:
+            self._requests += 1
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+        return True
+
+    def _leave(self, route, status):
+        """Record a response and free the slot of its request."""
+        with self._lock:
+            self._in_flight -= 1
+            self._routes[route] = self._routes.get(route, 0) + 1
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+        if self._slots is not None:
+            self._slots.release()
+
+
+class _Entity(object):
+    """An entity served by the fake charm store."""
+
+    def __init__(self, id, meta, files, diagram):
+        self.id = id
+        self.owner, self.series, self.name, self.revision = _parse_id(id)
+        self.meta = meta
+        self.files = files
+        self.diagram = diagram
+
+    def meta_any(self, includes):
+        """Return the meta/any response with the given includes."""
+        meta = dict(
+            (include, self.meta[include]) for include in includes
+            if include in self.meta)
+        if 'manifest' in includes and 'manifest' not in meta:
+            meta['manifest'] = self.manifest()
+        return {'Id': self.id, 'Meta': meta}
+
+    def interfaces(self, key):
+        """Return the interfaces of the relations of a charm.
+
+        @param key The charm-metadata key listing the relations, Provides
+            or Requires.
+        """
+        metadata = self.meta.get('charm-metadata') or {}
+        relations = metadata.get(key) or {}
+        return set(
+            relation.get('Interface') for relation in relations.values())
+
+    def manifest(self):
+        """Return the manifest of the archive."""
+        return [
+            {'Name': name, 'Size': len(content)}
+            for name, content in sorted(self.files.items())]
+
+    def readme(self):
+        """Return the content of the README file, or None."""
+        for name in sorted(self.files):
+            if '/' not in name and name.lower().startswith('readme'):
+                return self.files[name]
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        store = self.server.store
+        parts = urlsplit(self.path)
+        path, query = unquote(parts.path), parse_qs(parts.query)
+        prefix = store.root + '/'
+        if path.startswith(prefix):
+            self._serve(store, path[len(prefix):], query)
+            return
+        if store.fallback is None:
+            self._respond(404, 'application/json', _error(
+                'not found: ' + path, 'not found'))
+            return
+        status, content_type, body = store.fallback(path, query)
+        delay = store._delay()
+        if delay:
+            time.sleep(delay)
+        self._respond(status, content_type, body)
+
+    def _serve(self, store, path, query):
+        """Answer a request to a FakeCharmStore, with its latency and faults.
+
+        @param path The url path, relative to the API root.
+        @param query The query parameters, as returned by parse_qs.
+        """
+        if not store._enter():
+            self._respond(503, 'application/json', _error(
+                'too many requests in flight', 'service unavailable'))
+            return
+        try:
+            route, status, content_type, body = store.handle(path, query)
+            delay = store._delay()
+            if delay:
+                time.sleep(delay)
+            fault = store._fault(route)
+        except Exception:
+            store._leave('not-found', 500)
+            raise
+        if fault is not None:
+            with store._lock:
+                store._faults += 1
+            status, content_type = fault.status, 'application/json'
+            body = _error('injected fault', 'fault')
+        # The response is recorded before it is sent, so that the stats
+        # include it once the client has received it.
+        store._leave(route, status)
+        if status is RESET:
+            self._reset()
+            return
+        self._respond(status, content_type, body)
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reset(self):
+        """Close the connection abruptly, without a response."""
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, handler, backlog):
+        self.request_queue_size = backlog
+        HTTPServer.__init__(self, address, handler)
+
+
+# The path markers of the entity routes, mapped to the route names.
+_ROUTE_MARKERS = (
+    ('/meta/', 'meta'),
+    ('/archive/', 'archive'),
+    ('/archive', 'archive'),
+    ('/icon.svg', 'icon'),
+    ('/diagram.svg', 'diagram'),
+    ('/readme', 'readme'),
+)
+
+
+def _path(entity_id):
+    """Return the path of an entity id, without the cs: prefix."""
+    try:
+        entity_id = entity_id.path()
+    except AttributeError:
+        pass
+    if entity_id.startswith('cs:'):
+        entity_id = entity_id[3:]
+    return entity_id
+
+
+def _encode(value):
+    """Encode a JSON response body."""
+    return json.dumps(value).encode('utf-8')
+
+
+def _error(message, code):
+    """Return the body of a charm store error response."""
+    return _encode({'Message': message, 'Code': code})
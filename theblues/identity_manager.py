@@ -10,26 +10,34 @@ from theblues.errors import (
     InvalidMacaroon,
     ServerError,
 )
+from theblues.metrics import instrumented
 from theblues.utils import (
     ensure_trailing_slash,
     make_request,
     DEFAULT_TIMEOUT,
+    Transport,
 )
 
 
 class IdentityManager(object):
     """Identity Manager API."""
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, transport=None):
         """Initializer.
 
         @param url The url to the identity manager (IdM) API.
         @param timeout How long to wait before timing out a request in seconds;
             a value of None means no timeout.
+        @param transport The Transport used to send requests; if None, a
+            new one is created.
         """
         self.url = ensure_trailing_slash(url)
         self.timeout = timeout
+        if transport is None:
+            transport = Transport()
+        self._transport = transport
 
+    @instrumented('identity.get_user')
     def get_user(self, username, macaroons):
         """Fetch user data.
 
@@ -39,16 +47,20 @@ class IdentityManager(object):
         @param macaroons the encoded macaroons string.
         """
         url = '{}u/{}'.format(self.url, username)
-        return make_request(url, timeout=self.timeout, macaroons=macaroons)
+        return make_request(url, timeout=self.timeout, macaroons=macaroons,
+                            transport=self._transport)
 
+    @instrumented('identity.debug')
     def debug(self):
         """Retrieve the debug information from the identity manager."""
         url = '{}debug/status'.format(self.url)
         try:
-            return make_request(url, timeout=self.timeout)
+            return make_request(
+                url, timeout=self.timeout, transport=self._transport)
         except ServerError as err:
             return {"error": str(err)}
 
+    @instrumented('identity.login')
     def login(self, username, json_document):
         """Send user identity information to the identity manager.
 
@@ -59,8 +71,10 @@ class IdentityManager(object):
         """
         url = '{}u/{}'.format(self.url, username)
         make_request(
-            url, method='PUT', body=json_document, timeout=self.timeout)
+            url, method='PUT', body=json_document, timeout=self.timeout,
+            transport=self._transport)
 
+    @instrumented('identity.discharge')
     def discharge(self, username, macaroon):
         """Discharge the macarooon for the identity.
 
@@ -81,7 +95,9 @@ class IdentityManager(object):
             self.url, quote(username), caveats[0][1])
         logging.debug('Sending identity info to {}'.format(url))
         logging.debug('data is {}'.format(caveats[0][1]))
-        response = make_request(url, method='POST', timeout=self.timeout)
+        response = make_request(
+            url, method='POST', timeout=self.timeout,
+            transport=self._transport)
         try:
             macaroon = response['Macaroon']
             json_macaroon = json.dumps(macaroon)
@@ -91,6 +107,7 @@ class IdentityManager(object):
 
         return base64.urlsafe_b64encode(json_macaroon.encode('utf-8'))
 
+    @instrumented('identity.discharge_token')
     def discharge_token(self, username):
         """Discharge token for a user.
 
@@ -102,7 +119,9 @@ class IdentityManager(object):
         url = '{}discharge-token-for-user?username={}'.format(
             self.url, quote(username))
         logging.debug('Sending identity info to {}'.format(url))
-        response = make_request(url, method='GET', timeout=self.timeout)
+        response = make_request(
+            url, method='GET', timeout=self.timeout,
+            transport=self._transport)
         try:
             macaroon = response['DischargeToken']
             json_macaroon = json.dumps(macaroon)
@@ -119,6 +138,7 @@ class IdentityManager(object):
         """
         return '{}u/{}/extra-info'.format(self.url, username)
 
+    @instrumented('identity.set_extra_info')
     def set_extra_info(self, username, extra_info):
         """Set extra info for the given user.
 
@@ -129,8 +149,10 @@ class IdentityManager(object):
             dictionary like object.
         """
         url = self._get_extra_info_url(username)
-        make_request(url, method='PUT', body=extra_info, timeout=self.timeout)
+        make_request(url, method='PUT', body=extra_info, timeout=self.timeout,
+                     transport=self._transport)
 
+    @instrumented('identity.get_extra_info')
     def get_extra_info(self, username):
         """Get extra info for the given user.
 
@@ -139,4 +161,5 @@ class IdentityManager(object):
         @param username The username for the user who's info is being accessed.
         """
         url = self._get_extra_info_url(username)
-        return make_request(url, timeout=self.timeout)
+        return make_request(
+            url, timeout=self.timeout, transport=self._transport)
@@ -0,0 +1,167 @@
+import threading
+
+from theblues.batch import EntityBatcher
+from theblues.errors import EntityNotFound
+from theblues.records import Entity
+
+
+# The metadata requested for the indexed charms, which is the same as the
+# metadata returned by CharmStore.fetch_interfaces.
+INTERFACE_INCLUDES = [
+    'bundle-unit-count',
+    'charm-metadata',
+    'extra-info',
+    'owner',
+    'stats',
+    'supported-series',
+]
+
+# The relation ways, mapped to the charm-metadata key listing them.
+_WAYS = {
+    'provides': 'Provides',
+    'requires': 'Requires',
+}
+
+
+class InterfaceIndex(object):
+    """An index of the charms providing or requiring each interface.
+
+    The index is built from charm dicts (or records.Entity objects) holding
+    the charm-metadata, e.g. as returned by CharmStore.list with
+    INTERFACE_INCLUDES. Pass it to CharmStore to answer fetch_interfaces
+    without querying the charmstore.
+
+    For instance:
+
+        index = InterfaceIndex.from_charmstore(charmstore)
+        charmstore.interface_index = index
+        charmstore.fetch_interfaces_batch(['mysql', 'http'], 'requires')
+
+    The index is safe to use from several threads.
+    """
+
+    def __init__(self, entities=()):
+        """Initializer.
+
+        @param entities An iterable of entities to index.
+        """
+        self._lock = threading.Lock()
+        self._entities = {}
+        self._interfaces = dict((way, {}) for way in _WAYS)
+        self.update(entities)
+
+    @classmethod
+    def from_charmstore(cls, charmstore, **kwargs):
+        """Build an index of the charms listed by the charmstore.
+
+        @param charmstore The CharmStore to list charms from.
+        @param kwargs Other parameters to pass to CharmStore.list, e.g.
+            promulgated_only or series.
+        """
+        kwargs.setdefault('includes', INTERFACE_INCLUDES)
+        kwargs.setdefault('doc_type', 'charm')
+        return cls(charmstore.list(stream=True, **kwargs))
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._entities
+
+    def update(self, entities):
+        """Add entities to the index, replacing those with the same id.
+
+        @param entities An iterable of entities to index.
+        """
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        """Add an entity to the index, replacing any with the same id.
+
+        Entities without charm-metadata, like bundles, have no relations
+        and are ignored.
+
+        @param entity An entity dict or a records.Entity.
+        """
+        data = entity.to_dict() if isinstance(entity, Entity) else entity
+        metadata = (data.get('Meta') or {}).get('charm-metadata')
+        if not metadata:
+            return
+        id = data['Id']
+        interfaces = {}
+        for way, key in _WAYS.items():
+            relations = metadata.get(key) or {}
+            interfaces[way] = set(
+                relation['Interface'] for relation in relations.values()
+                if relation.get('Interface'))
+        with self._lock:
+            self._remove(id)
+            self._entities[id] = (entity, interfaces)
+            for way, names in interfaces.items():
+                for name in names:
+                    self._interfaces[way].setdefault(name, {})[id] = entity
+
+    def remove(self, entity_id):
+        """Remove an entity from the index.
+
+        @param entity_id The id of the entity, as returned by the charmstore.
+        @raise KeyError if the entity is not in the index.
+        """
+        with self._lock:
+            if entity_id not in self._entities:
+                raise KeyError(entity_id)
+            self._remove(entity_id)
+
+    def _remove(self, entity_id):
+        """Remove an entity from the index if present, with the lock held."""
+        entry = self._entities.pop(entity_id, None)
+        if entry is None:
+            return
+        for way, names in entry[1].items():
+            for name in names:
+                charms = self._interfaces[way][name]
+                del charms[entity_id]
+                if not charms:
+                    del self._interfaces[way][name]
+
+    def refresh(self, charmstore, entity_ids, max_batch_size=None):
+        """Fetch the given entities again and update the index.
+
+        The entities are fetched with bulk meta/any requests, or from the
+        charmstore cache if it has them. Those which no longer exist are
+        removed from the index.
+
+        @param charmstore The CharmStore to fetch the entities from.
+        @param entity_ids The ids of the entities to refresh.
+        @param max_batch_size The maximum number of ids per request, or None
+            for the EntityBatcher default.
+        """
+        kwargs = {}
+        if max_batch_size is not None:
+            kwargs['max_batch_size'] = max_batch_size
+        with EntityBatcher(charmstore, **kwargs) as batch:
+            futures = [
+                (entity_id, batch.entity(entity_id, include_stats=False,
+                                         includes=INTERFACE_INCLUDES[:]))
+                for entity_id in entity_ids]
+        for entity_id, future in futures:
+            try:
+                self.add(future.result())
+            except EntityNotFound:
+                with self._lock:
+                    self._remove(entity_id)
+
+    def charms(self, interface, way):
+        """Return the charms that provide or require an interface.
+
+        @param interface The interface name.
+        @param way The type of relation, either "provides" or "requires".
+        @return a list of the indexed entities, sorted by id.
+        @raise ValueError if the way is not valid.
+        """
+        if way not in _WAYS:
+            raise ValueError('invalid relation way: {}'.format(way))
+        with self._lock:
+            charms = self._interfaces[way].get(interface, {})
+            return [charms[id] for id in sorted(charms)]
@@ -1,16 +1,18 @@
 from macaroonbakery import httpbakery
 
+from theblues.metrics import instrumented
 from theblues.utils import (
     ensure_trailing_slash,
     make_request,
     DEFAULT_TIMEOUT,
+    Transport,
 )
 
 
 class JIMM(object):
 
     def __init__(self, url, timeout=DEFAULT_TIMEOUT, client=None,
-                 cookies=None):
+                 cookies=None, transport=None):
         """Initializer.
 
         @param url The url to the JIMM API.
@@ -20,14 +22,20 @@ class JIMM(object):
         requests with macaroons.
         @param cookies (which act as dict) holds cookies to be sent with the
         requests.
+        @param transport The Transport used to send requests; if None, a
+            new one is created.
         """
         self.url = ensure_trailing_slash(url)
         self.timeout = timeout
+        if transport is None:
+            transport = Transport()
+        self._transport = transport
         self.cookies = cookies
         if client is None:
             client = httpbakery.Client()
         self._client = client
 
+    @instrumented('jimm.list_models')
     def list_models(self, macaroons):
         """ Get the logged in user's models from the JIMM controller.
 
@@ -35,4 +43,5 @@ class JIMM(object):
         @return The json decoded list of environments.
         """
         return make_request("{}model".format(self.url), timeout=self.timeout,
-                            client=self._client, cookies=self.cookies)
+                            client=self._client, cookies=self.cookies,
+                            transport=self._transport)
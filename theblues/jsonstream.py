@@ -0,0 +1,153 @@
+import codecs
+import json
+import numbers
+
+
+_WHITESPACE = ' \t\n\r'
+# The characters which may continue a number, e.g. "1" in "1.5e3".
+_NUMBER_CHARS = '0123456789+-.eE'
+_decoder = json.JSONDecoder()
+
+
+def iter_items(chunks, key):
+    """Decode incrementally the items of an array in a JSON object.
+
+    Only the items of the array are decoded one at a time: the values of the
+    other members of the object preceding the array are decoded whole and
+    discarded, and the data following the array is not read.
+
+    For instance, iterating over the results of a charmstore list response:
+
+        for entity in iter_items(response.iter_content(65536), 'Results'):
+            print(entity['Id'])
+
+    @param chunks An iterable of bytes holding a UTF-8 encoded JSON object.
+    @param key The name of the object member holding the array.
+    @raise KeyError if the object has no such member.
+    @raise ValueError if the data is not valid JSON or the member is not an
+        array.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise KeyError(key)
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            break
+        reader.value()
+        char = reader.next_char()
+        if char == '}':
+            raise KeyError(key)
+        if char != ',':
+            raise ValueError('expected "," or "}}", got {!r}'.format(char))
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        char = reader.next_char()
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError('expected "," or "]", got {!r}'.format(char))
+
+
+class _Reader(object):
+    """Read JSON tokens and values from a stream of UTF-8 encoded chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size=1):
+        """Read until at least size characters are buffered.
+
+        @return whether any data was read.
+        """
+        if self._eof:
+            return False
+        parts = [self._buffer[self._pos:]]
+        length = len(parts[0])
+        target = length + size
+        while length < target:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                parts.append(self._decoder.decode(b'', True))
+                self._eof = True
+                break
+            text = self._decoder.decode(chunk)
+            parts.append(text)
+            length += len(text)
+        self._buffer = u''.join(parts)
+        self._pos = 0
+        return len(self._buffer) > len(parts[0])
+
+    def _skip_whitespace(self):
+        while True:
+            while (self._pos < len(self._buffer) and
+                   self._buffer[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return
+            if not self._fill():
+                raise ValueError('unexpected end of JSON data')
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        self._skip_whitespace()
+        return self._buffer[self._pos]
+
+    def next_char(self):
+        """Consume and return the next non-whitespace character."""
+        char = self.peek()
+        self._pos += 1
+        return char
+
+    def expect(self, expected):
+        """Consume the next non-whitespace character, checking its value."""
+        char = self.next_char()
+        if char != expected:
+            raise ValueError(
+                'expected {!r}, got {!r}'.format(expected, char))
+
+    def value(self):
+        """Consume and return the next JSON value."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # The value is probably incomplete: read at least as much
+                # again, so that large values are decoded in linear time.
+                if not self._fill(len(self._buffer) - self._pos):
+                    raise
+                continue
+            if (_is_number(value) and self._number_may_continue(end) and
+                    self._fill()):
+                # The number may continue in the next chunk, e.g. "1." was
+                # decoded as 1 and the fraction follows.
+                continue
+            self._pos = end
+            return value
+
+    def _number_may_continue(self, end):
+        """Return whether a number decoded up to end may continue.
+
+        That is the case when only characters which may be part of a number
+        are buffered after it.
+        """
+        for pos in range(end, len(self._buffer)):
+            if self._buffer[pos] not in _NUMBER_CHARS:
+                return False
+        return True
+
+
+def _is_number(value):
+    """Return whether a decoded JSON value is a number."""
+    return (isinstance(value, numbers.Number) and
+            not isinstance(value, bool))
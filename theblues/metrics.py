@@ -0,0 +1,542 @@
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+import functools
+import threading
+from timeit import default_timer
+import types
+
+
+# The operation requests are attributed to outside of any named operation.
+UNKNOWN_OPERATION = 'unknown'
+# The status recorded for requests failing without a response.
+ERROR_STATUS = 'error'
+# The cache outcomes.
+CACHE_HIT = 'hit'
+CACHE_MISS = 'miss'
+CACHE_REVALIDATED = 'revalidated'
+# The upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The upper bounds in seconds of the JSON decode time histogram buckets.
+DECODE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+# The upper bounds in bytes of the response size histogram buckets.
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# The metrics recorded for an operation by a Collector.
+OperationStats = namedtuple(
+    'OperationStats',
+    ['requests', 'errors', 'retries', 'bytes', 'latency', 'decode_time',
+     'statuses', 'cache', 'throttle_wait'])
+
+_local = threading.local()
+# The marker of the end of an iteration.
+_DONE = object()
+
+
+class Instrumentation(object):
+    """The hooks called by the clients to report their activity.
+
+    This implementation ignores everything: subclass it and override the
+    hooks of interest to send the measurements elsewhere, or use a
+    Collector. Hooks are called from any thread the requests are sent from.
+    """
+
+    def start_operation(self, operation):
+        """Called when an operation starts.
+
+        @param operation The name of the operation (e.g. charmstore.entity).
+        @return None, or a scope object whose activate() method returns a
+            context manager, entered in each thread while it runs the
+            operation, and whose finish(error) method is called once the
+            operation ends, with the exception raised if any.
+        """
+
+    def request(self, operation, method, url, status, latency, size,
+                retries=0):
+        """Called when a request completes.
+
+        @param operation The name of the operation (e.g. charmstore.entity).
+        @param method The HTTP method.
+        @param url The requested url.
+        @param status The response status code, or ERROR_STATUS if no
+            response was received.
+        @param latency The time in seconds until the response was received,
+            including any retry.
+        @param size The size of the response body in bytes. For streamed
+            responses, this is the announced Content-Length, or 0.
+        @param retries The number of times the request was sent again.
+        """
+
+    def decode(self, operation, duration):
+        """Called when a JSON response body has been decoded.
+
+        @param operation The name of the operation.
+        @param duration The time spent decoding, in seconds.
+        """
+
+    def cache(self, operation, outcome):
+        """Called when a cache is looked up.
+
+        @param operation The name of the operation.
+        @param outcome CACHE_HIT, CACHE_MISS, or CACHE_REVALIDATED when a
+            cached response was confirmed by the server.
+        """
+
+    def throttle(self, operation, host, wait):
+        """Called when a rate limiter lets a request through.
+
+        @param operation The name of the operation.
+        @param host The host whose ratelimit.RateLimiter was acquired.
+        @param wait The time spent waiting for the limiter, in seconds.
+        """
+
+
+class Histogram(object):
+    """A histogram with cumulative buckets, as exposed by Prometheus."""
+
+    def __init__(self, buckets):
+        """Initializer.
+
+        @param buckets The sorted upper bounds of the buckets.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Record a value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return (upper bound, count) pairs, ending with infinity."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q):
+        """Return an estimate of the q quantile (0 <= q <= 1).
+
+        The upper bound of the bucket holding the quantile is returned, or
+        None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class Collector(Instrumentation):
+    """Collect request metrics in memory, per operation.
+
+    For instance:
+
+        collector = Collector()
+        charmstore = CharmStore(instrumentation=collector)
+        plans = Plans(url, transport=Transport(instrumentation=collector))
+        ...
+        print(collector.expose())
+
+    The collector is safe to share between clients and threads.
+    """
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS,
+                 decode_buckets=DECODE_BUCKETS, size_buckets=SIZE_BUCKETS,
+                 prefix='theblues'):
+        """Initializer.
+
+        @param latency_buckets The latency histogram buckets, in seconds.
+        @param decode_buckets The decode time histogram buckets, in seconds.
+        @param size_buckets The response size histogram buckets, in bytes.
+        @param prefix The prefix of the exposed metric names.
+        """
+        self.latency_buckets = latency_buckets
+        self.decode_buckets = decode_buckets
+        self.size_buckets = size_buckets
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def _operation(self, name):
+        """Return the metrics of an operation, with the lock held."""
+        metrics = self._operations.get(name)
+        if metrics is None:
+            metrics = self._operations[name] = _Operation(
+                Histogram(self.latency_buckets),
+                Histogram(self.decode_buckets),
+                Histogram(self.size_buckets),
+                Histogram(self.latency_buckets))
+        return metrics
+
+    def request(self, operation, method, url, status, latency, size,
+                retries=0):
+        with self._lock:
+            metrics = self._operation(operation)
+            metrics.retries += retries
+            metrics.latency.observe(latency)
+            metrics.size.observe(size)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def decode(self, operation, duration):
+        with self._lock:
+            self._operation(operation).decode.observe(duration)
+
+    def cache(self, operation, outcome):
+        with self._lock:
+            cache = self._operation(operation).cache
+            cache[outcome] = cache.get(outcome, 0) + 1
+
+    def throttle(self, operation, host, wait):
+        with self._lock:
+            self._operation(operation).throttle.observe(wait)
+
+    def operations(self):
+        """Return a dict mapping each operation name to its OperationStats.
+
+        Errors count the requests without a response or with a status of
+        400 or more. The throttle wait is the total time spent waiting for
+        rate limiters.
+        """
+        with self._lock:
+            return dict(
+                (name, metrics.stats())
+                for name, metrics in self._operations.items())
+
+    def histograms(self, operation):
+        """Return the latency, decode time and size histograms of an
+        operation, or None if nothing was recorded for it.
+        """
+        with self._lock:
+            metrics = self._operations.get(operation)
+            if metrics is None:
+                return None
+            return metrics.latency, metrics.decode, metrics.size
+
+    def reset(self):
+        """Forget all the recorded metrics."""
+        with self._lock:
+            self._operations.clear()
+
+    def expose(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            operations = sorted(self._operations.items())
+            self._expose_histograms(
+                lines, operations, 'request_duration_seconds', 'latency',
+                'The duration of the requests until a response is received.')
+            self._expose_histograms(
+                lines, operations, 'response_size_bytes', 'size',
+                'The size of the response bodies.')
+            self._expose_histograms(
+                lines, operations, 'json_decode_seconds', 'decode',
+                'The time spent decoding JSON response bodies.')
+            self._expose_histograms(
+                lines, operations, 'rate_limit_wait_seconds', 'throttle',
+                'The time spent waiting for the rate limiters.')
+            name = self.prefix + '_responses_total'
+            lines.append('# HELP {} The responses by status code.'.format(
+                name))
+            lines.append('# TYPE {} counter'.format(name))
+            for operation, metrics in operations:
+                for status, count in sorted(
+                        metrics.statuses.items(), key=lambda i: str(i[0])):
+                    lines.append('{}{{operation="{}",status="{}"}} {}'.format(
+                        name, _escape(operation), status, count))
+            name = self.prefix + '_retries_total'
+            lines.append('# HELP {} The requests sent again.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for operation, metrics in operations:
+                if metrics.retries:
+                    lines.append('{}{{operation="{}"}} {}'.format(
+                        name, _escape(operation), metrics.retries))
+            name = self.prefix + '_cache_lookups_total'
+            lines.append('# HELP {} The cache lookups by outcome.'.format(
+                name))
+            lines.append('# TYPE {} counter'.format(name))
+            for operation, metrics in operations:
+                for outcome, count in sorted(metrics.cache.items()):
+                    lines.append(
+                        '{}{{operation="{}",outcome="{}"}} {}'.format(
+                            name, _escape(operation), outcome, count))
+        return '\n'.join(lines) + '\n'
+
+    def _expose_histograms(self, lines, operations, suffix, attr, help):
+        """Append the lines exposing a histogram of each operation."""
+        name = '{}_{}'.format(self.prefix, suffix)
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for operation, metrics in operations:
+            histogram = getattr(metrics, attr)
+            if not histogram.count:
+                continue
+            label = _escape(operation)
+            for bound, total in histogram.cumulative():
+                lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(
+                    name, label, _format_bound(bound), total))
+            lines.append('{}_sum{{operation="{}"}} {}'.format(
+                name, label, _format_number(histogram.sum)))
+            lines.append('{}_count{{operation="{}"}} {}'.format(
+                name, label, histogram.count))
+
+
+class _Operation(object):
+    """The metrics collected for an operation."""
+
+    def __init__(self, latency, decode, size, throttle):
+        self.latency = latency
+        self.decode = decode
+        self.size = size
+        self.throttle = throttle
+        self.statuses = {}
+        self.cache = {}
+        self.retries = 0
+
+    def stats(self):
+        errors = sum(
+            count for status, count in self.statuses.items()
+            if status == ERROR_STATUS or status >= 400)
+        return OperationStats(
+            requests=self.latency.count,
+            errors=errors,
+            retries=self.retries,
+            bytes=self.size.sum,
+            latency=self.latency.sum,
+            decode_time=self.decode.sum,
+            statuses=dict(self.statuses),
+            cache=dict(self.cache),
+            throttle_wait=self.throttle.sum)
+
+
+@contextmanager
+def operation(name, instrumentation=None):
+    """Attribute the requests sent in the block to the named operation.
+
+    Operations do not nest: within an operation, the requests of the
+    methods it calls are attributed to it.
+
+    @param name The operation name, e.g. charmstore.entity.
+    @param instrumentation The optional Instrumentation notified of the
+        start and end of the operation.
+    """
+    if getattr(_local, 'operation', None) is not None:
+        yield
+        return
+    scope = _start(name, instrumentation)
+    try:
+        with _running(name, scope):
+            yield
+    except BaseException as err:
+        _finish(scope, err)
+        raise
+    _finish(scope, None)
+
+
+def current_operation(default=UNKNOWN_OPERATION):
+    """Return the name of the operation in progress in this thread."""
+    return getattr(_local, 'operation', None) or default
+
+
+def instrumented(name):
+    """Decorate a client method to run as the named operation.
+
+    The instrumentation notified of the operation is the instrumentation
+    attribute of the client, or the one of its transport. When the method
+    returns a generator, the generator runs as the operation as it is
+    consumed, and the operation ends once the generator is exhausted,
+    closed or garbage collected: callers that stop iterating early should
+    close it. The span of a tracing.Tracer ends with the last item read.
+
+    @param name The operation name, e.g. plans.list_wallets.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if getattr(_local, 'operation', None) is not None:
+                return func(self, *args, **kwargs)
+            scope = _start(name, _instrumentation_of(self))
+            try:
+                with _running(name, scope):
+                    result = func(self, *args, **kwargs)
+            except BaseException as err:
+                _finish(scope, err)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _iter_in_operation(name, result, scope)
+            _finish(scope, None)
+            return result
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    """Return func running as the current operation, in any thread.
+
+    Use it for functions submitted to an executor.
+    """
+    name = current_operation(None)
+    if name is None:
+        return func
+    scope = _local.scope
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'operation', None) is not None:
+            return func(*args, **kwargs)
+        with _running(name, scope):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count_retry():
+    """Count a retry of the request being observed in this thread.
+
+    This is called by retry.RetryPolicy before sending a request again.
+    """
+    if getattr(_local, 'retries', None) is not None:
+        _local.retries += 1
+
+
+def observe_request(instrumentation, method, url, send, stream=False):
+    """Send a request, reporting it to the instrumentation.
+
+    @param instrumentation The Instrumentation to report to.
+    @param method The HTTP method.
+    @param url The requested url.
+    @param send A function sending the request and returning the requests
+        response.
+    @param stream Whether the response body is streamed, in which case its
+        size is the announced Content-Length.
+    @return the response.
+    """
+    name = current_operation()
+    outer_retries = getattr(_local, 'retries', None)
+    _local.retries = 0
+    start = default_timer()
+    try:
+        response = send()
+    except Exception:
+        instrumentation.request(
+            name, method, url, ERROR_STATUS, default_timer() - start, 0,
+            _local.retries)
+        raise
+    finally:
+        retries, _local.retries = _local.retries, outer_retries
+    latency = default_timer() - start
+    if stream:
+        try:
+            size = int(response.headers.get('Content-Length', 0))
+        except ValueError:
+            size = 0
+    else:
+        size = len(response.content or b'')
+    instrumentation.request(
+        name, method, url, response.status_code, latency, size, retries)
+    return response
+
+
+def observe_decode(instrumentation, decode, *args):
+    """Call decode(*args), reporting its duration to the instrumentation.
+
+    @param instrumentation The Instrumentation to report to, or None.
+    @param decode The function decoding JSON.
+    @return the decoded value.
+    """
+    if instrumentation is None:
+        return decode(*args)
+    start = default_timer()
+    value = decode(*args)
+    instrumentation.decode(current_operation(), default_timer() - start)
+    return value
+
+
+def _start(name, instrumentation):
+    """Notify the instrumentation, if any, that an operation starts.
+
+    @return the operation scope, or None.
+    """
+    if instrumentation is None:
+        return None
+    return instrumentation.start_operation(name)
+
+
+def _finish(scope, error):
+    """End an operation scope, if any."""
+    if scope is not None:
+        scope.finish(error)
+
+
+@contextmanager
+def _running(name, scope):
+    """Run the block as the named operation, with its scope active."""
+    _local.operation, _local.scope = name, scope
+    try:
+        if scope is None:
+            yield
+        else:
+            with scope.activate():
+                yield
+    finally:
+        _local.operation = _local.scope = None
+
+
+def _iter_in_operation(name, iterator, scope):
+    """Iterate over iterator, running each step as the named operation.
+
+    The scope of the operation ends with the iteration.
+    """
+    error = None
+    try:
+        while True:
+            if getattr(_local, 'operation', None) is not None:
+                # Consumed within another operation, to which the requests
+                # are attributed.
+                item = next(iterator, _DONE)
+            else:
+                with _running(name, scope):
+                    item = next(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    except GeneratorExit:
+        raise
+    except BaseException as err:
+        error = err
+        raise
+    finally:
+        _finish(scope, error)
+
+
+def _instrumentation_of(client):
+    """Return the instrumentation of a client or its transport, or None."""
+    instrumentation = getattr(client, 'instrumentation', None)
+    if instrumentation is None:
+        transport = getattr(client, '_transport', None)
+        instrumentation = getattr(transport, 'instrumentation', None)
+    return instrumentation
+
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_bound(bound):
+    """Format a bucket upper bound."""
+    if bound == float('inf'):
+        return '+Inf'
+    return _format_number(bound)
+
+
+def _format_number(value):
+    """Format a sample value."""
+    return repr(float(value))
@@ -7,10 +7,12 @@ from theblues.errors import (
     log,
     ServerError,
 )
+from theblues.metrics import instrumented
 from theblues.utils import (
     ensure_trailing_slash,
     make_request,
     DEFAULT_TIMEOUT,
+    Transport,
 )
 
 Plan = namedtuple(
@@ -28,7 +30,8 @@ PLAN_VERSION = 'v3'
 
 class Plans(object):
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT, client=None):
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, client=None,
+                 transport=None):
         """Initializer.
 
         @param url The url to the Plan API.
@@ -36,13 +39,19 @@ class Plans(object):
             a value of None means no timeout.
         @param client (httpbakery.Client) holds a context for making http
         requests with macaroons.
+        @param transport The Transport used to send requests; if None, a
+            new one is created.
         """
         self.url = ensure_trailing_slash(url) + PLAN_VERSION + '/'
         self.timeout = timeout
+        if transport is None:
+            transport = Transport()
+        self._transport = transport
         if client is None:
             client = httpbakery.Client()
         self._client = client
 
+    @instrumented('plans.get_plans')
     def get_plans(self, reference):
         """Get the plans for a given charm.
 
@@ -53,7 +62,8 @@ class Plans(object):
         response = make_request(
             '{}charm?charm-url={}'.format(self.url,
                                           'cs:' + reference.path()),
-            timeout=self.timeout, client=self._client)
+            timeout=self.timeout, client=self._client,
+            transport=self._transport)
         try:
             return tuple(map(lambda plan: Plan(
                 url=plan['url'], plan=plan['plan'],
@@ -71,6 +81,7 @@ class Plans(object):
                 'unable to get list of plans for {}: {}'.format(
                     reference.path(), err))
 
+    @instrumented('plans.list_wallets')
     def list_wallets(self):
         """Get the list of wallets.
 
@@ -81,7 +92,8 @@ class Plans(object):
         response = make_request(
             '{}wallet'.format(self.url),
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
         try:
             total = response['total']
             return {
@@ -111,6 +123,7 @@ class Plans(object):
             raise ServerError(
                 'unable to get list of wallets: {!r}'.format(err))
 
+    @instrumented('plans.get_wallet')
     def get_wallet(self, wallet_name):
         """Get a single wallet.
 
@@ -121,7 +134,8 @@ class Plans(object):
         response = make_request(
             '{}wallet/{}'.format(self.url, wallet_name),
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
         try:
             total = response['total']
             return {
@@ -141,6 +155,7 @@ class Plans(object):
             raise ServerError(
                 'unable to get list of wallets: {!r}'.format(exc))
 
+    @instrumented('plans.update_wallet')
     def update_wallet(self, wallet_name, limit):
         """Update a wallet with a new limit.
 
@@ -159,8 +174,10 @@ class Plans(object):
             method='PATCH',
             body=request,
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
 
+    @instrumented('plans.create_wallet')
     def create_wallet(self, wallet_name, limit):
         """Create a new wallet.
 
@@ -178,8 +195,10 @@ class Plans(object):
             method='POST',
             body=request,
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
 
+    @instrumented('plans.delete_wallet')
     def delete_wallet(self, wallet_name):
         """Delete a wallet.
 
@@ -191,8 +210,10 @@ class Plans(object):
             '{}wallet/{}'.format(self.url, wallet_name),
             method='DELETE',
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
 
+    @instrumented('plans.create_budget')
     def create_budget(self, wallet_name, model_uuid, limit):
         """Create a new budget for a model and wallet.
 
@@ -211,8 +232,10 @@ class Plans(object):
             method='POST',
             body=request,
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
 
+    @instrumented('plans.update_budget')
     def update_budget(self, wallet_name, model_uuid, limit):
         """Update a budget limit.
 
@@ -233,8 +256,10 @@ class Plans(object):
             method='PATCH',
             body=request,
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
 
+    @instrumented('plans.delete_budget')
     def delete_budget(self, model_uuid):
         """Delete a budget.
 
@@ -247,4 +272,5 @@ class Plans(object):
             '{}model/{}/budget'.format(self.url, model_uuid),
             method='DELETE',
             timeout=self.timeout,
-            client=self._client)
+            client=self._client,
+            transport=self._transport)
@@ -0,0 +1,294 @@
+from collections import namedtuple
+import threading
+import time
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from theblues.errors import RateLimitError
+from theblues.metrics import current_operation
+
+
+RateLimitStats = namedtuple(
+    'RateLimitStats',
+    ['name', 'acquired', 'rejected', 'waited', 'wait_time', 'max_wait',
+     'in_flight'])
+
+
+class TokenBucket(object):
+    """Limit the rate of events, allowing short bursts.
+
+    The bucket holds up to burst tokens, and is refilled with rate tokens
+    per second. Each event takes a token. Tokens are reserved in the order
+    they are asked for, so that waiting callers are served first come,
+    first served, without polling.
+
+    A bucket is safe to share between threads.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        """Initializer.
+
+        @param rate The number of tokens added per second.
+        @param burst The maximum number of tokens held, defaulting to the
+            rate (or 1 for rates below one per second).
+        @param clock A function returning the current time in seconds.
+        """
+        if rate <= 0:
+            raise ValueError('invalid rate: {}'.format(rate))
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1, rate)
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    @property
+    def tokens(self):
+        """The number of tokens available, negative if some are owed."""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def reserve(self, tokens=1, max_wait=None):
+        """Take tokens, possibly ahead of time.
+
+        @param tokens The number of tokens taken.
+        @param max_wait The maximum time in seconds the caller accepts to
+            wait for the tokens, or None to wait as long as needed.
+        @return how long in seconds the caller must wait before the event,
+            or None if that exceeds max_wait, in which case no token is
+            taken.
+        """
+        with self._lock:
+            self._refill()
+            wait = max(0, (tokens - self._tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= tokens
+            return wait
+
+    def refund(self, tokens=1):
+        """Give back tokens reserved for an event which did not happen."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+
+class RateLimiter(object):
+    """Bound the request rate and the requests in flight to a backend.
+
+    A request first takes a token from the bucket, when a rate is given,
+    then one of max_in_flight slots, when given, which is released once the
+    response (or error) is received. For streamed responses, the slot is
+    released once the headers are received.
+
+    Blocking limiters make requests wait for a token and a slot, for at
+    most max_wait seconds if given. Non-blocking limiters fail immediately.
+    In both cases, requests which cannot be sent raise RateLimitError, and
+    give their token back if no slot was free.
+
+    A limiter is safe to share between threads.
+    """
+
+    def __init__(self, name, rate=None, burst=None, max_in_flight=None,
+                 blocking=True, max_wait=None, clock=time.time,
+                 sleep=time.sleep):
+        """Initializer.
+
+        @param name The name of the limited backend, usually its host.
+        @param rate The maximum number of requests per second, or None.
+        @param burst The number of requests which may be sent at once after
+            a pause; see TokenBucket.
+        @param max_in_flight The maximum number of concurrent requests, or
+            None.
+        @param blocking Whether call waits for the limits, or fails
+            immediately.
+        @param max_wait The maximum time in seconds call waits, or None.
+        @param clock A function returning the current time in seconds.
+        @param sleep A function sleeping for the given number of seconds.
+        """
+        self.name = name
+        self.blocking = blocking
+        self.max_wait = max_wait
+        self._bucket = None
+        if rate is not None:
+            self._bucket = TokenBucket(rate, burst, clock=clock)
+        self.max_in_flight = max_in_flight
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._slot_released = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._acquired = self._rejected = self._waited = 0
+        self._wait_time = self._max_wait = 0
+
+    def acquire(self, blocking=True, timeout=None):
+        """Wait for a token and a slot, like threading.Lock.acquire.
+
+        The slot must be released by calling release.
+        @param blocking Whether to wait, or return immediately.
+        @param timeout The maximum time in seconds to wait when blocking,
+            or None.
+        @return whether the token and slot were acquired.
+        """
+        max_wait = timeout if blocking else 0
+        return self._acquire(max_wait) is not None
+
+    def release(self):
+        """Release a slot taken by acquire."""
+        if self.max_in_flight is None:
+            return
+        with self._lock:
+            self._in_flight -= 1
+            self._slot_released.notify()
+
+    def call(self, func, instrumentation=None):
+        """Call func once the limits allow it.
+
+        @param func A function sending a request and returning the requests
+            response.
+        @param instrumentation An optional metrics.Instrumentation to which
+            the time spent waiting is reported.
+        @return the response.
+        @raise RateLimitError if the limits do not allow the request.
+        @raise any error raised by func.
+        """
+        max_wait = self.max_wait if self.blocking else 0
+        wait = self._acquire(max_wait)
+        if wait is None:
+            raise RateLimitError(
+                'Rate limit reached for {}: request not sent'.format(
+                    self.name),
+                self.name)
+        if instrumentation is not None:
+            instrumentation.throttle(current_operation(), self.name, wait)
+        try:
+            return func()
+        finally:
+            self.release()
+
+    def stats(self):
+        """Return a RateLimitStats tuple describing the limiter."""
+        with self._lock:
+            return RateLimitStats(
+                name=self.name, acquired=self._acquired,
+                rejected=self._rejected, waited=self._waited,
+                wait_time=self._wait_time, max_wait=self._max_wait,
+                in_flight=self._in_flight)
+
+    def _acquire(self, max_wait):
+        """Take a token and a slot, waiting at most max_wait seconds.
+
+        @return the time spent waiting, or None if no token or slot was
+            available in time.
+        """
+        start = self._clock()
+        blocked = False
+        if self._bucket is not None:
+            delay = self._bucket.reserve(max_wait=max_wait)
+            if delay is None:
+                return self._reject()
+            if delay:
+                blocked = True
+                self._sleep(delay)
+        with self._lock:
+            if (self.max_in_flight is not None and
+                    self._in_flight >= self.max_in_flight):
+                blocked = True
+                remaining = None
+                if max_wait is not None:
+                    remaining = max_wait - (self._clock() - start)
+                if not self._wait_for_slot(remaining):
+                    self._rejected += 1
+                    if self._bucket is not None:
+                        self._bucket.refund()
+                    return None
+            if self.max_in_flight is not None:
+                self._in_flight += 1
+            # Only the waits are measured, not the time spent taking locks.
+            wait = max(0, self._clock() - start) if blocked else 0
+            self._acquired += 1
+            if wait:
+                self._waited += 1
+                self._wait_time += wait
+                self._max_wait = max(self._max_wait, wait)
+        return wait
+
+    def _wait_for_slot(self, timeout):
+        """Wait until a slot is free, with the lock held.
+
+        @param timeout The maximum time in seconds to wait, or None.
+        @return whether a slot is free.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._in_flight >= self.max_in_flight:
+            if deadline is None:
+                self._slot_released.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._slot_released.wait(remaining)
+        return True
+
+    def _reject(self):
+        with self._lock:
+            self._rejected += 1
+        return None
+
+
+class RateLimiterRegistry(object):
+    """The rate limiters of the backend hosts, created on demand.
+
+    Share a registry between clients so that they share the limits of each
+    host, for instance:
+
+        limits = RateLimiterRegistry(rate=20, max_in_flight=8)
+        charmstore = CharmStore(rate_limits=limits)
+        transport = Transport(rate_limits=limits)
+        plans = Plans(plans_url, transport=transport)
+        terms = Terms(terms_url, transport=transport)
+    """
+
+    def __init__(self, hosts=None, **kwargs):
+        """Initializer.
+
+        @param hosts An optional dict mapping hosts to a dict of RateLimiter
+            parameters overriding the default ones for that host.
+        @param kwargs The default RateLimiter parameters.
+        """
+        self._hosts = hosts or {}
+        self._kwargs = kwargs
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """Return the limiter of the given host, creating it if required."""
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                kwargs = dict(self._kwargs)
+                kwargs.update(self._hosts.get(host, {}))
+                limiter = self._limiters[host] = RateLimiter(host, **kwargs)
+            return limiter
+
+    def for_url(self, url):
+        """Return the limiter of the host of the given url."""
+        return self.get(urlparse(url).netloc)
+
+    def stats(self):
+        """Return a dict mapping each host to its RateLimitStats."""
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return dict(
+            (limiter.name, limiter.stats()) for limiter in limiters)
@@ -0,0 +1,110 @@
+import json
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 cannot intern the unicode strings decoded from JSON.
+    def intern(value):
+        return value
+
+
+class Entity(object):
+    """A compact, read-only record of an entity returned by the charmstore.
+
+    The owner, series and name parsed from the id are interned, so that
+    records share the strings repeated across results. The Meta section is
+    kept as compact JSON text, and only decoded when accessed.
+    """
+
+    __slots__ = ('id', 'owner', 'series', 'name', 'revision', '_meta')
+
+    def __init__(self, id, meta=None):
+        """Initializer.
+
+        @param id The entity id (e.g. cs:~hatch/xenial/mysql-1).
+        @param meta The entity metadata as a dict, or None.
+        """
+        self.id = intern(id)
+        self.owner, self.series, self.name, self.revision = _parse_id(id)
+        if meta:
+            meta = json.dumps(meta, separators=(',', ':'))
+        self._meta = meta or None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a record from an entity dict (with Id and Meta keys)."""
+        return cls(data['Id'], data.get('Meta'))
+
+    @property
+    def meta(self):
+        """The entity metadata, decoded on each access."""
+        if self._meta is None:
+            return {}
+        return json.loads(self._meta)
+
+    def to_dict(self):
+        """Return the entity as the dict returned by the charmstore."""
+        data = {'Id': self.id}
+        if self._meta is not None:
+            data['Meta'] = self.meta
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, Entity):
+            return NotImplemented
+        return self.id == other.id and self.meta == other.meta
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<Entity {}>'.format(self.id)
+
+
+def to_records(results):
+    """Return a list of records for the given entity dicts.
+
+    Records in the results are returned as they are.
+    """
+    return [_to_record(result) for result in results]
+
+
+def iter_records(results):
+    """Iterate over records for the given iterable of entity dicts.
+
+    Records in the results are returned as they are.
+    """
+    for result in results:
+        yield _to_record(result)
+
+
+def _to_record(result):
+    """Return the record of an entity dict, or the record itself."""
+    if isinstance(result, Entity):
+        return result
+    return Entity.from_dict(result)
+
+
+def _parse_id(id):
+    """Split an entity id into interned owner, series, name and revision.
+
+    Missing parts are None. For instance cs:~hatch/xenial/mysql-1 is split
+    into ('hatch', 'xenial', 'mysql', 1).
+    """
+    path = id.split(':', 1)[-1]
+    parts = path.split('/')
+    owner = None
+    if parts[0].startswith('~'):
+        owner = intern(parts.pop(0)[1:])
+    series = intern(parts.pop(0)) if len(parts) > 1 else None
+    name, revision = parts[0], None
+    base, sep, suffix = name.rpartition('-')
+    if sep and suffix.isdigit():
+        name, revision = base, int(suffix)
+    return owner, series, intern(name), revision
@@ -0,0 +1,243 @@
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    TimeoutError,
+    wait,
+)
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+import random
+import threading
+import time
+
+from requests.exceptions import (
+    ConnectionError,
+    Timeout,
+)
+
+from theblues.errors import log
+from theblues.metrics import count_retry
+
+
+# The methods which can be sent again without changing their outcome.
+IDEMPOTENT_METHODS = frozenset(
+    ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE'])
+# The response status codes worth retrying.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.1
+DEFAULT_MAX_BACKOFF = 5
+DEFAULT_MAX_RETRY_AFTER = 30
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_DELAY = 1
+DEFAULT_HEDGE_WINDOW = 200
+# The number of latencies to record before the percentile is used.
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_WORKERS = 16
+
+
+class RetryPolicy(object):
+    """Retry idempotent requests failing with transient errors.
+
+    Connection errors, timeouts and responses with a status in
+    RETRY_STATUSES are retried, up to max_attempts attempts overall. The
+    delay before a retry grows exponentially with the attempt number and is
+    randomized ("full jitter"), so that clients do not retry in lockstep. A
+    Retry-After header in the response is honored, unless it asks to wait
+    longer than max_retry_after, in which case the response is returned.
+
+    A policy holds no per-request state and can be shared by clients.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 max_retry_after=DEFAULT_MAX_RETRY_AFTER,
+                 statuses=RETRY_STATUSES, methods=IDEMPOTENT_METHODS,
+                 sleep=time.sleep, random=random.random):
+        """Initializer.
+
+        @param max_attempts The maximum number of attempts, including the
+            first one.
+        @param backoff The base delay in seconds before the first retry.
+        @param max_backoff The maximum delay in seconds between attempts.
+        @param max_retry_after The longest Retry-After delay in seconds that
+            is waited for.
+        @param statuses The response status codes to retry.
+        @param methods The request methods that may be retried.
+        @param sleep The function used to wait between attempts.
+        @param random A function returning a random float in [0, 1).
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(methods)
+        self._sleep = sleep
+        self._random = random
+
+    def call(self, method, func, url=None):
+        """Call func, retrying as the policy allows.
+
+        @param method The HTTP method of the request sent by func.
+        @param func A function sending the request and returning the
+            requests response.
+        @param url The requested url, used for logging.
+        @return the last response received.
+        @raise the connection or timeout error of the last attempt.
+        """
+        retry = method.upper() in self.methods
+        attempt = 1
+        while True:
+            try:
+                response = func()
+            except (ConnectionError, Timeout) as err:
+                if not retry or attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt)
+                reason = err
+            else:
+                if (not retry or attempt >= self.max_attempts or
+                        response.status_code not in self.statuses):
+                    return response
+                delay = self.delay(attempt, response)
+                if delay is None:
+                    return response
+                reason = 'status code {}'.format(response.status_code)
+                response.close()
+            log.info('retrying {} {} in {:.3f}s after {}'.format(
+                method, url, delay, reason))
+            self._sleep(delay)
+            count_retry()
+            attempt += 1
+
+    def delay(self, attempt, response=None):
+        """Return how long to wait before the next attempt.
+
+        @param attempt The number of the attempt which just failed.
+        @param response The response received, if any.
+        @return the delay in seconds, or None if the response asks to wait
+            longer than max_retry_after.
+        """
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay = self._random() * ceiling
+        retry_after = _retry_after(response)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+class HedgePolicy(object):
+    """Send a second, hedged request when the first one is slow.
+
+    If no response arrives within the given percentile of the recent
+    latencies, the same request is sent again and the first response to
+    arrive is used; the other one is discarded. Until enough latencies are
+    recorded, initial_delay is used as the threshold. Only idempotent
+    requests may be hedged.
+
+    The hedged and won attributes count the hedged requests sent, and those
+    answered first.
+    """
+
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE,
+                 initial_delay=DEFAULT_HEDGE_DELAY, min_delay=0,
+                 window=DEFAULT_HEDGE_WINDOW,
+                 max_workers=DEFAULT_HEDGE_WORKERS, clock=time.time):
+        """Initializer.
+
+        @param percentile The latency percentile after which to hedge.
+        @param initial_delay The delay in seconds after which to hedge
+            until enough latencies are recorded.
+        @param min_delay The minimum delay in seconds after which to hedge.
+        @param window The number of recent latencies recorded.
+        @param max_workers The maximum number of requests in flight.
+        @param clock A function returning the current time in seconds.
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.hedged = self.won = 0
+        self._clock = clock
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def delay(self):
+        """Return how long to wait for a response before hedging."""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return self.initial_delay
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100.0)
+        return max(self.min_delay, latencies[min(index, len(latencies) - 1)])
+
+    def record(self, latency):
+        """Record the latency of a request, in seconds."""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def call(self, func):
+        """Call func, calling it again concurrently if it is slow.
+
+        @param func A function sending an idempotent request and returning
+            the requests response.
+        @return the first response received.
+        @raise the error of the last request to fail, if both fail.
+        """
+        start = self._clock()
+        first = self._executor.submit(func)
+        try:
+            response = first.result(timeout=self.delay())
+        except TimeoutError:
+            pass
+        else:
+            self.record(self._clock() - start)
+            return response
+        with self._lock:
+            self.hedged += 1
+        second = self._executor.submit(func)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = second if second in done else first
+        loser = first if winner is second else second
+        if winner.exception() is not None:
+            winner, loser = loser, winner
+        response = winner.result()
+        loser.add_done_callback(_discard)
+        if winner is second:
+            with self._lock:
+                self.won += 1
+        self.record(self._clock() - start)
+        return response
+
+    def close(self):
+        """Stop the worker threads once the pending requests complete."""
+        self._executor.shutdown(wait=False)
+
+
+def _discard(future):
+    """Close the response of a request which lost the race."""
+    if future.exception() is None:
+        future.result().close()
+
+
+def _retry_after(response):
+    """Return the Retry-After delay of a response in seconds, or None."""
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
@@ -0,0 +1,273 @@
+from bisect import bisect_left
+from collections import namedtuple
+import re
+
+from theblues.records import (
+    Entity,
+    _parse_id,
+)
+
+
+# The metadata requested from the charmstore to build an index.
+INDEX_INCLUDES = [
+    'bundle-metadata',
+    'charm-metadata',
+    'owner',
+    'promulgated',
+    'supported-series',
+    'tags',
+]
+
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+# The indexed attributes of an entity.
+_Document = namedtuple(
+    '_Document',
+    ['id', 'name', 'owner', 'series', 'summary', 'tags', 'promulgated',
+     'type', 'entity'])
+
+# The supported sort keys, mapped to the document attribute they sort on.
+_SORT_KEYS = {
+    'name': 'name',
+    'owner': 'owner',
+    'author': 'owner',
+    'series': 'series',
+}
+
+
+class SearchIndex(object):
+    """A local inverted index to search charmstore entities.
+
+    The index is built from entity dicts (or records.Entity objects) as
+    returned by CharmStore.list or CharmStore.search with INDEX_INCLUDES,
+    and answers the same queries as CharmStore.search without contacting
+    the charmstore. Names, summaries, tags, owners and series are indexed.
+
+    For instance:
+
+        index = SearchIndex.from_charmstore(charmstore)
+        index.search('mysq', autocomplete=True, series='xenial')
+
+    The index can be queried from several threads, but must not be updated
+    concurrently.
+    """
+
+    def __init__(self, entities=()):
+        """Initializer.
+
+        @param entities An iterable of entities to index.
+        """
+        self._documents = {}
+        self._postings = {}
+        self._tokens = None
+        self.update(entities)
+
+    @classmethod
+    def from_charmstore(cls, charmstore, **kwargs):
+        """Build an index of the entities listed by the charmstore.
+
+        The list response is decoded incrementally, so that only the index
+        is kept in memory.
+
+        @param charmstore The CharmStore to list entities from.
+        @param kwargs Other parameters to pass to CharmStore.list, e.g.
+            promulgated_only or series.
+        """
+        kwargs.setdefault('includes', INDEX_INCLUDES)
+        return cls(charmstore.list(stream=True, **kwargs))
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._documents
+
+    def update(self, entities):
+        """Add entities to the index, replacing those with the same id.
+
+        @param entities An iterable of entities to index.
+        """
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        """Add an entity to the index, replacing any with the same id.
+
+        @param entity An entity dict or a records.Entity.
+        """
+        document = _document(entity)
+        if document.id in self._documents:
+            self.remove(document.id)
+        self._documents[document.id] = document
+        for token in _document_tokens(document):
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                self._tokens = None
+            ids.add(document.id)
+
+    def remove(self, entity_id):
+        """Remove an entity from the index.
+
+        @param entity_id The id of the entity, as returned by the charmstore.
+        @raise KeyError if the entity is not in the index.
+        """
+        document = self._documents.pop(entity_id)
+        for token in _document_tokens(document):
+            ids = self._postings[token]
+            ids.discard(entity_id)
+            if not ids:
+                del self._postings[token]
+                self._tokens = None
+
+    def search(self, text='', doc_type=None, limit=None, autocomplete=False,
+               promulgated_only=False, tags=None, sort=None, owner=None,
+               series=None):
+        """Search for entities in the index.
+
+        The parameters are the same as for CharmStore.search. Every word of
+        the text must match: exactly, or as a prefix with autocomplete.
+        Without a sort, entities whose name starts with the text come first,
+        then the others by name.
+
+        @return a list of the indexed entities, as they were added.
+        @raise ValueError if the sort is not valid.
+        """
+        words = _tokenize(text)
+        if words:
+            # Start from the word with the fewest matches, so that the ids
+            # checked against the other words are as few as possible.
+            groups = sorted(
+                (self._match(word, autocomplete) for word in words),
+                key=lambda postings: sum(map(len, postings)))
+            ids = set().union(*groups[0])
+            for postings in groups[1:]:
+                ids = set(id for id in ids
+                          if any(id in matches for matches in postings))
+            documents = [self._documents[id] for id in ids]
+        else:
+            documents = list(self._documents.values())
+        documents = _filter(documents, doc_type, promulgated_only, tags,
+                            owner, series)
+        if sort is None:
+            prefix = text.strip().lower()
+            documents.sort(key=lambda d: (
+                not d.name.lower().startswith(prefix), d.name, d.id))
+        else:
+            _sort(documents, sort)
+        if limit is not None:
+            documents = documents[:limit]
+        return [document.entity for document in documents]
+
+    def _match(self, word, prefix):
+        """Return the sets of ids of the entities matching a word.
+
+        @param word The lower case word to match.
+        @param prefix Whether to also match the words starting with it.
+        """
+        if not prefix:
+            ids = self._postings.get(word)
+            return [ids] if ids is not None else []
+        tokens = self._tokens
+        if tokens is None:
+            tokens = self._tokens = sorted(self._postings)
+        postings = []
+        for i in range(bisect_left(tokens, word), len(tokens)):
+            token = tokens[i]
+            if not token.startswith(word):
+                break
+            postings.append(self._postings[token])
+        return postings
+
+
+def _document(entity):
+    """Return the indexed attributes of an entity dict or record."""
+    data = entity.to_dict() if isinstance(entity, Entity) else entity
+    id = data['Id']
+    meta = data.get('Meta') or {}
+    owner, series, name, _ = _parse_id(id)
+    charm = meta.get('charm-metadata') or {}
+    bundle = meta.get('bundle-metadata') or {}
+    owner = (meta.get('owner') or {}).get('User', owner)
+    supported = (meta.get('supported-series') or {}).get('SupportedSeries')
+    if supported:
+        series = tuple(supported)
+    elif series is not None:
+        series = (series,)
+    else:
+        series = tuple(charm.get('Series') or ())
+    tags = (meta.get('tags') or {}).get('Tags')
+    if tags is None:
+        tags = (charm.get('Tags') or charm.get('Categories') or
+                bundle.get('Tags') or ())
+    is_bundle = bool(bundle) or 'bundle' in series
+    return _Document(
+        id=id,
+        name=name,
+        owner=owner,
+        series=series,
+        summary=charm.get('Summary') or bundle.get('Description') or '',
+        tags=tuple(tags),
+        promulgated=bool(
+            (meta.get('promulgated') or {}).get('Promulgated')),
+        type='bundle' if is_bundle else 'charm',
+        entity=entity)
+
+
+def _tokenize(text):
+    """Split text into lower case words."""
+    return _TOKEN_RE.findall(text.lower()) if text else []
+
+
+def _document_tokens(document):
+    """Return the set of words indexed for a document."""
+    tokens = set(_tokenize(document.name))
+    tokens.update(_tokenize(document.summary))
+    tokens.update(_tokenize(document.owner or ''))
+    for value in document.tags + document.series:
+        tokens.update(_tokenize(value))
+    return tokens
+
+
+def _split(value):
+    """Split a filter given as a list or a comma separated string."""
+    if isinstance(value, (list, tuple)):
+        return set(value)
+    return set(value.split(','))
+
+
+def _filter(documents, doc_type, promulgated_only, tags, owner, series):
+    """Return the documents matching the search filters."""
+    tags = _split(tags) if tags is not None else None
+    series = _split(series) if series is not None else None
+    return [
+        document for document in documents
+        if (doc_type is None or document.type == doc_type) and
+        (not promulgated_only or document.promulgated) and
+        (owner is None or document.owner == owner) and
+        (tags is None or tags.intersection(document.tags)) and
+        (series is None or series.intersection(document.series))
+    ]
+
+
+def _sort(documents, sort):
+    """Sort documents in place according to a charmstore sort string.
+
+    The sort string is a comma separated list of keys, each optionally
+    prefixed with "-" for descending order.
+    """
+    # Sort by each key in turn, starting with the least significant one.
+    for key in reversed(sort.split(',')):
+        reverse = key.startswith('-')
+        field = _SORT_KEYS.get(key.lstrip('-'))
+        if field is None:
+            raise ValueError('invalid sort key: {}'.format(key))
+        documents.sort(key=lambda d: _sort_value(getattr(d, field)),
+                       reverse=reverse)
+
+
+def _sort_value(value):
+    """Return a sort key for a document attribute, which may be None."""
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    return (value is not None, value or '')
@@ -0,0 +1,57 @@
+import threading
+
+
+class SingleFlight(object):
+    """Deduplicate concurrent calls sharing the same key.
+
+    While a call for a key is in flight, other callers for the same key wait
+    for it to complete and receive its result, or its exception, instead of
+    performing the call themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs), unless a call for key is in flight.
+
+        @param key The hashable key identifying the call.
+        @param func The function to call.
+        @return the result of the call.
+        @raise any exception raised by the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        """Return the number of calls currently in flight."""
+        with self._lock:
+            return len(self._calls)
+
+
+class _Call(object):
+    """A call in flight and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
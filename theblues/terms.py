@@ -7,10 +7,12 @@ from theblues.errors import (
     log,
     ServerError,
 )
+from theblues.metrics import instrumented
 from theblues.utils import (
     ensure_trailing_slash,
     make_request,
     DEFAULT_TIMEOUT,
+    Transport,
 )
 
 Term = namedtuple('Term',
@@ -20,7 +22,8 @@ TERMS_VERSION = 'v1'
 
 class Terms(object):
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT, client=None):
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, client=None,
+                 transport=None):
         """Initializer.
 
         @param url The url to the Terms Service API.
@@ -28,13 +31,19 @@ class Terms(object):
             a value of None means no timeout.
         @param client (httpbakery.Client) holds a context for making http
         requests with macaroons.
+        @param transport The Transport used to send requests; if None, a
+            new one is created.
         """
         self.url = ensure_trailing_slash(url) + TERMS_VERSION + '/'
         self.timeout = timeout
+        if transport is None:
+            transport = Transport()
+        self._transport = transport
         if client is None:
             client = httpbakery.Client()
         self._client = client
 
+    @instrumented('terms.get_terms')
     def get_terms(self, name, revision=None):
         """ Retrieve a specific term and condition.
 
@@ -47,7 +56,8 @@ class Terms(object):
         url = '{}terms/{}'.format(self.url, name)
         if revision:
             url = '{}?revision={}'.format(url, revision)
-        json = make_request(url, timeout=self.timeout, client=self._client)
+        json = make_request(url, timeout=self.timeout, client=self._client,
+                            transport=self._transport)
         try:
             # This is always a list of one element.
             data = json[0]
@@ -0,0 +1,8 @@
+import sys
+
+
+# The asyncio client requires aiohttp, which is only installed on Python 3.10
+# and later (see test-requirements.txt).
+collect_ignore = []
+if sys.version_info < (3, 10):
+    collect_ignore.append('test_async_charmstore.py')
@@ -0,0 +1,103 @@
+import tempfile
+from unittest import TestCase
+import zipfile
+
+from theblues.archive import (
+    Archive,
+    ArchiveCache,
+)
+
+
+def make_archive(files):
+    """Return a temporary file holding a zip archive with the given files."""
+    fileobj = tempfile.TemporaryFile()
+    with zipfile.ZipFile(fileobj, 'w') as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    fileobj.seek(0)
+    return fileobj
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.archive = Archive(make_archive({
+            'metadata.yaml': b'name: mysql\n',
+            'hooks/install': b'#!/bin/sh\n',
+            'README.md': u'caf\xe9'.encode('utf-8'),
+        }))
+        self.addCleanup(self.archive.close)
+
+    def test_names(self):
+        self.assertEqual(['README.md', 'hooks/install', 'metadata.yaml'],
+                         sorted(self.archive.names()))
+
+    def test_contains(self):
+        self.assertIn('hooks/install', self.archive)
+        self.assertNotIn('config.yaml', self.archive)
+
+    def test_read(self):
+        self.assertEqual(b'name: mysql\n', self.archive.read('metadata.yaml'))
+
+    def test_read_text(self):
+        self.assertEqual(u'caf\xe9', self.archive.read_text('README.md'))
+
+    def test_read_missing(self):
+        with self.assertRaises(KeyError):
+            self.archive.read('config.yaml')
+
+    def test_directories_not_listed(self):
+        fileobj = tempfile.TemporaryFile()
+        with zipfile.ZipFile(fileobj, 'w') as zf:
+            zf.writestr('hooks/', b'')
+            zf.writestr('hooks/install', b'')
+        with Archive(fileobj) as archive:
+            self.assertEqual(['hooks/install'], archive.names())
+
+    def test_not_a_zip(self):
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write(b'not a zip')
+        fileobj.flush()
+        with self.assertRaises(zipfile.BadZipfile):
+            Archive(fileobj)
+        fileobj.close()
+
+
+class TestArchiveCache(TestCase):
+
+    def archive(self):
+        archive = Archive(make_archive({'README.md': b''}))
+        self.addCleanup(archive.close)
+        return archive
+
+    def test_get_set(self):
+        cache = ArchiveCache()
+        archive = self.archive()
+        self.assertIsNone(cache.get('mysql'))
+        cache.set('mysql', archive)
+        self.assertIs(archive, cache.get('mysql'))
+        self.assertEqual(1, len(cache))
+
+    def test_evict_least_recently_used(self):
+        cache = ArchiveCache(max_entries=2)
+        cache.set('a', self.archive())
+        cache.set('b', self.archive())
+        cache.get('a')
+        cache.set('c', self.archive())
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_evicted_archive_still_readable(self):
+        cache = ArchiveCache(max_entries=1)
+        archive = self.archive()
+        cache.set('a', archive)
+        cache.set('b', self.archive())
+        self.assertEqual(b'', archive.read('README.md'))
+
+    def test_clear(self):
+        cache = ArchiveCache()
+        cache.set('a', self.archive())
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertIsNone(cache.get('a'))
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+import zipfile
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from mock import patch
+
+from theblues.async_charmstore import (
+    AsyncCharmStore,
+    BulkFetchError,
+
+    # We need to import the exceptions that come up in testing from the
+    # module rather than errors so that assertRaises doesn't get confused by
+    # namespaces.
+    EntityNotFound,
+    ServerError,
+    )
+from theblues.interface_index import InterfaceIndex
+from theblues.records import Entity
+
+
+class TestAsyncCharmStore(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.routes = {}
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self.handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.cs = AsyncCharmStore(str(self.server.make_url('')).rstrip('/'))
+
+    async def asyncTearDown(self):
+        await self.cs.close()
+        await self.server.close()
+
+    async def handler(self, request):
+        self.requests.append(request.path_qs)
+        route = self.routes.get(request.path)
+        if route is None:
+            return web.Response(status=404)
+        return await route(request)
+
+    def route(self, path, status=200, body=None, json=None, delay=0):
+        async def handle(request):
+            if delay:
+                await asyncio.sleep(delay)
+            if json is not None:
+                return web.json_response(json, status=status)
+            return web.Response(status=status, body=body)
+        self.routes[path] = handle
+
+    async def test_entity(self):
+        self.route('/precise/mysql-1/meta/any',
+                   json={'Id': 'cs:precise/mysql-1', 'Meta': {}})
+        data = await self.cs.entity('cs:precise/mysql-1')
+        self.assertEqual({'Id': 'cs:precise/mysql-1', 'Meta': {}}, data)
+        self.assertIn('include=stats', self.requests[0])
+        self.assertIn('include=charm-metadata', self.requests[0])
+
+    async def test_entity_not_found(self):
+        with self.assertRaises(EntityNotFound):
+            await self.cs.entity('precise/mysql-1')
+
+    async def test_entity_407(self):
+        self.route('/precise/mysql-1/meta/any', status=407,
+                   json={'Message': 'nope'})
+        with self.assertRaises(EntityNotFound):
+            await self.cs.entity('precise/mysql-1')
+
+    async def test_server_error(self):
+        self.route('/search', status=500, body=b'bad wolf')
+        with patch('theblues.charmstore.logging.error') as log_mocked:
+            with self.assertRaises(ServerError) as cm:
+                await self.cs.search('foo')
+        self.assertEqual((500, 'bad wolf'), cm.exception.args[:2])
+        self.assertEqual(1, log_mocked.call_count)
+
+    async def test_timeout(self):
+        self.cs.timeout = 0.01
+        self.route('/debug/status', json={}, delay=0.5)
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(ServerError) as cm:
+                await self.cs.debug()
+        self.assertIn('Request timed out', cm.exception.args[0])
+
+    async def test_connection_error(self):
+        url = str(self.server.make_url('')).rstrip('/')
+        await self.server.close()
+        cs = AsyncCharmStore(url)
+        self.addAsyncCleanup(cs.close)
+        with patch('theblues.charmstore.logging.error') as log_mocked:
+            with self.assertRaises(ServerError) as cm:
+                await cs.debug()
+        self.assertIsNotNone(cm.exception.args[0])
+        self.assertIn('Error during request', cm.exception.args[2])
+        self.assertEqual(1, log_mocked.call_count)
+
+    def test_unsupported_options(self):
+        with self.assertRaises(TypeError) as cm:
+            AsyncCharmStore(retry=object(), cache=object())
+        self.assertEqual(
+            'unsupported AsyncCharmStore options: cache, retry',
+            str(cm.exception))
+
+    async def test_search_and_list(self):
+        self.route('/search', json={'Results': [{'Id': 'cs:foo/bar-0'}]})
+        self.route('/list', json={'Results': [{'Id': 'cs:foo/baz-0'}]})
+        results = await self.cs.search('foo', limit=1, series='precise')
+        self.assertEqual([{'Id': 'cs:foo/bar-0'}], results)
+        self.assertEqual('/search?series=precise&text=foo&limit=1',
+                         self.requests[0])
+        results = await self.cs.list(owner='hatch')
+        self.assertEqual([{'Id': 'cs:foo/baz-0'}], results)
+
+    async def test_files(self):
+        self.route('/precise/mysql-1/meta/manifest',
+                   json=[{'Name': 'README.md'}, {'Name': 'icon.svg'}])
+        self.route('/precise/mysql-1/archive/README.md', body=b'readme')
+        files = await self.cs.files('precise/mysql-1')
+        self.assertEqual(['README.md', 'icon.svg'], sorted(files))
+        content = await self.cs.files(
+            'precise/mysql-1', filename='README.md', read_file=True)
+        self.assertEqual('readme', content)
+        with self.assertRaises(EntityNotFound):
+            await self.cs.files('precise/mysql-1', filename='missing')
+
+    def route_archive(self, path, content):
+        self.route('/{}/meta/hash256'.format(path),
+                   json={'Sum': hashlib.sha256(content).hexdigest()})
+        self.route('/{}/archive'.format(path), body=content, delay=0.01)
+
+    async def test_download_archive(self):
+        content = b'archive content ' * 1000
+        self.route_archive('precise/mysql-1', content)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        dest = os.path.join(tempdir, 'mysql.zip')
+        with open(dest + '.part', 'wb') as f:
+            f.write(b'corrupt')
+        digest = await self.cs.download_archive('precise/mysql-1', dest)
+        self.assertEqual(hashlib.sha256(content).hexdigest(), digest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+    async def test_files_from_archive(self):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as zf:
+            zf.writestr('metadata.yaml', b'name: mysql\n')
+            zf.writestr('README.md', b'readme')
+        self.route_archive('precise/mysql-1', content.getvalue())
+        results = await asyncio.gather(*[
+            self.cs.files('precise/mysql-1', filename='metadata.yaml',
+                          read_file=True, from_archive=True)
+            for _ in range(3)])
+        self.assertEqual(['name: mysql\n'] * 3, results)
+        files = await self.cs.files('precise/mysql-1', from_archive=True)
+        self.assertEqual(['README.md', 'metadata.yaml'], sorted(files))
+        with self.assertRaises(EntityNotFound):
+            await self.cs.files('precise/mysql-1', filename='missing',
+                                read_file=True, from_archive=True)
+        # The archive is downloaded once.
+        self.assertEqual(
+            ['/precise/mysql-1/meta/hash256', '/precise/mysql-1/archive'],
+            self.requests)
+
+    async def test_charm_icon(self):
+        self.route('/precise/mysql-1/icon.svg', body=b'icon')
+        icon = await self.cs.charm_icon('precise/mysql-1')
+        self.assertEqual(b'icon', icon)
+
+    async def test_charm_icons(self):
+        self.route('/precise/mysql-1/icon.svg', body=b'mysql')
+        self.route('/precise/django-2/icon.svg', body=b'django')
+        icons = await self.cs.charm_icons(
+            ['precise/mysql-1', 'precise/django-2', 'precise/mysql-1'])
+        self.assertEqual(
+            {'precise/mysql-1': b'mysql', 'precise/django-2': b'django'},
+            icons)
+        self.assertEqual(2, len(self.requests))
+        with self.assertRaises(BulkFetchError) as cm:
+            await self.cs.charm_icons(['precise/mysql-1', 'missing-1'])
+        self.assertEqual({'precise/mysql-1': b'mysql'}, cm.exception.results)
+        self.assertIsInstance(cm.exception.errors['missing-1'], EntityNotFound)
+
+    async def test_entity_id(self):
+        self.route('/mysql/meta/any', json={'Id': 'cs:precise/mysql-1'})
+        self.assertEqual('cs:precise/mysql-1',
+                         await self.cs.entityId('mysql'))
+
+    async def test_concurrent_requests(self):
+        self.route('/precise/mysql-1/meta/charm-config',
+                   json={'Options': {}}, delay=0.05)
+        results = await asyncio.gather(
+            *[self.cs.config('precise/mysql-1') for _ in range(50)])
+        self.assertEqual([{'Options': {}}] * 50, results)
+
+    async def test_map_entities(self):
+        self.route('/xenial/mysql-1/meta/any',
+                   json={'Id': 'cs:xenial/mysql-1', 'Meta': {}})
+        self.route('/broken-2/meta/any', status=500, body=b'bad wolf')
+        ids = ['xenial/mysql-1', 'missing-1', 'broken-2']
+        with patch('theblues.charmstore.logging.error'):
+            results = await self.cs.map_entities(ids, includes=['owner'])
+        self.assertEqual(ids, [result.id for result in results])
+        self.assertEqual(
+            {'Id': 'cs:xenial/mysql-1', 'Meta': {}}, results[0].entity)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, EntityNotFound)
+        self.assertIsInstance(results[2].error, ServerError)
+        for request in self.requests:
+            self.assertIn('include=owner&include=stats', request)
+
+    async def test_entities_chunked(self):
+        async def handle(request):
+            ids = request.query.getall('id')
+            if 'bad' in ids:
+                return web.Response(status=500, body=b'bad wolf')
+            return web.json_response(dict((id, {'Id': id}) for id in ids))
+        self.routes['/meta/any'] = handle
+        ids = ['precise/charm-{}'.format(i) for i in range(10)]
+        data = await self.cs.entities(ids, max_url_length=100)
+        self.assertEqual(dict((id, {'Id': id}) for id in ids), data)
+        self.assertTrue(len(self.requests) > 1)
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(BulkFetchError) as cm:
+                await self.cs.entities(ids + ['bad'], max_url_length=100)
+        errors, results = cm.exception.errors, cm.exception.results
+        self.assertIn('bad', errors)
+        self.assertEqual(
+            sorted(ids + ['bad']), sorted(list(errors) + list(results)))
+
+    async def test_iter_search(self):
+        entities = [{'Id': 'cs:charm-{}'.format(i)} for i in range(25)]
+
+        async def handle(request):
+            skip = int(request.query['skip'])
+            limit = int(request.query['limit'])
+            return web.json_response(
+                {'Results': entities[skip:skip + limit]})
+        self.routes['/search'] = handle
+        results = [r async for r in self.cs.iter_search('foo', page_size=10)]
+        self.assertEqual(entities, results)
+        self.assertEqual(3, len(self.requests))
+        self.route('/list', json={'Results': []})
+        results = [r async for r in self.cs.iter_list(page_size=100)]
+        self.assertEqual([], results)
+
+    async def test_iter_list_paging_ignored(self):
+        self.route('/list', json={'Results': [{'Id': 'cs:foo/bar-0'}] * 3})
+        results = [r async for r in self.cs.iter_list(page_size=2)]
+        self.assertEqual([{'Id': 'cs:foo/bar-0'}] * 3, results)
+        self.assertEqual(1, len(self.requests))
+
+    async def test_iter_list_skip_ignored(self):
+        entities = [{'Id': 'cs:charm-{}'.format(i)} for i in range(10)]
+
+        async def handle(request):
+            limit = int(request.query['limit'])
+            return web.json_response({'Results': entities[:limit]})
+        self.routes['/list'] = handle
+        results = [r async for r in self.cs.iter_list(page_size=3)]
+        self.assertEqual(entities[:3], results)
+        self.assertEqual(2, len(self.requests))
+
+    async def test_fetch_interfaces_batch(self):
+        async def handle(request):
+            interface = request.query['requires']
+            return web.json_response(
+                {'Results': [{'Id': 'cs:{}-user-1'.format(interface)}]})
+        self.routes['/search'] = handle
+        results = await self.cs.fetch_interfaces_batch(
+            ['mysql', 'http'], 'requires')
+        self.assertEqual({
+            'mysql': [{'Id': 'cs:mysql-user-1'}],
+            'http': [{'Id': 'cs:http-user-1'}],
+        }, results)
+
+    async def test_fetch_interfaces_records_from_record_index(self):
+        self.cs.interface_index = InterfaceIndex([Entity.from_dict(
+            {'Id': 'cs:mysql-1', 'Meta': {'charm-metadata': {
+                'Provides': {'db': {'Interface': 'mysql'}}}}})])
+        results = await self.cs.fetch_interfaces(
+            'mysql', 'provides', records=True)
+        self.assertEqual(['cs:mysql-1'], [r.id for r in results])
+        results = await self.cs.fetch_interfaces_batch(
+            ['mysql'], 'provides', records=True)
+        self.assertEqual(['cs:mysql-1'], [r.id for r in results['mysql']])
+        self.assertEqual([], self.requests)
@@ -0,0 +1,330 @@
+import datetime
+import threading
+import time
+from unittest import TestCase
+
+from macaroonbakery import (
+    bakery,
+    checkers,
+    httpbakery,
+)
+from mock import (
+    MagicMock,
+    patch,
+)
+import requests
+
+from theblues.auth import (
+    AuthCache,
+    Authorization,
+    DEFAULT_COOKIE_NAME,
+)
+
+
+URL = 'http://example.com/v5/meta/any'
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def make_macaroon(expires):
+    """Return a macaroon valid until the given time since the epoch."""
+    m = bakery.Macaroon(
+        b'root-key', b'id', 'charmstore', version=bakery.LATEST_VERSION)
+    m.add_caveat(checkers.time_before_caveat(
+        datetime.datetime.utcfromtimestamp(expires)))
+    return m
+
+
+def make_request(url=URL, cookie=None):
+    request = requests.Request('GET', url)
+    if cookie is not None:
+        request.headers['Cookie'] = cookie
+    return request.prepare()
+
+
+def make_response(request, status_code=200, content=b'{}', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers.update(headers or {})
+    response.request = request
+    response.url = request.url
+    return response
+
+
+def refused(request, macaroon, path='/', suffix='store'):
+    """Return a discharge-required response to request."""
+    content, headers = httpbakery.discharge_required_response(
+        macaroon, path, suffix)
+    response = make_response(request, 401, content, headers)
+    response.connection = MagicMock()
+    response.connection.send.side_effect = (
+        lambda request, **kwargs: make_response(request))
+    return response
+
+
+def send(auth, request, response=None, macaroon=None):
+    """Authorize request and return the response after the hooks ran.
+
+    The request is refused with macaroon if given.
+    """
+    request = auth(request)
+    if response is None:
+        if macaroon is None:
+            response = make_response(request)
+        else:
+            response = refused(request, macaroon)
+    for hook in request.hooks['response']:
+        response = hook(response)
+    return response
+
+
+class TestAuthCache(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = AuthCache(
+            refresh_margin=60, background=False, clock=self.clock)
+        self.client = httpbakery.Client()
+        self.macaroon = make_macaroon(self.clock.now + 3600)
+
+    def test_no_authorization(self):
+        request = make_request()
+        response = send(self.cache.auth(self.client, URL), request)
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('Cookie', request.headers)
+        self.assertEqual(
+            str(bakery.LATEST_VERSION),
+            request.headers[httpbakery.BAKERY_PROTOCOL_HEADER])
+        self.assertIsNone(self.cache.get(self.client, URL))
+        self.assertEqual(1, self.cache.stats().misses)
+
+    def test_discharge(self):
+        auth = self.cache.auth(self.client, URL)
+        response = send(auth, make_request(), macaroon=self.macaroon)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(401, response.history[0].status_code)
+        authorization = self.cache.get(self.client, URL)
+        self.assertEqual(
+            Authorization(
+                host='example.com', path='/', name='macaroon-store',
+                value=authorization.value, expires=self.clock.now + 3600,
+                obtained=self.clock.now),
+            authorization)
+        self.assertEqual(
+            'macaroon-store=' + authorization.value,
+            response.request.headers['Cookie'])
+
+    def test_reuse(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        request = make_request('http://example.com/v5/other/meta/any')
+        response = send(self.cache.auth(self.client, request.url), request)
+        self.assertEqual(200, response.status_code)
+        value = self.cache.get(self.client, URL).value
+        self.assertEqual('macaroon-store=' + value, request.headers['Cookie'])
+        stats = self.cache.stats()
+        self.assertEqual(1, stats.discharges)
+        self.assertEqual(1, stats.hits)
+        self.assertEqual(1, stats.misses)
+
+    def test_replace_cookie(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        request = make_request(cookie='macaroon-store=old; session=s1')
+        send(self.cache.auth(self.client, URL), request)
+        value = self.cache.get(self.client, URL).value
+        self.assertEqual(
+            'session=s1; macaroon-store=' + value, request.headers['Cookie'])
+
+    def test_default_cookie_name(self):
+        request = make_request()
+        response = refused(request, self.macaroon, suffix=None)
+        send(self.cache.auth(self.client, URL), request, response=response)
+        self.assertEqual(
+            DEFAULT_COOKIE_NAME, self.cache.get(self.client, URL).name)
+
+    def test_macaroon_path(self):
+        request = make_request()
+        response = refused(request, self.macaroon, path='/v5/meta/')
+        send(self.cache.auth(self.client, URL), request, response=response)
+        self.assertEqual('/v5/meta/', self.cache.get(self.client, URL).path)
+        self.assertIsNone(
+            self.cache.get(self.client, 'http://example.com/v5/search'))
+        self.assertIsNone(
+            self.cache.get(self.client, 'http://other.example.com/v5/meta/'))
+
+    def test_per_client(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.assertIsNone(self.cache.get(httpbakery.Client(), URL))
+
+    def test_expiry(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3600
+        self.assertIsNone(self.cache.get(self.client, URL))
+        self.assertEqual([], self.cache.authorizations(self.client))
+
+    def test_invalidate(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.cache.invalidate(self.client, 'http://other.example.com/v5/')
+        self.assertIsNotNone(self.cache.get(self.client, URL))
+        self.cache.invalidate(self.client, URL)
+        self.assertIsNone(self.cache.get(self.client, URL))
+
+    def test_invalidate_all(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.cache.invalidate(self.client)
+        self.assertEqual([], self.cache.authorizations(self.client))
+
+    def test_other_responses(self):
+        auth = self.cache.auth(self.client, URL)
+        for status_code, headers in (
+                (404, {'Content-Type': 'application/json'}),
+                (401, {'Content-Type': 'application/json'}),
+                (401, {'WWW-Authenticate': 'Macaroon',
+                       'Content-Type': 'text/plain'})):
+            request = make_request()
+            response = make_response(
+                request, status_code, b'{"Code": "not found"}', headers)
+            self.assertIs(response, send(auth, request, response=response))
+        self.assertEqual(0, self.cache.stats().discharges)
+
+    def test_discharge_failure(self):
+        auth = self.cache.auth(self.client, URL)
+        with patch('theblues.auth.bakery.discharge_all',
+                   side_effect=httpbakery.DischargeError('denied')):
+            with self.assertRaises(httpbakery.DischargeError):
+                send(auth, make_request(), macaroon=self.macaroon)
+        self.assertEqual(1, self.cache.stats().failures)
+        self.assertIsNone(self.cache.get(self.client, URL))
+
+    def test_refused_after_discharge(self):
+        # A request sent before the macaroons were discharged by another
+        # one uses them instead of discharging them again.
+        auth = self.cache.auth(self.client, URL)
+        stale = auth(make_request())
+        send(auth, make_request(), macaroon=self.macaroon)
+        self.clock.now += 1
+        response = refused(stale, self.macaroon)
+        for hook in stale.hooks['response']:
+            response = hook(response)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, self.cache.stats().discharges)
+
+    def test_refresh(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3550
+        renewed = make_macaroon(self.clock.now + 3600)
+        with patch('theblues.auth.bakery.discharge_all',
+                   return_value=[renewed.macaroon]):
+            send(self.cache.auth(self.client, URL), make_request())
+        authorization = self.cache.get(self.client, URL)
+        self.assertEqual(self.clock.now + 3600, authorization.expires)
+        stats = self.cache.stats()
+        self.assertEqual(1, stats.refreshes)
+        self.assertEqual(2, stats.discharges)
+
+    def test_refresh_not_extended(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3550
+        for _ in range(3):
+            send(self.cache.auth(self.client, URL), make_request())
+        # The expiry of the macaroon in the refused response cannot be
+        # extended, so that it is only discharged again once.
+        self.assertEqual(1, self.cache.stats().refreshes)
+        self.assertIsNotNone(self.cache.get(self.client, URL))
+
+    def test_refresh_failure(self):
+        send(self.cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3550
+        with patch('theblues.auth.bakery.discharge_all',
+                   side_effect=httpbakery.DischargeError('denied')):
+            request = make_request()
+            send(self.cache.auth(self.client, URL), request)
+        self.assertIn('macaroon-store=', request.headers['Cookie'])
+        self.assertEqual(1, self.cache.stats().failures)
+
+    def test_no_refresh(self):
+        cache = AuthCache(refresh_margin=None, clock=self.clock)
+        send(cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3550
+        send(cache.auth(self.client, URL), make_request())
+        self.assertEqual(0, cache.stats().refreshes)
+
+    def test_background_refresh(self):
+        cache = AuthCache(refresh_margin=60, clock=self.clock)
+        send(cache.auth(self.client, URL), make_request(),
+             macaroon=self.macaroon)
+        self.clock.now += 3550
+        done = threading.Event()
+
+        def discharge_all(*args):
+            done.wait(1)
+            return [make_macaroon(self.clock.now + 3600).macaroon]
+
+        with patch('theblues.auth.bakery.discharge_all', discharge_all):
+            request = make_request()
+            send(cache.auth(self.client, URL), request)
+            # The request did not wait for the refresh.
+            self.assertIn('macaroon-store=', request.headers['Cookie'])
+            self.assertEqual(1, cache.stats().discharges)
+            done.set()
+            deadline = time.time() + 1
+            while (cache.stats().discharges < 2 and
+                   time.time() < deadline):
+                time.sleep(0.01)
+        self.assertEqual(
+            self.clock.now + 3600, cache.get(self.client, URL).expires)
+
+    def test_concurrent_discharge(self):
+        calls = []
+
+        def discharge_all(macaroon, get_discharge, key):
+            calls.append(macaroon)
+            time.sleep(0.05)
+            return [macaroon.macaroon]
+
+        results = []
+
+        def request():
+            response = send(self.cache.auth(self.client, URL), make_request(),
+                            macaroon=self.macaroon)
+            results.append(response.status_code)
+
+        with patch('theblues.auth.bakery.discharge_all', discharge_all):
+            threads = [threading.Thread(target=request) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([200] * 8, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, self.cache.stats().discharges)
+
+    def test_resend_without_connection(self):
+        request = make_request()
+        response = refused(request, self.macaroon)
+        response.connection = None
+        with patch('requests.Session.send',
+                   side_effect=lambda request, **kwargs: make_response(
+                       request, 204)) as mock_send:
+            response = send(
+                self.cache.auth(self.client, URL), request, response=response)
+        self.assertEqual(204, response.status_code)
+        self.assertIn('macaroon-store=', mock_send.call_args[0][0].headers[
+            'Cookie'])
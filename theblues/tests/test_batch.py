@@ -0,0 +1,149 @@
+import threading
+from unittest import TestCase
+
+from httmock import (
+    HTTMock,
+    urlmatch,
+    )
+
+from theblues.batch import EntityBatcher
+from theblues.cache import MemoryCache
+from theblues.charmstore import CharmStore
+from theblues.errors import (
+    EntityNotFound,
+    ServerError,
+    )
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+
+class TestEntityBatcher(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.queries = []
+
+    @urlmatch(path='/meta/any')
+    def bulk(self, url, request):
+        query = parse_qs(url.query)
+        self.queries.append(query)
+        return {
+            'status_code': 200,
+            'content': dict(
+                (id, {'Id': 'cs:' + id, 'Meta': {}})
+                for id in query['id'] if id != 'missing'),
+        }
+
+    def test_batch(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                mysql = batch.entity('cs:mysql', includes=['owner'])
+                wordpress = batch.entity('wordpress', includes=['owner'])
+                self.assertFalse(mysql.done())
+        self.assertEqual({'Id': 'cs:mysql', 'Meta': {}}, mysql.result())
+        self.assertEqual(
+            {'Id': 'cs:wordpress', 'Meta': {}}, wordpress.result())
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual({
+            'id': ['mysql', 'wordpress'],
+            'include': ['owner', 'stats'],
+        }, self.queries[0])
+
+    def test_batch_grouped_by_includes_and_channel(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                batch.entity('mysql', includes=['owner'])
+                batch.entity('django', includes=['owner'], channel='edge')
+                batch.entity('redis', includes=['stats', 'owner'])
+                batch.entity('wordpress')
+        self.assertEqual(3, len(self.queries))
+        self.assertEqual(['mysql', 'redis'], self.queries[0]['id'])
+        self.assertEqual(['edge'], self.queries[1]['channel'])
+        self.assertIn('charm-metadata', self.queries[2]['include'])
+
+    def test_batch_duplicates(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                first = batch.entity('mysql')
+                second = batch.entity('mysql')
+        self.assertEqual(['mysql'], self.queries[0]['id'])
+        self.assertEqual(first.result(), second.result())
+        self.assertIsNot(first.result(), second.result())
+
+    def test_batch_size(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs, max_batch_size=2) as batch:
+                futures = [batch.entity(id) for id in 'abcde']
+        self.assertEqual(3, len(self.queries))
+        self.assertEqual(['e'], self.queries[2]['id'])
+        self.assertEqual(
+            ['cs:' + id for id in 'abcde'],
+            [future.result()['Id'] for future in futures])
+
+    def test_cancelled(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                first = batch.entity('mysql')
+                cancelled = batch.entity('mysql')
+                missing = batch.entity('missing')
+                last = batch.entity('wordpress')
+                self.assertTrue(cancelled.cancel())
+                self.assertTrue(missing.cancel())
+        self.assertEqual('cs:mysql', first.result()['Id'])
+        self.assertEqual('cs:wordpress', last.result()['Id'])
+        self.assertTrue(cancelled.cancelled())
+        self.assertTrue(missing.cancelled())
+
+    def test_not_found(self):
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                found = batch.entity('mysql')
+                missing = batch.entity('missing')
+        self.assertEqual('cs:mysql', found.result()['Id'])
+        with self.assertRaises(EntityNotFound):
+            missing.result()
+
+    def test_server_error(self):
+        @urlmatch(path='/meta/any')
+        def error(url, request):
+            return {'status_code': 500, 'content': b'bad wolf'}
+
+        with HTTMock(error):
+            with EntityBatcher(self.cs) as batch:
+                futures = [batch.entity('mysql'), batch.entity('wordpress')]
+        for future in futures:
+            with self.assertRaises(ServerError):
+                future.result()
+
+    def test_window(self):
+        batch = EntityBatcher(self.cs, window=0.1)
+        results = []
+
+        def load(id):
+            results.append(batch.load(id)['Id'])
+
+        threads = [threading.Thread(target=load, args=(id,))
+                   for id in ('mysql', 'wordpress', 'redis')]
+        with HTTMock(self.bulk):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(
+            ['cs:mysql', 'cs:redis', 'cs:wordpress'], sorted(results))
+
+    def test_cache(self):
+        self.cs.cache = MemoryCache()
+        with HTTMock(self.bulk):
+            with EntityBatcher(self.cs) as batch:
+                batch.entity('mysql')
+            with EntityBatcher(self.cs) as batch:
+                cached = batch.entity('mysql')
+                self.assertTrue(cached.done())
+            entity = self.cs.entity('mysql')
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(entity, cached.result())
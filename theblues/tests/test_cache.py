@@ -0,0 +1,368 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase
+
+import mock
+import requests
+
+from theblues.cache import (
+    BlobCache,
+    CacheStats,
+    HTTPCache,
+    MemoryCache,
+    SQLiteCache,
+)
+
+
+def make_response(content=b'{}', headers=None, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content
+    response.encoding = 'utf-8'
+    return response
+
+
+class TestHTTPCache(TestCase):
+
+    def setUp(self):
+        self.cache = HTTPCache(max_entries=2)
+
+    def test_headers_empty(self):
+        self.assertEqual({}, self.cache.headers('http://example.com/a'))
+
+    def test_store_without_validators(self):
+        self.cache.store('http://example.com/a', make_response())
+        self.assertEqual(0, len(self.cache))
+
+    def test_headers(self):
+        self.cache.store('http://example.com/a', make_response(headers={
+            'ETag': '"abc"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }))
+        self.assertEqual({
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }, self.cache.headers('http://example.com/a'))
+
+    def test_not_modified(self):
+        self.cache.store('http://example.com/a', make_response(
+            content=b'{"foo": "bar"}',
+            headers={'ETag': '"abc"', 'Content-Type': 'application/json'}))
+        response = self.cache.not_modified(
+            'http://example.com/a', make_response(b'', status_code=304))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'foo': 'bar'}, response.json())
+        self.assertEqual('application/json', response.headers['content-type'])
+
+    def test_not_modified_missing(self):
+        response = self.cache.not_modified(
+            'http://example.com/a', make_response(b'', status_code=304))
+        self.assertIsNone(response)
+
+    def test_lru_eviction(self):
+        response = make_response(headers={'ETag': '"abc"'})
+        self.cache.store('http://example.com/a', response)
+        self.cache.store('http://example.com/b', response)
+        # Using "a" makes "b" the least recently used entry.
+        self.cache.headers('http://example.com/a')
+        self.cache.store('http://example.com/c', response)
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual({}, self.cache.headers('http://example.com/b'))
+        self.assertNotEqual({}, self.cache.headers('http://example.com/a'))
+
+    def test_clear(self):
+        self.cache.store(
+            'http://example.com/a', make_response(headers={'ETag': '"a"'}))
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMemoryCache(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = MemoryCache(
+            ttl=10, max_entries=3, max_bytes=100, clock=self.clock)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', b'value')
+        self.assertEqual(b'value', self.cache.get('a'))
+        self.assertEqual(
+            CacheStats(hits=1, misses=1, evictions=0, expirations=0,
+                       entries=1, size=6),
+            self.cache.stats())
+
+    def test_expiry(self):
+        self.cache.set('a', b'value')
+        self.cache.set('b', b'value', ttl=60)
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(b'value', self.cache.get('b'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats.expirations)
+        self.assertEqual(1, stats.entries)
+
+    def test_no_ttl(self):
+        cache = MemoryCache(ttl=None, clock=self.clock)
+        cache.set('a', b'value')
+        self.clock.now += 1e9
+        self.assertEqual(b'value', cache.get('a'))
+
+    def test_evict_max_entries(self):
+        for key in 'abc':
+            self.cache.set(key, b'v')
+        self.cache.get('a')
+        self.cache.set('d', b'v')
+        self.assertIsNone(self.cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(b'v', self.cache.get(key))
+        self.assertEqual(1, self.cache.stats().evictions)
+
+    def test_evict_max_bytes(self):
+        self.cache.set('a', b'x' * 49)
+        self.cache.set('b', b'x' * 49)
+        self.cache.set('c', b'x' * 9)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(60, self.cache.stats().size)
+
+    def test_value_too_big(self):
+        self.cache.set('a', b'x' * 100)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.stats().size)
+
+    def test_replace(self):
+        self.cache.set('a', b'x' * 10)
+        self.cache.set('a', b'x')
+        self.assertEqual(b'x', self.cache.get('a'))
+        self.assertEqual(2, self.cache.stats().size)
+
+    def test_delete_and_clear(self):
+        self.cache.set('a', b'v')
+        self.cache.set('b', b'v')
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.stats().size)
+
+
+class TestSQLiteCache(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'cache.db')
+        self.clock = FakeClock()
+        self.cache = self.make_cache()
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault('ttl', 10)
+        kwargs.setdefault('max_entries', 3)
+        kwargs.setdefault('max_bytes', 100)
+        return SQLiteCache(self.path, clock=self.clock, **kwargs)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', b'value')
+        self.assertEqual(b'value', self.cache.get('a'))
+        self.assertEqual(
+            CacheStats(hits=1, misses=1, evictions=0, expirations=0,
+                       entries=1, size=6),
+            self.cache.stats())
+
+    def test_shared_between_instances(self):
+        other = self.make_cache()
+        self.cache.set('a', b'value')
+        self.assertEqual(b'value', other.get('a'))
+        other.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_persistent(self):
+        self.cache.set('a', b'value')
+        del self.cache
+        self.assertEqual(b'value', self.make_cache().get('a'))
+
+    def test_expiry(self):
+        self.cache.set('a', b'value')
+        self.cache.set('b', b'value', ttl=60)
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(b'value', self.cache.get('b'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats.expirations)
+        self.assertEqual(1, stats.entries)
+
+    def test_evict_max_entries(self):
+        self.cache.ttl = None
+        for key in 'abc':
+            self.cache.set(key, b'v')
+            self.clock.now += 1
+        # Access times are only refreshed after a while.
+        self.clock.now += 61
+        self.cache.get('a')
+        self.cache.set('d', b'v')
+        self.assertIsNone(self.cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(b'v', self.cache.get(key))
+        self.assertEqual(1, self.cache.stats().evictions)
+
+    def test_evict_max_bytes(self):
+        self.cache.set('a', b'x' * 49)
+        self.clock.now += 1
+        self.cache.set('b', b'x' * 49)
+        self.clock.now += 1
+        self.cache.set('c', b'x' * 9)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(60, self.cache.stats().size)
+
+    def test_value_too_big(self):
+        self.cache.set('a', b'v')
+        self.cache.set('a', b'x' * 100)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_clear(self):
+        self.cache.set('a', b'v')
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+
+    def test_threads(self):
+        cache = self.make_cache(max_entries=1000, max_bytes=100000)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(20):
+                    key = '{}-{}'.format(n, i)
+                    cache.set(key, key.encode('utf-8'))
+                    assert cache.get(key) == key.encode('utf-8')
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(160, len(cache))
+
+    def test_database_error(self):
+        self.cache.set('a', b'v')
+        with mock.patch.object(self.cache, '_connection') as connection:
+            connection.side_effect = sqlite3.OperationalError('locked')
+            with mock.patch('theblues.cache.log.warning') as warning:
+                self.assertIsNone(self.cache.get('a'))
+                self.cache.set('b', b'v')
+                self.cache.clear()
+                stats = self.cache.stats()
+        self.assertEqual(4, warning.call_count)
+        self.assertEqual((0, 0), (stats.entries, stats.size))
+        self.assertEqual(1, stats.misses)
+
+    def test_totals(self):
+        self.cache.set('a', b'v')
+        self.cache.set('a', b'value')
+        self.cache.set('b', b'v')
+        self.cache.delete('b')
+        stats = self.cache.stats()
+        self.assertEqual((1, 6), (stats.entries, stats.size))
+        # Existing databases get their totals on opening.
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute('DROP TABLE cache_totals')
+        conn.close()
+        stats = self.make_cache().stats()
+        self.assertEqual((1, 6), (stats.entries, stats.size))
+        self.cache.clear()
+        self.assertEqual(0, self.cache.stats().size)
+
+
+class TestBlobCache(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.clock = FakeClock()
+        self.cache = BlobCache(self.dir, ttl=10, max_bytes=100,
+                               clock=self.clock)
+
+    def blob_files(self):
+        return [name for _, _, names in os.walk(os.path.join(self.dir,
+                                                             'blobs'))
+                for name in names]
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('icon:mysql'))
+        self.cache.set('icon:mysql', b'<svg/>')
+        self.assertEqual(b'<svg/>', self.cache.get('icon:mysql'))
+        self.assertEqual(1, len(self.cache))
+
+    def test_deduplicated(self):
+        self.cache.set('icon:mysql', b'<svg/>')
+        self.cache.set('icon:wordpress', b'<svg/>')
+        self.assertEqual(b'<svg/>', self.cache.get('icon:wordpress'))
+        self.assertEqual(1, len(self.blob_files()))
+        self.assertEqual(6, self.cache.stats().size)
+        self.assertEqual(2, self.cache.stats().entries)
+
+    def test_expired(self):
+        self.cache.set('icon:mysql', b'<svg/>')
+        self.clock.now += 11
+        self.assertIsNone(self.cache.get('icon:mysql'))
+
+    def test_size_bounded(self):
+        self.cache.set('a', b'a' * 60)
+        for path, _, names in os.walk(os.path.join(self.dir, 'blobs')):
+            for name in names:
+                os.utime(os.path.join(path, name), (0, 0))
+        self.cache.set('b', b'b' * 60)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(b'b' * 60, self.cache.get('b'))
+        self.assertEqual(1, len(self.blob_files()))
+        self.assertEqual(1, self.cache.stats().evictions)
+
+    def test_too_large(self):
+        self.cache.set('a', b'a' * 101)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual([], self.blob_files())
+
+    def test_corrupted(self):
+        self.cache.set('a', b'content')
+        path = os.path.join(self.dir, 'blobs')
+        for parent, _, names in os.walk(path):
+            for name in names:
+                with open(os.path.join(parent, name), 'wb') as f:
+                    f.write(b'other')
+        with mock.patch('theblues.cache.log') as log_mocked:
+            self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(1, log_mocked.warning.call_count)
+
+    def test_delete_and_clear(self):
+        self.cache.set('a', b'a')
+        self.cache.set('b', b'b')
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(b'b', self.cache.get('b'))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual([], self.blob_files())
+
+    def test_shared(self):
+        self.cache.set('a', b'content')
+        other = BlobCache(self.dir, clock=self.clock)
+        self.assertEqual(b'content', other.get('a'))
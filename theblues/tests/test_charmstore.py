@@ -1,15 +1,40 @@
+import hashlib
+import io
+import json
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from unittest import TestCase
+import zipfile
 
 from httmock import (
     HTTMock,
     urlmatch,
     )
 from jujubundlelib import references
-from mock import patch
+from mock import (
+    MagicMock,
+    patch,
+    )
 from requests.exceptions import Timeout
-
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+from theblues.archive import ArchiveCache
+from theblues.cache import (
+    BlobCache,
+    HTTPCache,
+    MemoryCache,
+    SQLiteCache,
+)
+from theblues.circuitbreaker import CircuitBreakerRegistry
 from theblues.charmstore import (
+    BulkFetchError,
     CharmStore,
 
     # We need to import the exceptions that come up in testing from charmstore
@@ -18,6 +43,19 @@ from theblues.charmstore import (
     EntityNotFound,
     ServerError,
     )
+from theblues.errors import (
+    CircuitOpenError,
+    RateLimitError,
+)
+from theblues.interface_index import InterfaceIndex
+from theblues.metrics import Collector
+from theblues.tracing import Tracer
+from theblues.ratelimit import RateLimiterRegistry
+from theblues.records import Entity
+from theblues.retry import (
+    HedgePolicy,
+    RetryPolicy,
+)
 
 
 SAMPLE_CHARM = 'precise/mysql-1'
@@ -446,6 +484,50 @@ class TestCharmStore(TestCase):
                 cm.exception.args[0]
             )
 
+    def test_entities_chunked(self):
+        ids = ['precise/charm-{}'.format(i) for i in range(10)]
+        urls = []
+
+        @urlmatch(path='/meta/any')
+        def handler(url, request):
+            urls.append(url.geturl())
+            paths = [param[3:] for param in url.query.split('&')[1:]]
+            return {
+                'status_code': 200,
+                'content': dict((path, {'Id': path}) for path in paths),
+            }
+
+        with HTTMock(handler):
+            data = self.cs.entities(ids, max_url_length=100, workers=2)
+        self.assertEqual(dict((id, {'Id': id}) for id in ids), data)
+        self.assertEqual(4, len(urls))
+        for url in urls:
+            self.assertLessEqual(len(url), 100)
+
+    def test_entities_chunked_long_id(self):
+        chunks = self.cs._entities_urls(['a' * 200, 'b'], 100)
+        self.assertEqual([
+            ('http://example.com/meta/any?include=id&id=' + 'a' * 200,
+             ['a' * 200]),
+            ('http://example.com/meta/any?include=id&id=b', ['b']),
+        ], chunks)
+
+    def test_entities_chunked_errors(self):
+        @urlmatch(path='/meta/any')
+        def handler(url, request):
+            if 'id=bad' in url.query:
+                return {'status_code': 500, 'content': b'bad wolf'}
+            return {'status_code': 200, 'content': {'good': {'Id': 'good'}}}
+
+        with HTTMock(handler):
+            with patch('theblues.charmstore.logging.error'):
+                with self.assertRaises(ServerError) as cm:
+                    self.cs.entities(['good', 'bad'], max_url_length=50)
+        self.assertIsInstance(cm.exception, BulkFetchError)
+        self.assertEqual({'good': {'Id': 'good'}}, cm.exception.results)
+        self.assertEqual(['bad'], list(cm.exception.errors))
+        self.assertEqual(500, cm.exception.errors['bad'].args[0])
+
     def test_charm_error(self):
         with HTTMock(entity_404):
             with self.assertRaises(EntityNotFound):
@@ -785,3 +867,1040 @@ class TestCharmStore(TestCase):
         url = self.cs.resource_url(entity_id, "myresource", "22")
         self.assertEqual('http://example.com/mongodb/resource/myresource/22',
                          url)
+
+
+class TestCharmStoreHTTPCache(TestCase):
+
+    def setUp(self):
+        self.cache = HTTPCache()
+        self.cs = CharmStore('http://example.com', http_cache=self.cache)
+        self.requests = []
+
+    @urlmatch(path=CONFIG_PATH)
+    def config_etag(self, url, request):
+        self.requests.append(request)
+        if request.headers.get('If-None-Match') == '"v1"':
+            return {'status_code': 304}
+        return {
+            'status_code': 200,
+            'headers': {'ETag': '"v1"', 'Content-Type': 'application/json'},
+            'content': b'{"exists": true}',
+        }
+
+    def test_not_modified(self):
+        with HTTMock(self.config_etag):
+            first = self.cs.config(SAMPLE_CHARM)
+            second = self.cs.config(SAMPLE_CHARM)
+        self.assertEqual({'exists': True}, first)
+        self.assertEqual(first, second)
+        self.assertNotIn('If-None-Match', self.requests[0].headers)
+        self.assertEqual('"v1"', self.requests[1].headers['If-None-Match'])
+
+    def test_modified(self):
+        @urlmatch(path=README_PATH)
+        def readme(url, request):
+            self.requests.append(request)
+            modified = 'Wed, 0{} Oct 2018 07:28:00 GMT'.format(
+                len(self.requests))
+            return {
+                'status_code': 200,
+                'headers': {'Last-Modified': modified},
+                'content': 'readme {}'.format(len(self.requests)),
+            }
+        with HTTMock(readme):
+            self.assertEqual(
+                'readme 1', self.cs.entity_readme_content(SAMPLE_CHARM))
+            self.assertEqual(
+                'readme 2', self.cs.entity_readme_content(SAMPLE_CHARM))
+        self.assertEqual(
+            'Wed, 01 Oct 2018 07:28:00 GMT',
+            self.requests[1].headers['If-Modified-Since'])
+
+    def test_evicted_while_revalidating(self):
+        @urlmatch(path=CONFIG_PATH)
+        def handler(url, request):
+            self.requests.append(request)
+            if request.headers.get('If-None-Match'):
+                self.cache.clear()
+                return {'status_code': 304}
+            return {
+                'status_code': 200,
+                'headers': {'ETag': '"v1"'},
+                'content': b'{"exists": true}',
+            }
+        with HTTMock(handler):
+            self.cs.config(SAMPLE_CHARM)
+            self.assertEqual({'exists': True}, self.cs.config(SAMPLE_CHARM))
+        self.assertEqual(3, len(self.requests))
+
+    def test_errors_not_cached(self):
+        with HTTMock(config_404):
+            with self.assertRaises(EntityNotFound):
+                self.cs.config(SAMPLE_CHARM)
+        self.assertEqual(0, len(self.cache))
+
+
+class TestCharmStoreCache(TestCase):
+
+    def setUp(self):
+        self.cache = MemoryCache()
+        self.cs = CharmStore('http://example.com', cache=self.cache)
+        self.urls = []
+
+    @urlmatch(path=ID_PATH)
+    def entity(self, url, request):
+        self.urls.append(url.geturl())
+        return {'status_code': 200, 'content': {'Id': 'cs:precise/mysql-1'}}
+
+    def test_entity_cached(self):
+        with HTTMock(self.entity):
+            first = self.cs.entity(SAMPLE_CHARM_ID)
+            second = self.cs.entity(
+                references.Reference.from_string(SAMPLE_CHARM))
+            third = self.cs.charm(SAMPLE_CHARM)
+        self.assertEqual({'Id': 'cs:precise/mysql-1'}, first)
+        self.assertEqual(first, second)
+        self.assertEqual(first, third)
+        # The charm call requires the manifest, so it is a different entry.
+        self.assertEqual(2, len(self.urls))
+        self.assertEqual(1, self.cache.stats().hits)
+
+    def test_includes_order_ignored(self):
+        with HTTMock(self.entity):
+            self.cs.entity(SAMPLE_CHARM, includes=['foo', 'bar'])
+            self.cs.entity(SAMPLE_CHARM, includes=['bar', 'foo'])
+        self.assertEqual(1, len(self.urls))
+
+    def test_channel(self):
+        with HTTMock(self.entity):
+            self.cs.entity(SAMPLE_CHARM, channel='edge')
+            self.cs.entity(SAMPLE_CHARM, channel='stable')
+            self.cs.entity(SAMPLE_CHARM, channel='edge')
+        self.assertEqual(2, len(self.urls))
+
+    def test_results_not_shared(self):
+        with HTTMock(self.entity):
+            self.cs.entity(SAMPLE_CHARM)['Id'] = 'changed'
+            data = self.cs.entity(SAMPLE_CHARM)
+        self.assertEqual({'Id': 'cs:precise/mysql-1'}, data)
+
+    def test_search_and_list_cached(self):
+        with HTTMock(search_200):
+            self.assertEqual(
+                [{'Id': 'cs:foo/bar-0'}], self.cs.search('foo'))
+        with HTTMock(list_200):
+            self.assertEqual([{'Id': 'cs:foo/bar-0'}], self.cs.list())
+        with HTTMock(search_400):
+            self.assertEqual(
+                [{'Id': 'cs:foo/bar-0'}], self.cs.search('foo'))
+            self.assertEqual([{'Id': 'cs:foo/bar-0'}], self.cs.list())
+
+    def test_binary_cached(self):
+        with HTTMock(icon_200, diagram_200):
+            self.cs.charm_icon(SAMPLE_CHARM)
+            self.cs.bundle_visualization(SAMPLE_BUNDLE)
+        with HTTMock(icon_404, diagram_404):
+            self.assertEqual(b'icon', self.cs.charm_icon(SAMPLE_CHARM))
+            self.assertEqual(
+                b'diagram', self.cs.bundle_visualization(SAMPLE_BUNDLE))
+
+    def test_shared_disk_cache(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'cache.db')
+        cs1 = CharmStore('http://example.com', cache=SQLiteCache(path))
+        cs2 = CharmStore('http://example.com', cache=SQLiteCache(path))
+        with HTTMock(self.entity):
+            cs1.entity(SAMPLE_CHARM)
+            data = cs2.entity(SAMPLE_CHARM)
+        self.assertEqual({'Id': 'cs:precise/mysql-1'}, data)
+        self.assertEqual(1, len(self.urls))
+
+    def test_cache_shared_between_charmstores(self):
+        staging = CharmStore('http://staging.example.com', cache=self.cache)
+        with HTTMock(self.entity):
+            self.cs.entity(SAMPLE_CHARM)
+            staging.entity(SAMPLE_CHARM)
+        self.assertEqual(
+            ['example.com', 'staging.example.com'],
+            [url.split('/')[2] for url in self.urls])
+
+    def test_blob_cache_shared_between_charmstores(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        blob_cache = BlobCache(tempdir)
+        cs = CharmStore('http://example.com', blob_cache=blob_cache)
+        staging = CharmStore('http://staging.example.com',
+                             blob_cache=blob_cache)
+        with HTTMock(icon_200):
+            cs.charm_icon(SAMPLE_CHARM)
+        with HTTMock(icon_404):
+            with self.assertRaises(EntityNotFound):
+                staging.charm_icon(SAMPLE_CHARM)
+
+    def test_not_found_not_cached(self):
+        with HTTMock(entity_404):
+            with self.assertRaises(EntityNotFound):
+                self.cs.entity(SAMPLE_CHARM)
+        self.assertEqual(0, len(self.cache))
+
+
+class TestCharmStoreCoalescing(TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    @urlmatch(path=ID_PATH)
+    def slow_entity(self, url, request):
+        self.calls += 1
+        time.sleep(0.2)
+        return {'status_code': 200, 'content': {'Id': 'cs:precise/mysql-1'}}
+
+    def fetch_concurrently(self, cs, count=10):
+        results = []
+
+        def fetch():
+            results.append(cs.entity(SAMPLE_CHARM))
+
+        threads = [threading.Thread(target=fetch) for _ in range(count)]
+        with HTTMock(self.slow_entity):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_coalesced(self):
+        cs = CharmStore('http://example.com')
+        results = self.fetch_concurrently(cs)
+        self.assertEqual(1, self.calls)
+        self.assertEqual([{'Id': 'cs:precise/mysql-1'}] * 10, results)
+
+    def test_not_coalesced(self):
+        cs = CharmStore('http://example.com', coalesce=False)
+        self.fetch_concurrently(cs, count=3)
+        self.assertEqual(3, self.calls)
+
+    def test_errors_shared(self):
+        cs = CharmStore('http://example.com')
+        errors = []
+
+        @urlmatch(path=ID_PATH)
+        def slow_404(url, request):
+            self.calls += 1
+            time.sleep(0.2)
+            return {'status_code': 404}
+
+        def fetch():
+            try:
+                cs.entity(SAMPLE_CHARM)
+            except EntityNotFound as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        with HTTMock(slow_404):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, self.calls)
+        self.assertEqual(5, len(errors))
+
+
+class TestCharmStoreDownloadArchive(TestCase):
+
+    ARCHIVE = b'archive content ' * 1000
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.ranges = []
+        self.if_ranges = []
+        self.honor_range = True
+        self.sum = hashlib.sha256(self.ARCHIVE).hexdigest()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.dest = os.path.join(self.tempdir, 'mysql.zip')
+
+    @urlmatch(path='/{}/meta/hash256'.format(SAMPLE_CHARM))
+    def hash256(self, url, request):
+        return {'status_code': 200, 'content': {'Sum': self.sum}}
+
+    @urlmatch(path='/{}/archive'.format(SAMPLE_CHARM))
+    def archive(self, url, request):
+        header = request.headers.get('Range')
+        self.ranges.append(header)
+        self.if_ranges.append(request.headers.get('If-Range'))
+        headers = {'ETag': '"{}"'.format(self.sum)}
+        if header is None or not self.honor_range:
+            return {'status_code': 200, 'content': self.ARCHIVE,
+                    'headers': headers}
+        start = int(header[len('bytes='):-1])
+        if start >= len(self.ARCHIVE):
+            return {'status_code': 416, 'content': b'invalid range'}
+        return {'status_code': 206, 'content': self.ARCHIVE[start:],
+                'headers': headers}
+
+    def download(self, dest=None):
+        with HTTMock(self.hash256, self.archive):
+            return self.cs.download_archive(SAMPLE_CHARM, dest or self.dest,
+                                            chunk_size=1000)
+
+    def test_download_to_path(self):
+        self.assertEqual(self.sum, self.download())
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertEqual([None], self.ranges)
+
+    def test_download_to_file(self):
+        f = io.BytesIO()
+        self.assertEqual(self.sum, self.download(f))
+        self.assertEqual(self.ARCHIVE, f.getvalue())
+
+    def test_resume(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(self.ARCHIVE[:5000])
+        self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual(['bytes=5000-'], self.ranges)
+
+    def test_resume_with_validator(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(self.ARCHIVE[:5000])
+        with open(self.dest + '.part.info', 'w') as f:
+            json.dump({'Sum': self.sum, 'ETag': '"etag"'}, f)
+        self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual(['"etag"'], self.if_ranges)
+        self.assertFalse(os.path.exists(self.dest + '.part.info'))
+
+    def test_resume_other_archive(self):
+        # The partial file of another revision is not resumed.
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(b'other revision')
+        with open(self.dest + '.part.info', 'w') as f:
+            json.dump({'Sum': 'other', 'ETag': '"other"'}, f)
+        self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual([None], self.ranges)
+
+    def test_resume_part_too_long(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(self.ARCHIVE + b'trailing')
+        with patch('theblues.charmstore.logging.error'):
+            with patch('theblues.charmstore.logging.warning') as warning:
+                self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual(
+            ['bytes={}-'.format(len(self.ARCHIVE) + 8), None], self.ranges)
+        self.assertEqual(1, warning.call_count)
+
+    def test_resume_corrupt_part(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(b'x' * len(self.ARCHIVE))
+        with patch('theblues.charmstore.logging.error'):
+            with patch('theblues.charmstore.logging.warning'):
+                self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual(
+            ['bytes={}-'.format(len(self.ARCHIVE)), None], self.ranges)
+
+    def test_resume_corrupt_prefix(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(b'x' * 5000)
+        with patch('theblues.charmstore.logging.error'):
+            with patch('theblues.charmstore.logging.warning'):
+                self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+        self.assertEqual(['bytes=5000-', None], self.ranges)
+
+    def test_resume_range_ignored(self):
+        self.honor_range = False
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(self.ARCHIVE[:5000])
+        self.download()
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(self.ARCHIVE, f.read())
+
+    def test_already_complete(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(self.ARCHIVE)
+        self.download()
+        self.assertEqual([], self.ranges)
+        self.assertTrue(os.path.exists(self.dest))
+
+    def test_hash_mismatch(self):
+        self.sum = hashlib.sha256(b'something else').hexdigest()
+        with patch('theblues.charmstore.logging.error') as log_mocked:
+            with self.assertRaises(ServerError) as cm:
+                self.download()
+        self.assertIn('Invalid archive hash', cm.exception.args[0])
+        self.assertEqual(1, log_mocked.call_count)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_not_found(self):
+        @urlmatch(path='/{}/meta/hash256'.format(SAMPLE_CHARM))
+        def hash256_404(url, request):
+            return {'status_code': 404}
+
+        with HTTMock(hash256_404):
+            with self.assertRaises(EntityNotFound):
+                self.cs.download_archive(SAMPLE_CHARM, self.dest)
+
+
+class TestCharmStoreArchive(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.urls = []
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as zf:
+            zf.writestr('metadata.yaml', b'name: mysql\n')
+            zf.writestr('config.yaml', b'options: {}\n')
+            zf.writestr('hooks/', b'')
+            zf.writestr('hooks/install', b'#!/bin/sh\n')
+        self.content = content.getvalue()
+
+    @urlmatch(netloc='example.com')
+    def charmstore(self, url, request):
+        self.urls.append(url.path)
+        if url.path == '/{}/meta/hash256'.format(SAMPLE_CHARM):
+            content = {'Sum': hashlib.sha256(self.content).hexdigest()}
+            return {'status_code': 200, 'content': content}
+        if url.path == '/{}/archive'.format(SAMPLE_CHARM):
+            return {'status_code': 200, 'content': self.content}
+        return {'status_code': 404}
+
+    def test_read_files_from_archive(self):
+        with HTTMock(self.charmstore):
+            metadata = self.cs.files(SAMPLE_CHARM, filename='metadata.yaml',
+                                     read_file=True, from_archive=True)
+            config = self.cs.files(SAMPLE_CHARM, filename='config.yaml',
+                                   read_file=True, from_archive=True)
+        self.assertEqual('name: mysql\n', metadata)
+        self.assertEqual('options: {}\n', config)
+        self.assertEqual(
+            ['/precise/mysql-1/meta/hash256', '/precise/mysql-1/archive'],
+            self.urls)
+
+    def test_list_files_from_archive(self):
+        with HTTMock(self.charmstore):
+            files = self.cs.files(SAMPLE_CHARM, from_archive=True)
+        self.assertEqual(['config.yaml', 'hooks/install', 'metadata.yaml'],
+                         sorted(files))
+        self.assertEqual(
+            'http://example.com/precise/mysql-1/archive/hooks/install',
+            files['hooks/install'])
+
+    def test_missing_file_from_archive(self):
+        with HTTMock(self.charmstore):
+            with self.assertRaises(EntityNotFound):
+                self.cs.files(SAMPLE_CHARM, filename='actions.yaml',
+                              read_file=True, from_archive=True)
+
+    def test_archive_bytes(self):
+        with HTTMock(self.charmstore):
+            archive = self.cs.archive(SAMPLE_CHARM)
+        self.assertEqual(b'#!/bin/sh\n', archive.read('hooks/install'))
+
+    def test_archive_cache_bounded(self):
+        self.cs = CharmStore('http://example.com',
+                             archive_cache=ArchiveCache(max_entries=0))
+        with HTTMock(self.charmstore):
+            self.cs.archive(SAMPLE_CHARM)
+            self.cs.archive(SAMPLE_CHARM)
+        self.assertEqual(4, len(self.urls))
+
+
+class TestCharmStoreIterPages(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.entities = [{'Id': 'cs:charm-{}'.format(i)} for i in range(25)]
+        self.queries = []
+        self.paging = True
+
+    @urlmatch(path='({})|({})'.format(SEARCH_PATH, LIST_PATH))
+    def charmstore(self, url, request):
+        query = parse_qs(url.query)
+        self.queries.append(query)
+        results = self.entities
+        if self.paging and 'limit' in query:
+            skip = int(query.get('skip', ['0'])[0])
+            results = results[skip:skip + int(query['limit'][0])]
+        return {'status_code': 200, 'content': {'Results': results}}
+
+    def test_iter_search(self):
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_search('foo', page_size=10))
+        self.assertEqual(self.entities, results)
+        self.assertEqual(
+            [(['10'], ['0']), (['10'], ['10']), (['10'], ['20'])],
+            [(q['limit'], q['skip']) for q in self.queries])
+        self.assertEqual(['foo'], self.queries[0]['text'])
+
+    def test_iter_search_lazy(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.iter_search('foo', page_size=10)
+            self.assertEqual(self.entities[0], next(results))
+        self.assertEqual(1, len(self.queries))
+
+    def test_iter_search_limit(self):
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_search('foo', limit=15, page_size=10))
+        self.assertEqual(self.entities[:15], results)
+        self.assertEqual(['5'], self.queries[-1]['limit'])
+
+    def test_iter_search_exact_pages(self):
+        self.entities = self.entities[:20]
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_search('foo', page_size=10))
+        self.assertEqual(self.entities, results)
+        self.assertEqual(3, len(self.queries))
+
+    def test_iter_list(self):
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_list(
+                includes=['id'], owner='hatch', page_size=10))
+        self.assertEqual(self.entities, results)
+        self.assertEqual(3, len(self.queries))
+        self.assertEqual(['hatch'], self.queries[0]['owner'])
+
+    def test_paging_ignored(self):
+        self.paging = False
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_list(page_size=10))
+        self.assertEqual(self.entities, results)
+        self.assertEqual(1, len(self.queries))
+
+    def test_skip_ignored(self):
+        self.entities = self.entities[:3]
+        self.paging = False
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_list(page_size=3))
+        self.assertEqual(self.entities, results)
+        self.assertEqual(2, len(self.queries))
+
+    def test_only_limit_honored(self):
+        @urlmatch(path=LIST_PATH)
+        def limit_only(url, request):
+            self.queries.append(url.query)
+            limit = int(parse_qs(url.query)['limit'][0])
+            return {'status_code': 200,
+                    'content': {'Results': self.entities[:limit]}}
+
+        with HTTMock(limit_only):
+            results = list(self.cs.iter_list(page_size=10))
+        self.assertEqual(self.entities[:10], results)
+        self.assertEqual(2, len(self.queries))
+
+    def test_paging_ignored_limit(self):
+        self.paging = False
+        with HTTMock(self.charmstore):
+            results = list(self.cs.iter_search('', limit=5, page_size=10))
+        self.assertEqual(self.entities[:5], results)
+
+
+class TestCharmStoreStreamResults(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.entities = [{'Id': 'cs:charm-{}'.format(i)} for i in range(50)]
+
+    @urlmatch(path='({})|({})'.format(SEARCH_PATH, LIST_PATH))
+    def charmstore(self, url, request):
+        return {'status_code': 200, 'content': {'Results': self.entities}}
+
+    def test_list_stream(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.list(includes=['id'], stream=True)
+            self.assertNotIsInstance(results, list)
+            self.assertEqual(self.entities, list(results))
+
+    def test_search_stream(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.search('foo', stream=True)
+            self.assertEqual(self.entities, list(results))
+
+    def test_stream_not_cached(self):
+        self.cs = CharmStore('http://example.com', cache=MemoryCache())
+        with HTTMock(self.charmstore):
+            list(self.cs.list(stream=True))
+        self.assertEqual(0, len(self.cs.cache))
+
+    def test_stream_error(self):
+        with HTTMock(search_400):
+            with patch('theblues.charmstore.logging.error'):
+                with self.assertRaises(ServerError) as cm:
+                    list(self.cs.search('foo', stream=True))
+        self.assertEqual(400, cm.exception.args[0])
+
+
+class TestCharmStoreRecords(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com')
+        self.entities = [
+            {'Id': 'cs:~hatch/xenial/charm-{}'.format(i),
+             'Meta': {'stats': {'ArchiveDownloadCount': i}}}
+            for i in range(5)]
+
+    @urlmatch(path='({})|({})'.format(SEARCH_PATH, LIST_PATH))
+    def charmstore(self, url, request):
+        return {'status_code': 200, 'content': {'Results': self.entities}}
+
+    @urlmatch(path='/meta/any')
+    def related(self, url, request):
+        return {'status_code': 200, 'content': dict(
+            (e['Id'], e) for e in self.entities)}
+
+    def test_search_records(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.search('foo', records=True)
+        self.assertEqual([Entity.from_dict(e) for e in self.entities],
+                         results)
+        self.assertEqual('hatch', results[0].owner)
+        self.assertEqual({'stats': {'ArchiveDownloadCount': 4}},
+                         results[4].meta)
+
+    def test_list_records(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.list(records=True)
+            streamed = list(self.cs.list(records=True, stream=True))
+            paged = list(self.cs.iter_list(records=True))
+        expected = [Entity.from_dict(e) for e in self.entities]
+        self.assertEqual(expected, results)
+        self.assertEqual(expected, streamed)
+        self.assertEqual(expected, paged)
+
+    def test_fetch_related_records(self):
+        with HTTMock(self.related):
+            results = self.cs.fetch_related(self.entities, records=True)
+        self.assertEqual(
+            sorted(e['Id'] for e in self.entities),
+            sorted(r.id for r in results))
+
+    def test_fetch_interfaces_records(self):
+        with HTTMock(self.charmstore):
+            results = self.cs.fetch_interfaces('mysql', 'requires',
+                                               records=True)
+        self.assertEqual([Entity.from_dict(e) for e in self.entities],
+                         results)
+
+
+class TestCharmStoreFetchInterfaces(TestCase):
+
+    def setUp(self):
+        self.queries = []
+
+    @urlmatch(path=SEARCH_PATH)
+    def search(self, url, request):
+        query = parse_qs(url.query)
+        self.queries.append(query)
+        interface = (query.get('requires') or query.get('provides'))[0]
+        return {'status_code': 200, 'content': {
+            'Results': [{'Id': 'cs:{}-user-1'.format(interface)}]}}
+
+    def index(self):
+        return InterfaceIndex([{'Id': 'cs:mysql-1', 'Meta': {
+            'charm-metadata': {'Provides': {'db': {'Interface': 'mysql'}}}}}])
+
+    def test_fetch_interfaces_from_index(self):
+        cs = CharmStore('http://example.com', interface_index=self.index())
+        with HTTMock(self.search):
+            results = cs.fetch_interfaces('mysql', 'provides')
+        self.assertEqual([[{'Id': 'cs:mysql-1', 'Meta': {
+            'charm-metadata': {'Provides': {'db': {'Interface': 'mysql'}}}}}]],
+            list(results))
+        self.assertEqual([], self.queries)
+
+    def test_fetch_interfaces_batch(self):
+        cs = CharmStore('http://example.com')
+        with HTTMock(self.search):
+            results = cs.fetch_interfaces_batch(
+                ['mysql', 'http', 'mysql', ''], 'requires')
+        self.assertEqual({
+            'mysql': [{'Id': 'cs:mysql-user-1'}],
+            'http': [{'Id': 'cs:http-user-1'}],
+        }, results)
+        self.assertEqual(2, len(self.queries))
+
+    def test_fetch_interfaces_batch_from_index(self):
+        cs = CharmStore('http://example.com', interface_index=self.index())
+        with HTTMock(self.search):
+            results = cs.fetch_interfaces_batch(
+                ['mysql', 'http'], 'provides', records=True)
+        self.assertEqual(['cs:mysql-1'], [r.id for r in results['mysql']])
+        self.assertEqual([], results['http'])
+        self.assertEqual([], self.queries)
+
+    def test_fetch_interfaces_records_from_record_index(self):
+        index = InterfaceIndex([
+            Entity.from_dict(c) for c in self.index().charms(
+                'mysql', 'provides')])
+        cs = CharmStore('http://example.com', interface_index=index)
+        results = cs.fetch_interfaces('mysql', 'provides', records=True)
+        self.assertEqual(['cs:mysql-1'], [r.id for r in results])
+        results = cs.fetch_interfaces_batch(
+            ['mysql'], 'provides', records=True)
+        self.assertEqual(['cs:mysql-1'], [r.id for r in results['mysql']])
+
+
+class TestCharmStoreIcons(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.cs = CharmStore('http://example.com',
+                             blob_cache=BlobCache(self.tempdir))
+        self.paths = []
+
+    @urlmatch(netloc='example.com')
+    def icons(self, url, request):
+        self.paths.append(url.path)
+        if url.path.startswith('/missing'):
+            return {'status_code': 404}
+        return {'status_code': 200, 'content': b'<svg>' + url.path.encode()}
+
+    def test_charm_icon_cached(self):
+        with HTTMock(self.icons):
+            self.cs.charm_icon(SAMPLE_CHARM)
+            icon = self.cs.charm_icon(SAMPLE_CHARM)
+        self.assertEqual(b'<svg>/precise/mysql-1/icon.svg', icon)
+        self.assertEqual(1, len(self.paths))
+
+    def test_bundle_visualization_cached(self):
+        with HTTMock(self.icons):
+            self.cs.bundle_visualization(SAMPLE_BUNDLE)
+            diagram = self.cs.bundle_visualization(SAMPLE_BUNDLE)
+        self.assertEqual(b'<svg>/mongodb-cluster/diagram.svg', diagram)
+        self.assertEqual(1, len(self.paths))
+
+    def test_charm_icons(self):
+        ids = ['precise/charm-{}'.format(i) for i in range(10)]
+        with HTTMock(self.icons):
+            self.cs.charm_icon(ids[0])
+            icons = self.cs.charm_icons(ids + ids[:2])
+        self.assertEqual(sorted(ids), sorted(icons))
+        self.assertEqual(b'<svg>/precise/charm-3/icon.svg',
+                         icons['precise/charm-3'])
+        self.assertEqual(10, len(self.paths))
+
+    def test_charm_icons_errors(self):
+        with HTTMock(self.icons):
+            with self.assertRaises(BulkFetchError) as cm:
+                self.cs.charm_icons(['precise/mysql-1', 'missing-1'])
+        self.assertEqual(['precise/mysql-1'], list(cm.exception.results))
+        self.assertIsInstance(
+            cm.exception.errors['missing-1'], EntityNotFound)
+
+
+class TestCharmStoreRetry(TestCase):
+
+    def setUp(self):
+        self.statuses = [503, 200]
+        self.calls = 0
+
+    @urlmatch(path=ID_PATH)
+    def flaky(self, url, request):
+        self.calls += 1
+        status = self.statuses.pop(0)
+        return {'status_code': status, 'content': {'Id': SAMPLE_CHARM_ID}}
+
+    def test_retried(self):
+        cs = CharmStore('http://example.com', retry=RetryPolicy(
+            sleep=lambda delay: None))
+        with HTTMock(self.flaky):
+            with patch('theblues.retry.log'):
+                data = cs.entity(SAMPLE_CHARM)
+        self.assertEqual({'Id': SAMPLE_CHARM_ID}, data)
+        self.assertEqual(2, self.calls)
+
+    def test_not_retried_by_default(self):
+        cs = CharmStore('http://example.com')
+        with HTTMock(self.flaky):
+            with patch('theblues.charmstore.logging.error'):
+                with self.assertRaises(ServerError):
+                    cs.entity(SAMPLE_CHARM)
+        self.assertEqual(1, self.calls)
+
+    def test_hedged(self):
+        hedge = HedgePolicy()
+        self.addCleanup(hedge.close)
+        cs = CharmStore('http://example.com', hedge=hedge)
+        self.statuses = [200]
+        with HTTMock(self.flaky):
+            data = cs.entity(SAMPLE_CHARM)
+        self.assertEqual({'Id': SAMPLE_CHARM_ID}, data)
+        self.assertEqual(0, hedge.hedged)
+
+
+class TestCharmStoreCircuitBreaker(TestCase):
+
+    def test_fail_fast(self):
+        calls = []
+
+        @urlmatch(path=ID_PATH)
+        def unavailable(url, request):
+            calls.append(url)
+            return {'status_code': 503, 'content': b'unavailable'}
+
+        cs = CharmStore('http://example.com',
+                        circuit_breakers=CircuitBreakerRegistry(
+                            failure_threshold=1))
+        with HTTMock(unavailable):
+            with patch('theblues.charmstore.logging.error'):
+                with patch('theblues.circuitbreaker.log'):
+                    with self.assertRaises(ServerError):
+                        cs.entity(SAMPLE_CHARM)
+                    with self.assertRaises(CircuitOpenError):
+                        cs.entity(SAMPLE_CHARM)
+        self.assertEqual(1, len(calls))
+
+
+class TestCharmStoreMapEntities(TestCase):
+
+    def setUp(self):
+        self.cs = CharmStore('http://example.com', cache=MemoryCache())
+        self.requests = []
+
+    def handler(self, url, request):
+        path = url.path.split('/meta/any')[0].lstrip('/')
+        self.requests.append(path)
+        if path.startswith('missing'):
+            return {'status_code': 404}
+        if path.startswith('broken'):
+            return {'status_code': 500, 'content': b'boom'}
+        time.sleep(0.01 * (path.count('a') % 3))
+        return {
+            'status_code': 200,
+            'content': {'Id': 'cs:' + path, 'Meta': {}},
+        }
+
+    def test_order_and_errors(self):
+        ids = ['xenial/mysql-1', 'missing-2', 'trusty/django-3',
+               'broken-4', references.Reference.from_string('cs:wiki-5')]
+        with HTTMock(urlmatch(path=ID_PATH)(self.handler)):
+            with patch('theblues.charmstore.logging.error'):
+                results = self.cs.map_entities(ids, workers=3)
+        self.assertEqual(ids, [result.id for result in results])
+        self.assertEqual(
+            ['cs:xenial/mysql-1', None, 'cs:trusty/django-3', None,
+             'cs:wiki-5'],
+            [result.entity and result.entity['Id'] for result in results])
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, EntityNotFound)
+        self.assertIsInstance(results[3].error, ServerError)
+
+    def test_includes_and_cache(self):
+        ids = ['xenial/mysql-1', 'xenial/mysql-1', 'trusty/django-3']
+        with HTTMock(urlmatch(path=ID_PATH)(self.handler)):
+            self.cs.map_entities(ids[1:], includes=['owner'])
+            results = self.cs.map_entities(ids, includes=['owner'])
+        self.assertEqual([None] * 3, [result.error for result in results])
+        self.assertEqual(
+            ['trusty/django-3', 'xenial/mysql-1'], sorted(self.requests))
+
+    def test_shares_entity_cache(self):
+        with HTTMock(urlmatch(path=ID_PATH)(self.handler)):
+            entity = self.cs.entity('xenial/mysql-1')
+            results = self.cs.map_entities(['xenial/mysql-1'])
+        self.assertEqual(entity, results[0].entity)
+        self.assertEqual(['xenial/mysql-1'], self.requests)
+
+    def test_empty(self):
+        self.assertEqual([], self.cs.map_entities([]))
+
+    def test_pool_size(self):
+        cs = CharmStore('http://example.com', pool_maxsize=32)
+        self.assertEqual(
+            32, cs.session.get_adapter('http://example.com')._pool_maxsize)
+
+
+class TestCharmStoreRateLimit(TestCase):
+
+    def test_limit(self):
+        calls = []
+
+        @urlmatch(path=ID_PATH)
+        def entity(url, request):
+            calls.append(url)
+            return entity_200(url, request)
+
+        registry = RateLimiterRegistry(rate=1, burst=1, blocking=False)
+        cs = CharmStore('http://example.com', rate_limits=registry)
+        with HTTMock(entity):
+            cs.entity(SAMPLE_CHARM)
+            with self.assertRaises(RateLimitError):
+                cs.entity(SAMPLE_CHARM)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, registry.stats()['example.com'].rejected)
+
+    def test_hedged_throttle_reported(self):
+        collector = Collector()
+        tracer = Tracer()
+        cs = CharmStore(
+            'http://example.com', hedge=HedgePolicy(),
+            rate_limits=RateLimiterRegistry(rate=10, burst=1),
+            instrumentation=collector)
+        with HTTMock(entity_200):
+            cs.entity(SAMPLE_CHARM)
+            cs.entity('precise/wordpress-1')
+        operations = collector.operations()
+        self.assertNotIn('unknown', operations)
+        self.assertGreater(operations['charmstore.entity'].throttle_wait, 0)
+        cs = CharmStore(
+            'http://example.com', hedge=HedgePolicy(),
+            rate_limits=RateLimiterRegistry(rate=10, burst=1),
+            instrumentation=tracer)
+        with HTTMock(entity_200):
+            cs.entity(SAMPLE_CHARM)
+            cs.entity('precise/wordpress-1')
+        attributes = [span.attributes for span in tracer.exporter.spans]
+        self.assertTrue(any('ratelimit.wait' in a for a in attributes))
+
+
+class TestCharmStoreAuthCache(TestCase):
+
+    def test_cached_auth(self):
+        auth_cache = MagicMock()
+
+        def authorize(request):
+            request.headers['Cookie'] = 'macaroon-store=cached'
+            return request
+
+        auth_cache.auth.return_value = authorize
+        cookies = []
+
+        @urlmatch(path=ID_PATH)
+        def entity(url, request):
+            cookies.append(request.headers.get('Cookie'))
+            return entity_200(url, request)
+
+        client = MagicMock()
+        cs = CharmStore(
+            'http://example.com', client=client, auth_cache=auth_cache)
+        with HTTMock(entity):
+            cs.entity(SAMPLE_CHARM)
+        self.assertEqual(['macaroon-store=cached'], cookies)
+        self.assertEqual(client, auth_cache.auth.call_args[0][0])
+        self.assertIn('/meta/any', auth_cache.auth.call_args[0][1])
+        self.assertFalse(client.auth.called)
+
+
+class TestCharmStoreInstrumentation(TestCase):
+
+    def setUp(self):
+        self.collector = Collector()
+        self.cs = CharmStore(
+            'http://example.com', cache=MemoryCache(),
+            instrumentation=self.collector)
+
+    def test_entity(self):
+        with HTTMock(entity_200):
+            self.cs.entity(SAMPLE_CHARM)
+            self.cs.entity(SAMPLE_CHARM)
+        stats = self.collector.operations()['charmstore.entity']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual({200: 1}, stats.statuses)
+        self.assertGreater(stats.bytes, 0)
+        self.assertEqual({'hit': 1, 'miss': 1}, stats.cache)
+        latency, decode, size = self.collector.histograms(
+            'charmstore.entity')
+        self.assertEqual(2, decode.count)
+
+    def test_nested_operation(self):
+        with HTTMock(entity_200):
+            self.cs.charm(SAMPLE_CHARM)
+        self.assertEqual(['charmstore.charm'],
+                         list(self.collector.operations()))
+
+    def test_error(self):
+        with HTTMock(entity_404):
+            with self.assertRaises(EntityNotFound):
+                self.cs.entity(SAMPLE_CHARM)
+        stats = self.collector.operations()['charmstore.entity']
+        self.assertEqual(1, stats.errors)
+        self.assertEqual({404: 1}, stats.statuses)
+
+    def test_streamed_list(self):
+        with HTTMock(list_200):
+            list(self.cs.list(stream=True))
+        stats = self.collector.operations()['charmstore.list']
+        self.assertEqual(1, stats.requests)
+
+    def test_concurrent_entities(self):
+        with HTTMock(entity_200):
+            self.cs.entities(
+                ['foo-{}'.format(i) for i in range(10)],
+                max_url_length=60)
+        stats = self.collector.operations()['charmstore.entities']
+        self.assertGreater(stats.requests, 1)
+        self.assertEqual(['charmstore.entities'],
+                         list(self.collector.operations()))
+
+
+class TestCharmStoreTracing(TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer()
+        self.cs = CharmStore(
+            'http://example.com', cache=MemoryCache(),
+            instrumentation=self.tracer)
+
+    def spans(self, name):
+        return [span for span in self.tracer.exporter.spans
+                if span.name == name]
+
+    def test_entity(self):
+        with HTTMock(entity_200):
+            with self.tracer.span('deploy') as deploy:
+                self.cs.charm(SAMPLE_CHARM)
+                self.cs.entity(SAMPLE_CHARM, get_files=True)
+        charm, = self.spans('charmstore.charm')
+        entity, = self.spans('charmstore.entity')
+        request, = self.spans('HTTP GET')
+        self.assertEqual(deploy.span_id, charm.parent_id)
+        self.assertEqual(deploy.span_id, entity.parent_id)
+        self.assertEqual(charm.span_id, request.parent_id)
+        self.assertEqual(200, request.attributes['http.status_code'])
+        self.assertEqual(
+            'http://example.com/{}/meta/any?include={}',
+            request.attributes['http.url_template'])
+        self.assertEqual(1, charm.attributes['cache.misses'])
+        self.assertEqual(1, entity.attributes['cache.hits'])
+        self.assertIn('json.decode_time', entity.attributes)
+
+    def test_error(self):
+        with HTTMock(entity_404):
+            with self.assertRaises(EntityNotFound):
+                self.cs.entity(SAMPLE_CHARM)
+        entity, = self.spans('charmstore.entity')
+        self.assertTrue(entity.error.startswith('EntityNotFound'))
+
+    def test_concurrent_entities(self):
+        with HTTMock(entity_200):
+            self.cs.entities(
+                ['foo-{}'.format(i) for i in range(10)],
+                max_url_length=60)
+        entities, = self.spans('charmstore.entities')
+        requests = self.spans('HTTP GET')
+        self.assertGreater(len(requests), 1)
+        for request in requests:
+            self.assertEqual(entities.span_id, request.parent_id)
+
+    def test_streamed_list(self):
+        with HTTMock(list_200):
+            results = self.cs.list(stream=True)
+            self.assertEqual([], self.spans('charmstore.list'))
+            list(results)
+        span, = self.spans('charmstore.list')
+        request, = self.spans('HTTP GET')
+        self.assertEqual(span.span_id, request.parent_id)
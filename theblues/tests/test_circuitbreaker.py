@@ -0,0 +1,141 @@
+from unittest import TestCase
+
+import mock
+import requests
+from requests.exceptions import ConnectionError
+
+from theblues.circuitbreaker import (
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+)
+from theblues.errors import (
+    CircuitOpenError,
+    ServerError,
+)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_response(status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+def fail():
+    raise ConnectionError('connection refused')
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            'example.com', failure_threshold=3, reset_timeout=10,
+            clock=self.clock)
+        patcher = mock.patch('theblues.circuitbreaker.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fail(self, count):
+        for _ in range(count):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(fail)
+
+    def test_closed(self):
+        response = self.breaker.call(make_response)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.call(make_response)
+        self.fail(2)
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.fail(1)
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            self.breaker.call(make_response)
+        self.assertEqual('example.com', ctx.exception.host)
+        self.assertIsInstance(ctx.exception, ServerError)
+
+    def test_server_errors_are_failures(self):
+        for _ in range(3):
+            response = self.breaker.call(lambda: make_response(503))
+            self.assertEqual(503, response.status_code)
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_client_errors_are_successes(self):
+        for _ in range(5):
+            self.breaker.call(lambda: make_response(404))
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_other_errors_ignored(self):
+        def error():
+            raise ValueError('bad wolf')
+        for _ in range(5):
+            with self.assertRaises(ValueError):
+                self.breaker.call(error)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_half_open_probe_success(self):
+        self.fail(3)
+        self.clock.now += 10
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.breaker.call(make_response)
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.stats().failures)
+
+    def test_half_open_probe_failure(self):
+        self.fail(3)
+        self.clock.now += 10
+        self.fail(1)
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertEqual(self.clock.now, self.breaker.stats().opened_at)
+
+    def test_half_open_limits_probes(self):
+        self.fail(3)
+        self.clock.now += 10
+
+        def probe():
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.call(make_response)
+            return make_response()
+
+        self.breaker.call(probe)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_reset(self):
+        self.fail(3)
+        self.breaker.reset()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+
+class TestCircuitBreakerRegistry(TestCase):
+
+    def test_per_host(self):
+        registry = CircuitBreakerRegistry(failure_threshold=1)
+        breaker = registry.for_url('https://plans.example.com/v2/wallet')
+        self.assertIs(breaker, registry.get('plans.example.com'))
+        self.assertIsNot(breaker, registry.get('terms.example.com'))
+        self.assertEqual(1, breaker.failure_threshold)
+
+    def test_states(self):
+        registry = CircuitBreakerRegistry(failure_threshold=1)
+        with mock.patch('theblues.circuitbreaker.log'):
+            with self.assertRaises(ConnectionError):
+                registry.get('a.example.com').call(fail)
+        registry.get('b.example.com')
+        states = registry.states()
+        self.assertEqual(OPEN, states['a.example.com'].state)
+        self.assertEqual(CLOSED, states['b.example.com'].state)
@@ -0,0 +1,339 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import requests
+
+from theblues.charmstore import CharmStore
+from theblues.errors import (
+    EntityNotFound,
+    ServerError,
+)
+from theblues.fakestore import (
+    constant,
+    exponential,
+    FakeCharmStore,
+    Fault,
+    Fixtures,
+    lognormal,
+    RESET,
+    uniform,
+)
+from theblues.retry import RetryPolicy
+
+
+README = b'# MySQL\n\nA database.\n'
+ICON = b'<svg>mysql</svg>'
+DIAGRAM = b'<svg>wiki</svg>'
+
+
+def make_fixtures():
+    fixtures = Fixtures()
+    for revision in (57, 58):
+        fixtures.add(
+            'cs:xenial/mysql-{}'.format(revision),
+            {'charm-metadata': {'Name': 'mysql', 'Summary': 'MySQL server',
+                                'Tags': ['databases'],
+                                'Provides': {'db': {'Interface': 'mysql'}}},
+             'owner': {'User': 'mysql-charmers'},
+             'promulgated': {'Promulgated': True},
+             'extra-info': {'revision': revision}},
+            {'README.md': README, 'icon.svg': ICON,
+             'hooks/install': b'#!/bin/sh\n'})
+    fixtures.add(
+        'cs:~hatch/bionic/mariadb-1',
+        {'charm-metadata': {'Name': 'mariadb', 'Summary': 'MariaDB server',
+                            'Tags': ['databases'],
+                            'Provides': {'db': {'Interface': 'mysql'}},
+                            'Requires': {'cache': {'Interface': 'memcache'}}},
+         'owner': {'User': 'hatch'}})
+    fixtures.add(
+        'cs:bundle/wiki-simple-3',
+        {'bundle-metadata': {'Tags': ['wiki']},
+         'owner': {'User': 'charmers'},
+         'promulgated': {'Promulgated': True}},
+        {'README.md': b'wiki'}, diagram=DIAGRAM)
+    return fixtures
+
+
+class TestFixtures(TestCase):
+
+    def setUp(self):
+        self.fixtures = make_fixtures()
+
+    def test_get(self):
+        entity = self.fixtures.get('cs:xenial/mysql-57')
+        self.assertEqual('cs:xenial/mysql-57', entity.id)
+        self.assertEqual(57, entity.meta['extra-info']['revision'])
+
+    def test_get_latest_revision(self):
+        self.assertEqual(
+            'cs:xenial/mysql-58', self.fixtures.get('mysql').id)
+        self.assertEqual(
+            'cs:xenial/mysql-58', self.fixtures.get('xenial/mysql').id)
+        self.assertEqual(
+            'cs:~hatch/bionic/mariadb-1',
+            self.fixtures.get('~hatch/mariadb').id)
+
+    def test_get_not_found(self):
+        with self.assertRaises(EntityNotFound):
+            self.fixtures.get('trusty/mysql')
+        with self.assertRaises(EntityNotFound):
+            self.fixtures.get('~other/mariadb')
+
+    def test_contains(self):
+        self.assertEqual(4, len(self.fixtures))
+        self.assertIn('cs:xenial/mysql-57', self.fixtures)
+        self.assertNotIn('cs:xenial/mysql-1', self.fixtures)
+
+    def test_from_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        root = os.path.join(directory, '~hatch', 'xenial', 'mysql-1')
+        os.makedirs(os.path.join(root, 'archive', 'hooks'))
+        with open(os.path.join(root, 'meta.json'), 'w') as f:
+            json.dump({'owner': {'User': 'hatch'}}, f)
+        with open(os.path.join(root, 'archive', 'README.md'), 'wb') as f:
+            f.write(README)
+        with open(os.path.join(root, 'archive', 'hooks', 'start'), 'wb') as f:
+            f.write(b'start')
+        fixtures = Fixtures.from_directory(directory)
+        entity = fixtures.get('cs:~hatch/xenial/mysql-1')
+        self.assertEqual({'owner': {'User': 'hatch'}}, entity.meta)
+        self.assertEqual(
+            {'README.md': README, 'hooks/start': b'start'}, entity.files)
+        self.assertIsNone(entity.diagram)
+
+
+class TestLatencies(TestCase):
+
+    def test_distributions(self):
+        rng = random.Random(0)
+        self.assertEqual(0.5, constant(0.5)(rng))
+        for _ in range(100):
+            self.assertTrue(0.1 <= uniform(0.1, 0.2)(rng) <= 0.2)
+            self.assertTrue(exponential(0.1)(rng) >= 0)
+        values = sorted(lognormal(0.02, 0.5)(rng) for _ in range(1001))
+        self.assertAlmostEqual(0.02, values[500], delta=0.003)
+
+
+class TestFakeCharmStore(TestCase):
+
+    def start(self, **kwargs):
+        store = FakeCharmStore(make_fixtures(), **kwargs)
+        store.start()
+        self.addCleanup(store.stop)
+        return store
+
+    def setUp(self):
+        self.store = self.start()
+        self.cs = CharmStore(self.store.url, timeout=10)
+
+    def test_url_not_running(self):
+        with self.assertRaises(RuntimeError):
+            FakeCharmStore(Fixtures()).url
+
+    def test_entity(self):
+        data = self.cs.entity('xenial/mysql-57')
+        self.assertEqual('cs:xenial/mysql-57', data['Id'])
+        self.assertEqual(
+            {'User': 'mysql-charmers'}, data['Meta']['owner'])
+        self.assertNotIn('promulgated', data['Meta'])
+
+    def test_entity_latest(self):
+        self.assertEqual('cs:xenial/mysql-58', self.cs.entity('mysql')['Id'])
+
+    def test_entity_not_found(self):
+        with self.assertRaises(EntityNotFound):
+            self.cs.entity('trusty/mysql')
+
+    def test_entities(self):
+        data = self.cs.entities(
+            ['xenial/mysql-57', 'bundle/wiki-simple-3', 'trusty/mysql'])
+        self.assertEqual(
+            ['bundle/wiki-simple-3', 'xenial/mysql-57'], sorted(data))
+        self.assertEqual(
+            'cs:bundle/wiki-simple-3', data['bundle/wiki-simple-3']['Id'])
+
+    def test_search(self):
+        results = self.cs.search('mysql')
+        self.assertEqual(
+            ['cs:xenial/mysql-57', 'cs:xenial/mysql-58'],
+            sorted(r['Id'] for r in results))
+        results = self.cs.search(
+            'server', owner='hatch', includes=['owner'])
+        self.assertEqual(
+            [{'Id': 'cs:~hatch/bionic/mariadb-1',
+              'Meta': {'owner': {'User': 'hatch'}}}], results)
+
+    def test_search_autocomplete_limit(self):
+        results = self.cs.search('mari', autocomplete=True)
+        self.assertEqual(['cs:~hatch/bionic/mariadb-1'],
+                         [r['Id'] for r in results])
+        self.assertEqual(1, len(self.cs.search('server', limit=1)))
+
+    def test_search_invalid_sort(self):
+        with self.assertRaises(ServerError):
+            self.cs.search('mysql', sort='color')
+
+    def test_fetch_interfaces(self):
+        results = self.cs.fetch_interfaces('mysql', 'provides')
+        self.assertEqual(
+            ['cs:xenial/mysql-57', 'cs:xenial/mysql-58',
+             'cs:~hatch/bionic/mariadb-1'],
+            sorted(r['Id'] for r in list(results)[0]))
+        results = self.cs.fetch_interfaces('memcache', 'requires')
+        self.assertEqual(['cs:~hatch/bionic/mariadb-1'],
+                         [r['Id'] for r in list(results)[0]])
+        self.assertEqual(
+            [[]], list(self.cs.fetch_interfaces('mysql', 'requires')))
+
+    def test_list(self):
+        results = self.cs.list(doc_type='bundle')
+        self.assertEqual(['cs:bundle/wiki-simple-3'],
+                         [r['Id'] for r in results])
+        results = self.cs.list(promulgated_only=True)
+        self.assertEqual(3, len(results))
+
+    def test_iter_list_pages(self):
+        results = list(self.cs.iter_list(page_size=1))
+        self.assertEqual(4, len(results))
+        self.assertEqual(4, len(set(r['Id'] for r in results)))
+
+    def test_files(self):
+        self.assertEqual(
+            README.decode('utf-8'),
+            self.cs.files('xenial/mysql-57', filename='README.md',
+                          read_file=True))
+        files = self.cs.files('xenial/mysql-57')
+        self.assertEqual(
+            ['README.md', 'hooks/install', 'icon.svg'], sorted(files))
+
+    def test_archive(self):
+        archive = self.cs.archive('xenial/mysql-57')
+        self.assertEqual(README, archive.read('README.md'))
+        self.assertEqual(
+            ['README.md', 'hooks/install', 'icon.svg'],
+            sorted(archive.names()))
+
+    def test_icon_readme_diagram(self):
+        self.assertEqual(ICON, self.cs.charm_icon('xenial/mysql-57'))
+        self.assertEqual(
+            README.decode('utf-8'),
+            self.cs.entity_readme_content('xenial/mysql-57'))
+        self.assertEqual(
+            DIAGRAM, self.cs.bundle_visualization('bundle/wiki-simple-3'))
+        with self.assertRaises(EntityNotFound):
+            self.cs.charm_icon('~hatch/bionic/mariadb-1')
+
+    def test_responses_bounded(self):
+        store = FakeCharmStore(make_fixtures(), max_responses=2)
+        for path in ('xenial/mysql-57/meta/any', 'xenial/mysql-58/meta/any',
+                     'search', 'xenial/mysql-58/meta/any'):
+            store.handle(path, {})
+        self.assertEqual(
+            [('search', ()), ('xenial/mysql-58/meta/any', ())],
+            list(store._responses))
+
+    def test_root_and_fallback(self):
+        def fallback(path, query):
+            return 200, 'text/plain', path.encode('utf-8')
+        store = self.start(root='/charmstore/v5/', fallback=fallback)
+        self.assertTrue(store.url.endswith('/charmstore/v5'))
+        cs = CharmStore(store.url, timeout=10)
+        self.assertEqual(
+            'cs:xenial/mysql-57', cs.entity('xenial/mysql-57')['Id'])
+        base = store.url[:-len('/charmstore/v5')]
+        response = requests.get(base + '/plans/v3/wallet')
+        self.assertEqual(b'/plans/v3/wallet', response.content)
+        self.assertEqual(1, store.stats().requests)
+
+    def test_no_fallback(self):
+        base = self.store.url[:-len('/v5')]
+        self.assertEqual(404, requests.get(base + '/plans').status_code)
+
+    def test_debug(self):
+        self.assertEqual({}, self.cs.debug())
+
+    def test_stats(self):
+        self.cs.entity('xenial/mysql-57')
+        self.cs.search('mysql')
+        with self.assertRaises(EntityNotFound):
+            self.cs.entity('trusty/mysql')
+        stats = self.store.stats()
+        self.assertEqual(3, stats.requests)
+        self.assertEqual(0, stats.faults)
+        self.assertEqual({'meta': 1, 'search': 1, 'not-found': 1},
+                         stats.routes)
+        self.assertEqual({200: 2, 404: 1}, stats.statuses)
+        self.store.reset_stats()
+        self.assertEqual(0, self.store.stats().requests)
+
+    def test_latency(self):
+        store = self.start(latency=0.05)
+        cs = CharmStore(store.url, timeout=10)
+        start = time.time()
+        cs.entity('xenial/mysql-57')
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_faults(self):
+        store = self.start(faults=[Fault(1, 500, routes=['search'])])
+        cs = CharmStore(store.url, timeout=10)
+        cs.entity('xenial/mysql-57')
+        with self.assertRaises(ServerError):
+            cs.search('mysql')
+        stats = store.stats()
+        self.assertEqual(1, stats.faults)
+        self.assertEqual({200: 1, 500: 1}, stats.statuses)
+
+    def test_faults_rate(self):
+        store = self.start(faults=[Fault(0.5, 503)], seed=42)
+        cs = CharmStore(store.url, timeout=10, retry=RetryPolicy(
+            max_attempts=20, backoff=0, sleep=lambda delay: None))
+        for _ in range(20):
+            cs.entity('xenial/mysql-57')
+        stats = store.stats()
+        self.assertEqual(20, stats.statuses[200])
+        self.assertEqual(stats.faults, stats.statuses[503])
+        self.assertTrue(0 < stats.faults < stats.requests)
+
+    def test_reset_fault(self):
+        store = self.start(faults=[Fault(1, RESET)])
+        cs = CharmStore(store.url, timeout=10)
+        with self.assertRaises(ServerError):
+            cs.entity('xenial/mysql-57')
+        self.assertEqual(1, store.stats().faults)
+
+    def test_max_concurrency(self):
+        store = self.start(latency=0.05, max_concurrency=2)
+        cs = CharmStore(store.url, timeout=10, cache=None, coalesce=False)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(
+                lambda i: cs.entity('xenial/mysql-57')['Id'], range(6)))
+        self.assertEqual(['cs:xenial/mysql-57'] * 6, results)
+        stats = store.stats()
+        self.assertEqual(6, stats.requests)
+        self.assertEqual(2, stats.max_in_flight)
+
+    def test_reject_over_capacity(self):
+        store = self.start(
+            latency=0.2, max_concurrency=1, reject_over_capacity=True)
+        cs = CharmStore(store.url, timeout=10, cache=None, coalesce=False)
+
+        def fetch(i):
+            try:
+                return cs.entity('xenial/mysql-57')['Id']
+            except ServerError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(fetch, range(4)))
+        stats = store.stats()
+        self.assertEqual(4 - results.count(None), stats.statuses[200])
+        self.assertEqual(results.count(None), stats.rejected)
+        self.assertGreater(stats.rejected, 0)
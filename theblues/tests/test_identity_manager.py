@@ -17,7 +17,10 @@ from theblues.errors import (
 )
 from theblues.identity_manager import IdentityManager
 from theblues.tests import helpers
-from theblues.utils import DEFAULT_TIMEOUT
+from theblues.utils import (
+    DEFAULT_TIMEOUT,
+    Transport,
+)
 
 _called = None
 
@@ -94,7 +97,9 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
     def setUp(self):
         global _called
         _called = False
-        self.idm = IdentityManager('http://example.com/v1')
+        self.transport = Transport()
+        self.idm = IdentityManager(
+            'http://example.com/v1', transport=self.transport)
 
     def test_login_success(self):
         with HTTMock(entity_200):
@@ -119,6 +124,7 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
             method='PUT',
             body='body',
             timeout=DEFAULT_TIMEOUT,
+            transport=self.transport,
         )
 
     def test_login_error_forbidden(self):
@@ -187,7 +193,8 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
             'http://example.com/v1/discharger/discharge'
             '?discharge-for-user=my.user%2Bname&id=identifier',
             timeout=DEFAULT_TIMEOUT,
-            method='POST')
+            method='POST',
+            transport=self.transport)
 
     def test_discharge_token_successful(self):
         with HTTMock(discharge_token_200):
@@ -210,7 +217,9 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
 class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
 
     def setUp(self):
-        self.idm = IdentityManager('http://example.com:8082/v1')
+        self.transport = Transport()
+        self.idm = IdentityManager(
+            'http://example.com:8082/v1', transport=self.transport)
 
     def test_init(self):
         self.assertEqual(self.idm.url, 'http://example.com:8082/v1/')
@@ -219,7 +228,8 @@ class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
     def test_debug(self, mock):
         self.idm.debug()
         mock.assert_called_once_with(
-            'http://example.com:8082/v1/debug/status', timeout=DEFAULT_TIMEOUT)
+            'http://example.com:8082/v1/debug/status', timeout=DEFAULT_TIMEOUT,
+            transport=self.transport)
 
     @patch('theblues.identity_manager.make_request')
     def test_debug_fail(self, mock):
@@ -232,7 +242,8 @@ class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
         self.idm.get_user('jeffspinach', 'my-macaroon')
         make_request_mock.assert_called_once_with(
             'http://example.com:8082/v1/u/jeffspinach',
-            timeout=DEFAULT_TIMEOUT, macaroons='my-macaroon')
+            timeout=DEFAULT_TIMEOUT, macaroons='my-macaroon',
+            transport=self.transport)
 
     def test_get_extra_info_ok(self):
         with HTTMock(extra):
@@ -0,0 +1,99 @@
+from unittest import TestCase
+
+from httmock import (
+    HTTMock,
+    urlmatch,
+)
+from mock import Mock
+
+from theblues.charmstore import CharmStore
+from theblues.interface_index import (
+    INTERFACE_INCLUDES,
+    InterfaceIndex,
+)
+from theblues.records import Entity
+
+
+def charm(id, provides=(), requires=()):
+    def relations(interfaces):
+        return dict(
+            ('{}-{}'.format(interface, i), {'Interface': interface})
+            for i, interface in enumerate(interfaces))
+    return {'Id': id, 'Meta': {'charm-metadata': {
+        'Provides': relations(provides),
+        'Requires': relations(requires),
+    }}}
+
+
+MYSQL = charm('cs:xenial/mysql-57', provides=['mysql', 'mysql-root'])
+WORDPRESS = charm('cs:xenial/wordpress-4', provides=['http'],
+                  requires=['mysql', 'memcache'])
+HAPROXY = charm('cs:xenial/haproxy-2', requires=['http'])
+BUNDLE = {'Id': 'cs:bundle/wiki-3', 'Meta': {'bundle-metadata': {}}}
+
+
+class TestInterfaceIndex(TestCase):
+
+    def setUp(self):
+        self.index = InterfaceIndex([MYSQL, WORDPRESS, HAPROXY, BUNDLE])
+
+    def test_charms(self):
+        self.assertEqual([MYSQL], self.index.charms('mysql', 'provides'))
+        self.assertEqual([WORDPRESS], self.index.charms('mysql', 'requires'))
+        self.assertEqual([HAPROXY], self.index.charms('http', 'requires'))
+        self.assertEqual([], self.index.charms('pgsql', 'provides'))
+
+    def test_bundles_ignored(self):
+        self.assertEqual(3, len(self.index))
+        self.assertNotIn('cs:bundle/wiki-3', self.index)
+
+    def test_invalid_way(self):
+        with self.assertRaises(ValueError):
+            self.index.charms('mysql', 'peers')
+
+    def test_replace(self):
+        self.index.add(charm('cs:xenial/mysql-57', provides=['pgsql']))
+        self.assertEqual([], self.index.charms('mysql', 'provides'))
+        self.assertEqual(1, len(self.index.charms('pgsql', 'provides')))
+
+    def test_remove(self):
+        self.index.remove('cs:xenial/wordpress-4')
+        self.assertEqual([], self.index.charms('mysql', 'requires'))
+        self.assertEqual([], self.index.charms('http', 'provides'))
+        with self.assertRaises(KeyError):
+            self.index.remove('cs:xenial/wordpress-4')
+
+    def test_records(self):
+        index = InterfaceIndex([Entity.from_dict(MYSQL)])
+        self.assertEqual([Entity.from_dict(MYSQL)],
+                         index.charms('mysql', 'provides'))
+
+    def test_from_charmstore(self):
+        charmstore = Mock()
+        charmstore.list.return_value = iter([MYSQL])
+        index = InterfaceIndex.from_charmstore(charmstore)
+        self.assertEqual(1, len(index))
+        charmstore.list.assert_called_once_with(
+            stream=True, includes=INTERFACE_INCLUDES, doc_type='charm')
+
+    def test_refresh(self):
+        urls = []
+
+        @urlmatch(path='/meta/any')
+        def bulk(url, request):
+            urls.append(url.query)
+            return {'status_code': 200, 'content': {
+                'xenial/mysql-57': charm(
+                    'cs:xenial/mysql-57', provides=['mysql-shared'])}}
+
+        cs = CharmStore('http://example.com')
+        with HTTMock(bulk):
+            self.index.refresh(
+                cs, ['cs:xenial/mysql-57', 'cs:xenial/wordpress-4'])
+        self.assertEqual(1, len(urls))
+        self.assertIn('include=charm-metadata', urls[0])
+        self.assertEqual(['cs:xenial/mysql-57'], [
+            c['Id'] for c in self.index.charms('mysql-shared', 'provides')])
+        self.assertEqual([], self.index.charms('mysql', 'provides'))
+        self.assertNotIn('cs:xenial/wordpress-4', self.index)
+        self.assertEqual(2, len(self.index))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import TestCase
+
+from theblues.jsonstream import iter_items
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterItems(TestCase):
+
+    def test_items(self):
+        data = json.dumps({'Results': [{'Id': 'cs:foo'}, 42, 'bar', None]})
+        results = list(iter_items([data.encode('utf-8')], 'Results'))
+        self.assertEqual([{'Id': 'cs:foo'}, 42, 'bar', None], results)
+
+    def test_chunk_sizes(self):
+        results = [{'Id': u'cs:caf\xe9-{}'.format(i), 'Count': 12345.5,
+                    'Meta': {'tags': [u'☃', 'x' * 100]}}
+                   for i in range(20)]
+        data = json.dumps(
+            {'Other': [1, {'a': 'b'}], 'Results': results, 'Total': 20},
+            indent=2, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 3, 7, 64, len(data)):
+            self.assertEqual(
+                results, list(iter_items(chunked(data, size), 'Results')))
+
+    def test_numbers_across_chunks(self):
+        data = b'{"Results": [123456, 7]}'
+        self.assertEqual([123456, 7],
+                         list(iter_items(chunked(data, 15), 'Results')))
+
+    def test_fractions_and_exponents_across_chunks(self):
+        data = b'{"Results": [1.5, 2e3, -4.25E-2, 3]}'
+        for size in range(1, len(data) + 1):
+            self.assertEqual(
+                [1.5, 2e3, -4.25E-2, 3],
+                list(iter_items(chunked(data, size), 'Results')))
+        self.assertEqual(
+            [1.5], list(iter_items([b'{"Results": [1.', b'5]}'], 'Results')))
+        self.assertEqual(
+            [2e3], list(iter_items([b'{"Results": [2e', b'3]}'], 'Results')))
+
+    def test_empty(self):
+        self.assertEqual(
+            [], list(iter_items([b'{"Results": [ ]}'], 'Results')))
+
+    def test_lazy(self):
+        chunks = iter([b'{"Results": [1,', b' 2,', b' 3]}'])
+        items = iter_items(chunks, 'Results')
+        self.assertEqual(1, next(items))
+        self.assertEqual(b' 2,', next(chunks))
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            list(iter_items([b'{"Other": []}'], 'Results'))
+        with self.assertRaises(KeyError):
+            list(iter_items([b'{}'], 'Results'))
+
+    def test_invalid(self):
+        for data in (b'[]', b'{"Results": {}}', b'{"Results": [1 2]}',
+                     b'{"Results": [1, ', b'{"Results": [{"a": ]}'):
+            with self.assertRaises(ValueError):
+                list(iter_items(chunked(data, 4), 'Results'))
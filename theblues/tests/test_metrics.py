@@ -0,0 +1,291 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest import TestCase
+
+from theblues.metrics import (
+    bind,
+    CACHE_HIT,
+    Collector,
+    count_retry,
+    current_operation,
+    ERROR_STATUS,
+    Histogram,
+    instrumented,
+    Instrumentation,
+    observe_decode,
+    observe_request,
+    operation,
+    UNKNOWN_OPERATION,
+)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class Scope(object):
+
+    def __init__(self, events, name):
+        self.events = events
+        self.name = name
+
+    @contextmanager
+    def activate(self):
+        self.events.append(('activate', self.name))
+        yield
+        self.events.append(('deactivate', self.name))
+
+    def finish(self, error):
+        self.events.append(
+            ('finish', self.name, str(error) if error else None))
+
+
+class ScopedInstrumentation(Instrumentation):
+
+    def __init__(self):
+        self.events = []
+
+    def start_operation(self, operation):
+        self.events.append(('start', operation))
+        return Scope(self.events, operation)
+
+
+class FakeClient(object):
+
+    def __init__(self, instrumentation=None):
+        self.instrumentation = instrumentation
+
+    @instrumented('fake.operation')
+    def operation(self):
+        return current_operation()
+
+    @instrumented('fake.fail')
+    def fail(self):
+        raise ValueError('bad wolf')
+
+    @instrumented('fake.iterate')
+    def iterate(self):
+        yield current_operation()
+        yield current_operation()
+
+
+class TestHistogram(TestCase):
+
+    def test_observe(self):
+        histogram = Histogram([1, 5])
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(14.5, histogram.sum)
+        self.assertEqual(
+            [(1, 2), (5, 3), (float('inf'), 4)], histogram.cumulative())
+
+    def test_quantile(self):
+        histogram = Histogram([1, 5])
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.5, 0.6, 0.7, 3):
+            histogram.observe(value)
+        self.assertEqual(1, histogram.quantile(0.5))
+        self.assertEqual(5, histogram.quantile(0.99))
+
+
+class TestOperation(TestCase):
+
+    def test_current_operation(self):
+        self.assertEqual(UNKNOWN_OPERATION, current_operation())
+        with operation('charmstore.charm'):
+            with operation('charmstore.entity'):
+                self.assertEqual('charmstore.charm', current_operation())
+            self.assertEqual('charmstore.charm', current_operation())
+        self.assertIsNone(current_operation(None))
+
+    def test_instrumented(self):
+        self.assertEqual('fake.operation', FakeClient().operation())
+        self.assertEqual(UNKNOWN_OPERATION, current_operation())
+
+    def test_instrumented_generator(self):
+        items = FakeClient().iterate()
+        self.assertEqual(UNKNOWN_OPERATION, current_operation())
+        self.assertEqual(['fake.iterate'] * 2, list(items))
+
+    def test_instrumented_scope(self):
+        instrumentation = ScopedInstrumentation()
+        client = FakeClient(instrumentation)
+        client.operation()
+        self.assertEqual(
+            [('start', 'fake.operation'), ('activate', 'fake.operation'),
+             ('deactivate', 'fake.operation'),
+             ('finish', 'fake.operation', None)],
+            instrumentation.events)
+
+    def test_instrumented_scope_error(self):
+        instrumentation = ScopedInstrumentation()
+        with self.assertRaises(ValueError):
+            FakeClient(instrumentation).fail()
+        self.assertEqual(
+            ('finish', 'fake.fail', 'bad wolf'), instrumentation.events[-1])
+
+    def test_instrumented_scope_generator(self):
+        instrumentation = ScopedInstrumentation()
+        items = FakeClient(instrumentation).iterate()
+        self.assertEqual(
+            [('start', 'fake.iterate'), ('activate', 'fake.iterate'),
+             ('deactivate', 'fake.iterate')],
+            instrumentation.events)
+        list(items)
+        self.assertEqual(
+            ('finish', 'fake.iterate', None), instrumentation.events[-1])
+        self.assertEqual(1, len([
+            event for event in instrumentation.events
+            if event[0] == 'finish']))
+
+    def test_instrumented_transport(self):
+        instrumentation = ScopedInstrumentation()
+        client = FakeClient()
+        client._transport = FakeClient(instrumentation)
+        client.operation()
+        self.assertEqual(('start', 'fake.operation'),
+                         instrumentation.events[0])
+
+    def test_bind(self):
+        with operation('charmstore.entities'):
+            func = bind(current_operation)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(
+                'charmstore.entities', executor.submit(func).result())
+        self.assertIs(current_operation, bind(current_operation))
+
+
+class TestObserve(TestCase):
+
+    def setUp(self):
+        self.collector = Collector()
+
+    def test_request(self):
+        with operation('terms.get_terms'):
+            response = observe_request(
+                self.collector, 'GET', 'http://example.com',
+                lambda: FakeResponse(200, b'{"a": 1}'))
+        self.assertEqual(200, response.status_code)
+        stats = self.collector.operations()['terms.get_terms']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual(0, stats.errors)
+        self.assertEqual(8, stats.bytes)
+        self.assertEqual({200: 1}, stats.statuses)
+
+    def test_request_streamed(self):
+        observe_request(
+            self.collector, 'GET', 'http://example.com',
+            lambda: FakeResponse(200, headers={'Content-Length': '42'}),
+            stream=True)
+        stats = self.collector.operations()[UNKNOWN_OPERATION]
+        self.assertEqual(42, stats.bytes)
+
+    def test_request_error(self):
+        def send():
+            raise IOError('bad wolf')
+        with self.assertRaises(IOError):
+            observe_request(self.collector, 'GET', 'http://example.com', send)
+        stats = self.collector.operations()[UNKNOWN_OPERATION]
+        self.assertEqual(1, stats.errors)
+        self.assertEqual({ERROR_STATUS: 1}, stats.statuses)
+
+    def test_decode(self):
+        self.assertEqual(
+            {'a': 1}, observe_decode(self.collector, dict, {'a': 1}))
+        self.assertEqual(
+            1, self.collector.histograms(UNKNOWN_OPERATION)[1].count)
+        self.assertEqual({'a': 1}, observe_decode(None, dict, {'a': 1}))
+
+    def test_request_retries(self):
+        def send():
+            count_retry()
+            count_retry()
+            return FakeResponse(200)
+        observe_request(self.collector, 'GET', 'http://example.com', send)
+        count_retry()
+        stats = self.collector.operations()[UNKNOWN_OPERATION]
+        self.assertEqual(2, stats.retries)
+
+    def test_instrumentation_ignores(self):
+        instrumentation = Instrumentation()
+        observe_request(
+            instrumentation, 'GET', 'http://example.com', FakeResponse)
+        instrumentation.cache('charmstore.entity', CACHE_HIT)
+
+
+class TestCollector(TestCase):
+
+    def test_expose(self):
+        collector = Collector(
+            latency_buckets=[0.1], decode_buckets=[0.01],
+            size_buckets=[100])
+        collector.request(
+            'charmstore.entity', 'GET', 'http://example.com', 200, 0.05, 10)
+        collector.request(
+            'charmstore.entity', 'GET', 'http://example.com', 404, 0.5, 200)
+        collector.cache('charmstore.entity', CACHE_HIT)
+        self.assertEqual(
+            collector.expose(),
+            '# HELP theblues_request_duration_seconds The duration of the '
+            'requests until a response is received.\n'
+            '# TYPE theblues_request_duration_seconds histogram\n'
+            'theblues_request_duration_seconds_bucket'
+            '{operation="charmstore.entity",le="0.1"} 1\n'
+            'theblues_request_duration_seconds_bucket'
+            '{operation="charmstore.entity",le="+Inf"} 2\n'
+            'theblues_request_duration_seconds_sum'
+            '{operation="charmstore.entity"} 0.55\n'
+            'theblues_request_duration_seconds_count'
+            '{operation="charmstore.entity"} 2\n'
+            '# HELP theblues_response_size_bytes The size of the response '
+            'bodies.\n'
+            '# TYPE theblues_response_size_bytes histogram\n'
+            'theblues_response_size_bytes_bucket'
+            '{operation="charmstore.entity",le="100.0"} 1\n'
+            'theblues_response_size_bytes_bucket'
+            '{operation="charmstore.entity",le="+Inf"} 2\n'
+            'theblues_response_size_bytes_sum'
+            '{operation="charmstore.entity"} 210.0\n'
+            'theblues_response_size_bytes_count'
+            '{operation="charmstore.entity"} 2\n'
+            '# HELP theblues_json_decode_seconds The time spent decoding '
+            'JSON response bodies.\n'
+            '# TYPE theblues_json_decode_seconds histogram\n'
+            '# HELP theblues_rate_limit_wait_seconds The time spent waiting '
+            'for the rate limiters.\n'
+            '# TYPE theblues_rate_limit_wait_seconds histogram\n'
+            '# HELP theblues_responses_total The responses by status code.\n'
+            '# TYPE theblues_responses_total counter\n'
+            'theblues_responses_total'
+            '{operation="charmstore.entity",status="200"} 1\n'
+            'theblues_responses_total'
+            '{operation="charmstore.entity",status="404"} 1\n'
+            '# HELP theblues_retries_total The requests sent again.\n'
+            '# TYPE theblues_retries_total counter\n'
+            '# HELP theblues_cache_lookups_total The cache lookups by '
+            'outcome.\n'
+            '# TYPE theblues_cache_lookups_total counter\n'
+            'theblues_cache_lookups_total'
+            '{operation="charmstore.entity",outcome="hit"} 1\n')
+
+    def test_operations(self):
+        collector = Collector()
+        collector.request('plans.list_wallets', 'GET', 'u', 500, 0.25, 3)
+        collector.decode('plans.list_wallets', 0.125)
+        stats = collector.operations()['plans.list_wallets']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual(1, stats.errors)
+        self.assertEqual(0.25, stats.latency)
+        self.assertEqual(0.125, stats.decode_time)
+
+    def test_reset(self):
+        collector = Collector()
+        collector.cache('charmstore.entity', CACHE_HIT)
+        collector.reset()
+        self.assertEqual({}, collector.operations())
+        self.assertIsNone(collector.histograms('charmstore.entity'))
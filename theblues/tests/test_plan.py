@@ -1,12 +1,17 @@
 import datetime
 import json
 
+from httmock import (
+    HTTMock,
+    urlmatch,
+)
 from jujubundlelib import references
 from mock import patch
 from unittest import TestCase
 
 from macaroonbakery import httpbakery
 
+from theblues.metrics import Collector
 from theblues.plans import (
     Plan,
     Plans,
@@ -14,14 +19,19 @@ from theblues.plans import (
     WalletTotal,
 )
 from theblues.errors import ServerError
-from theblues.utils import DEFAULT_TIMEOUT
+from theblues.utils import (
+    DEFAULT_TIMEOUT,
+    Transport,
+)
 
 
 class TestPlans(TestCase):
 
     def setUp(self):
         self.client = httpbakery.Client()
-        self.plans = Plans('http://example.com', client=self.client)
+        self.transport = Transport()
+        self.plans = Plans('http://example.com', client=self.client,
+                           transport=self.transport)
         self.ref = references.Reference.from_string(
             'cs:trusty/landscape-mock-0')
 
@@ -71,7 +81,8 @@ class TestPlans(TestCase):
         mocked.assert_called_once_with(
             'http://example.com/v3/charm?charm-url=cs:trusty/landscape-mock-0',
             timeout=DEFAULT_TIMEOUT,
-            client=self.client
+            client=self.client,
+            transport=self.transport,
         )
 
     @patch('theblues.plans.make_request')
@@ -232,3 +243,29 @@ class TestPlans(TestCase):
         self.assertEqual(
             str(err.exception),
             'unable to get list of wallets: KeyError(\'limit\',)')
+
+
+class TestPlansInstrumentation(TestCase):
+
+    def test_list_wallets(self):
+        @urlmatch(path='/v3/wallet')
+        def wallets(url, request):
+            return {
+                'status_code': 200,
+                'content': {
+                    'wallets': [],
+                    'total': dict.fromkeys(WalletTotal._fields, '0'),
+                    'credit': '0',
+                },
+            }
+
+        collector = Collector()
+        plans = Plans('http://example.com',
+                      transport=Transport(instrumentation=collector))
+        with HTTMock(wallets):
+            self.assertEqual([], list(plans.list_wallets()['wallets']))
+        stats = collector.operations()['plans.list_wallets']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual({200: 1}, stats.statuses)
+        _, decode, _ = collector.histograms('plans.list_wallets')
+        self.assertEqual(1, decode.count)
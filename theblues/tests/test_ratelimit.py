@@ -0,0 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from unittest import TestCase
+
+import requests
+
+from theblues.errors import (
+    RateLimitError,
+    ServerError,
+)
+from theblues.metrics import (
+    Collector,
+    operation,
+)
+from theblues.ratelimit import (
+    RateLimiter,
+    RateLimiterRegistry,
+    TokenBucket,
+)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def make_response(status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(2, burst=3, clock=self.clock)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+    def test_default_burst(self):
+        self.assertEqual(5, TokenBucket(5).burst)
+        self.assertEqual(1, TokenBucket(0.5).burst)
+
+    def test_burst(self):
+        self.assertEqual([0, 0, 0], [self.bucket.reserve() for _ in range(3)])
+        self.assertEqual(0, self.bucket.tokens)
+
+    def test_reserve_ahead(self):
+        for _ in range(3):
+            self.bucket.reserve()
+        # Waiting callers are served in order, a token every half second.
+        self.assertEqual(0.5, self.bucket.reserve())
+        self.assertEqual(1, self.bucket.reserve())
+        self.assertEqual(-2, self.bucket.tokens)
+
+    def test_refund(self):
+        self.bucket.reserve()
+        self.bucket.refund()
+        self.assertEqual(3, self.bucket.tokens)
+
+    def test_refill(self):
+        for _ in range(3):
+            self.bucket.reserve()
+        self.clock.now += 1
+        self.assertEqual(2, self.bucket.tokens)
+        self.clock.now += 10
+        self.assertEqual(3, self.bucket.tokens)
+
+    def test_max_wait(self):
+        for _ in range(3):
+            self.bucket.reserve()
+        self.assertIsNone(self.bucket.reserve(max_wait=0))
+        self.assertIsNone(self.bucket.reserve(max_wait=0.4))
+        self.assertEqual(0, self.bucket.tokens)
+        self.assertEqual(0.5, self.bucket.reserve(max_wait=0.5))
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, **kwargs):
+        return RateLimiter(
+            'example.com', clock=self.clock, sleep=self.clock.sleep,
+            **kwargs)
+
+    def test_no_limits(self):
+        limiter = self.limiter()
+        for _ in range(100):
+            self.assertEqual(200, limiter.call(make_response).status_code)
+        stats = limiter.stats()
+        self.assertEqual(100, stats.acquired)
+        self.assertEqual(0, stats.waited)
+        self.assertEqual(0, stats.in_flight)
+
+    def test_rate_blocking(self):
+        limiter = self.limiter(rate=10, burst=2)
+        for _ in range(4):
+            limiter.call(make_response)
+        self.assertEqual(2, len(self.clock.sleeps))
+        for delay in self.clock.sleeps:
+            self.assertAlmostEqual(0.1, delay)
+        stats = limiter.stats()
+        self.assertEqual(4, stats.acquired)
+        self.assertEqual(2, stats.waited)
+        self.assertAlmostEqual(0.2, stats.wait_time)
+        self.assertAlmostEqual(0.1, stats.max_wait)
+        self.assertEqual(0, stats.rejected)
+
+    def test_rate_non_blocking(self):
+        limiter = self.limiter(rate=10, burst=2, blocking=False)
+        limiter.call(make_response)
+        limiter.call(make_response)
+        with self.assertRaises(RateLimitError) as ctx:
+            limiter.call(make_response)
+        self.assertEqual('example.com', ctx.exception.host)
+        self.assertIsInstance(ctx.exception, ServerError)
+        self.assertEqual([], self.clock.sleeps)
+        self.assertEqual(1, limiter.stats().rejected)
+        self.clock.now += 0.1
+        limiter.call(make_response)
+
+    def test_max_wait(self):
+        limiter = self.limiter(rate=10, burst=1, max_wait=0.05)
+        limiter.call(make_response)
+        with self.assertRaises(RateLimitError):
+            limiter.call(make_response)
+        self.clock.now += 0.05
+        limiter.call(make_response)
+        self.assertEqual(1, len(self.clock.sleeps))
+        self.assertAlmostEqual(0.05, self.clock.sleeps[0])
+
+    def test_acquire_release(self):
+        limiter = self.limiter(rate=10, burst=1, max_in_flight=1)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(blocking=False))
+        self.clock.now += 1
+        # The token is given back when no slot is free.
+        self.assertFalse(limiter.acquire(blocking=False))
+        self.assertEqual(1, limiter._bucket.tokens)
+        self.assertEqual(1, limiter.stats().in_flight)
+        limiter.release()
+        self.assertTrue(limiter.acquire(blocking=False))
+        limiter.release()
+        self.assertEqual(2, limiter.stats().rejected)
+
+    def test_slot_released_on_error(self):
+        limiter = self.limiter(max_in_flight=1)
+
+        def fail():
+            raise requests.exceptions.ConnectionError('refused')
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            limiter.call(fail)
+        self.assertEqual(0, limiter.stats().in_flight)
+        limiter.call(make_response)
+
+    def test_max_in_flight(self):
+        limiter = RateLimiter('example.com', max_in_flight=2)
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def send():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return make_response()
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda i: limiter.call(send), range(12)))
+        self.assertEqual(2, state['max'])
+        stats = limiter.stats()
+        self.assertEqual(12, stats.acquired)
+        self.assertGreater(stats.waited, 0)
+        self.assertEqual(0, stats.in_flight)
+
+    def test_max_in_flight_timeout(self):
+        limiter = RateLimiter('example.com', max_in_flight=1, max_wait=0.01)
+        self.assertTrue(limiter.acquire())
+        with self.assertRaises(RateLimitError):
+            limiter.call(make_response)
+        self.assertFalse(limiter.acquire(timeout=0.01))
+        limiter.release()
+        limiter.call(make_response)
+
+    def test_instrumentation(self):
+        collector = Collector()
+        limiter = self.limiter(rate=10, burst=1)
+        with operation('charmstore.entity'):
+            limiter.call(make_response, instrumentation=collector)
+            limiter.call(make_response, instrumentation=collector)
+        stats = collector.operations()['charmstore.entity']
+        self.assertAlmostEqual(0.1, stats.throttle_wait)
+        self.assertIn(
+            'theblues_rate_limit_wait_seconds_count'
+            '{operation="charmstore.entity"} 2',
+            collector.expose())
+
+
+class TestRateLimiterRegistry(TestCase):
+
+    def test_per_host(self):
+        registry = RateLimiterRegistry(
+            hosts={'slow.example.com': {'rate': 1}}, max_in_flight=4)
+        limiter = registry.for_url('http://example.com/v5/meta/any')
+        self.assertIs(limiter, registry.get('example.com'))
+        self.assertEqual('example.com', limiter.name)
+        self.assertEqual(4, limiter.max_in_flight)
+        self.assertIsNone(limiter._bucket)
+        slow = registry.for_url('https://slow.example.com/v1/terms')
+        self.assertEqual(1, slow._bucket.rate)
+        self.assertEqual(4, slow.max_in_flight)
+        self.assertEqual(
+            ['example.com', 'slow.example.com'], sorted(registry.stats()))
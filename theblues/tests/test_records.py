@@ -0,0 +1,81 @@
+import pickle
+import sys
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+from theblues.records import (
+    Entity,
+    iter_records,
+    to_records,
+)
+
+
+class TestEntity(TestCase):
+
+    def test_parse_id(self):
+        tests = [
+            ('cs:~hatch/xenial/mysql-1', ('hatch', 'xenial', 'mysql', 1)),
+            ('cs:xenial/mysql-42', (None, 'xenial', 'mysql', 42)),
+            ('cs:mongodb-cluster-4', (None, None, 'mongodb-cluster', 4)),
+            ('cs:~hatch/mysql', ('hatch', None, 'mysql', None)),
+            ('mysql', (None, None, 'mysql', None)),
+            ('cs:~hatch/bundle/my-bundle-x', (
+                'hatch', 'bundle', 'my-bundle-x', None)),
+        ]
+        for id, expected in tests:
+            entity = Entity(id)
+            self.assertEqual(
+                expected,
+                (entity.owner, entity.series, entity.name, entity.revision),
+                id)
+
+    @skipIf(sys.version_info < (3,), 'Python 2 does not intern unicode')
+    def test_interned(self):
+        a = Entity(''.join(['cs:~hatch/', 'xenial/mysql-1']))
+        b = Entity(''.join(['cs:~hatch/', 'xenial/wordpress-2']))
+        self.assertIs(a.owner, b.owner)
+        self.assertIs(a.series, b.series)
+
+    def test_meta(self):
+        meta = {'charm-metadata': {'Name': 'mysql'}, 'stats': {}}
+        entity = Entity('cs:xenial/mysql-1', meta)
+        self.assertEqual(meta, entity.meta)
+        self.assertIsNot(entity.meta, entity.meta)
+
+    def test_no_meta(self):
+        entity = Entity('cs:xenial/mysql-1')
+        self.assertEqual({}, entity.meta)
+        self.assertEqual({'Id': 'cs:xenial/mysql-1'}, entity.to_dict())
+
+    def test_slots(self):
+        entity = Entity('cs:xenial/mysql-1')
+        with self.assertRaises(AttributeError):
+            entity.other = 1
+
+    def test_to_dict(self):
+        data = {'Id': 'cs:xenial/mysql-1', 'Meta': {'stats': {'Count': 1}}}
+        self.assertEqual(data, Entity.from_dict(data).to_dict())
+
+    def test_equality(self):
+        a = Entity('cs:xenial/mysql-1', {'a': 1})
+        self.assertEqual(a, Entity('cs:xenial/mysql-1', {'a': 1}))
+        self.assertNotEqual(a, Entity('cs:xenial/mysql-1', {'a': 2}))
+        self.assertNotEqual(a, Entity('cs:xenial/mysql-2', {'a': 1}))
+        self.assertEqual(hash(a), hash(Entity('cs:xenial/mysql-1')))
+
+    def test_repr(self):
+        self.assertEqual('<Entity cs:xenial/mysql-1>',
+                         repr(Entity('cs:xenial/mysql-1')))
+
+    def test_pickle(self):
+        entity = Entity('cs:xenial/mysql-1', {'a': 1})
+        self.assertEqual(entity, pickle.loads(pickle.dumps(entity)))
+
+    def test_to_records(self):
+        results = [{'Id': 'cs:foo-1'}, {'Id': 'cs:bar-2', 'Meta': {}}]
+        self.assertEqual(
+            [Entity('cs:foo-1'), Entity('cs:bar-2')], to_records(results))
+        records = iter_records(iter(results))
+        self.assertEqual(Entity('cs:foo-1'), next(records))
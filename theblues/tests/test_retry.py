@@ -0,0 +1,188 @@
+import threading
+import time
+from unittest import TestCase
+
+import mock
+import requests
+from requests.exceptions import (
+    ConnectionError,
+    ReadTimeout,
+)
+
+from theblues.metrics import (
+    Collector,
+    observe_request,
+)
+from theblues.retry import (
+    HEDGE_MIN_SAMPLES,
+    HedgePolicy,
+    RetryPolicy,
+)
+
+
+def make_response(status_code=200, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = b''
+    response._content_consumed = True
+    return response
+
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(
+            max_attempts=3, backoff=1, max_backoff=3,
+            sleep=self.sleeps.append, random=lambda: 0.5)
+
+    def sequence(self, *outcomes):
+        outcomes = list(outcomes)
+        self.calls = 0
+
+        def func():
+            self.calls += 1
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return func
+
+    def test_success(self):
+        response = self.policy.call('GET', self.sequence(make_response()))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], self.sleeps)
+
+    def test_retry_status(self):
+        func = self.sequence(make_response(503), make_response(502),
+                             make_response(200))
+        with mock.patch('theblues.retry.log'):
+            response = self.policy.call('GET', func)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([0.5, 1], self.sleeps)
+
+    def test_retries_observed(self):
+        collector = Collector()
+        func = self.sequence(make_response(503), make_response(200))
+        with mock.patch('theblues.retry.log'):
+            observe_request(
+                collector, 'GET', 'http://example.com',
+                lambda: self.policy.call('GET', func))
+        self.assertEqual(1, collector.operations()['unknown'].retries)
+
+    def test_attempts_exhausted(self):
+        func = self.sequence(*[make_response(500)] * 3)
+        with mock.patch('theblues.retry.log'):
+            response = self.policy.call('GET', func)
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(3, self.calls)
+
+    def test_not_retried_status(self):
+        response = self.policy.call('GET', self.sequence(make_response(404)))
+        self.assertEqual(404, response.status_code)
+
+    def test_retry_errors(self):
+        func = self.sequence(ConnectionError(), ReadTimeout(),
+                             make_response())
+        with mock.patch('theblues.retry.log'):
+            self.assertEqual(200, self.policy.call('GET', func).status_code)
+        func = self.sequence(*[ReadTimeout()] * 3)
+        with mock.patch('theblues.retry.log'):
+            with self.assertRaises(ReadTimeout):
+                self.policy.call('GET', func)
+
+    def test_non_idempotent(self):
+        func = self.sequence(make_response(503))
+        self.assertEqual(503, self.policy.call('POST', func).status_code)
+        with self.assertRaises(ConnectionError):
+            self.policy.call('PATCH', self.sequence(ConnectionError()))
+        self.assertEqual([], self.sleeps)
+
+    def test_delay_capped(self):
+        self.policy._random = lambda: 0.999
+        self.assertAlmostEqual(3, self.policy.delay(10), places=2)
+
+    def test_retry_after(self):
+        response = make_response(503, {'Retry-After': '2'})
+        self.assertEqual(2, self.policy.delay(1, response))
+        response = make_response(503, {'Retry-After': '3600'})
+        self.assertIsNone(self.policy.delay(1, response))
+        response = make_response(
+            503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(0.5, self.policy.delay(1, response))
+
+    def test_retry_after_too_long(self):
+        func = self.sequence(make_response(429, {'Retry-After': '3600'}))
+        self.assertEqual(429, self.policy.call('GET', func).status_code)
+        self.assertEqual([], self.sleeps)
+
+
+class TestHedgePolicy(TestCase):
+
+    def setUp(self):
+        self.policy = HedgePolicy(initial_delay=0.05)
+        self.addCleanup(self.policy.close)
+
+    def test_fast(self):
+        response = make_response()
+        self.assertIs(response, self.policy.call(lambda: response))
+        self.assertEqual(0, self.policy.hedged)
+
+    def test_hedged(self):
+        responses = [make_response(200), make_response(201)]
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def func():
+            response = responses.pop(0)
+            if response.status_code == 200:
+                release.wait(5)
+            return response
+
+        response = self.policy.call(func)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, self.policy.hedged)
+        self.assertEqual(1, self.policy.won)
+
+    def test_hedge_after_failure(self):
+        calls = []
+
+        def func():
+            calls.append(None)
+            time.sleep(0.1)
+            if len(calls) == 1:
+                raise ConnectionError()
+            return make_response()
+
+        self.assertEqual(200, self.policy.call(func).status_code)
+        self.assertEqual(2, len(calls))
+
+    def test_both_fail(self):
+        def func():
+            time.sleep(0.1)
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            self.policy.call(func)
+
+    def test_error_not_hedged(self):
+        def func():
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            self.policy.call(func)
+        self.assertEqual(0, self.policy.hedged)
+
+    def test_percentile_delay(self):
+        self.assertEqual(0.05, self.policy.delay())
+        for i in range(100):
+            self.policy.record(i / 100.0)
+        self.assertEqual(0.95, self.policy.delay())
+        self.policy.min_delay = 2
+        self.assertEqual(2, self.policy.delay())
+
+    def test_min_samples(self):
+        for i in range(HEDGE_MIN_SAMPLES - 1):
+            self.policy.record(10)
+        self.assertEqual(0.05, self.policy.delay())
@@ -0,0 +1,141 @@
+from unittest import TestCase
+
+from mock import Mock
+
+from theblues.records import Entity
+from theblues.search_index import (
+    INDEX_INCLUDES,
+    SearchIndex,
+)
+
+
+def charm(id, summary='', tags=(), owner=None, promulgated=False,
+          series=None):
+    meta = {
+        'charm-metadata': {'Summary': summary, 'Tags': list(tags)},
+        'promulgated': {'Promulgated': promulgated},
+    }
+    if owner is not None:
+        meta['owner'] = {'User': owner}
+    if series is not None:
+        meta['supported-series'] = {'SupportedSeries': series}
+    return {'Id': id, 'Meta': meta}
+
+
+ENTITIES = [
+    charm('cs:xenial/mysql-57', 'MySQL database server', ['databases'],
+          owner='mysql-charmers', promulgated=True),
+    charm('cs:~hatch/mysql-router-3', 'Route to MySQL', ['databases'],
+          owner='hatch', series=['xenial', 'bionic']),
+    charm('cs:trusty/wordpress-4', 'A blog engine', ['applications'],
+          owner='wp', promulgated=True),
+    charm('cs:~hatch/bionic/mariadb-1', 'MariaDB server', ['databases'],
+          owner='hatch'),
+    {'Id': 'cs:bundle/wiki-simple-3',
+     'Meta': {'bundle-metadata': {'Tags': ['wiki']},
+              'owner': {'User': 'charmers'},
+              'promulgated': {'Promulgated': True}}},
+]
+
+
+def ids(results):
+    return [result['Id'] for result in results]
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex(ENTITIES)
+
+    def test_len(self):
+        self.assertEqual(5, len(self.index))
+        self.assertIn('cs:xenial/mysql-57', self.index)
+
+    def test_search_all(self):
+        self.assertEqual(5, len(self.index.search()))
+
+    def test_search_word(self):
+        self.assertEqual(
+            sorted(['cs:~hatch/bionic/mariadb-1', 'cs:xenial/mysql-57']),
+            sorted(ids(self.index.search('server'))))
+
+    def test_search_exact_words(self):
+        self.assertEqual([], self.index.search('mysq'))
+        self.assertEqual(['cs:xenial/mysql-57'],
+                         ids(self.index.search('MySQL database')))
+
+    def test_autocomplete(self):
+        results = ids(self.index.search('mysq', autocomplete=True))
+        self.assertEqual(
+            ['cs:xenial/mysql-57', 'cs:~hatch/mysql-router-3'], results)
+        self.assertEqual(['cs:~hatch/mysql-router-3'],
+                         ids(self.index.search('rou', autocomplete=True)))
+
+    def test_name_prefix_first(self):
+        results = ids(self.index.search('hatch'))
+        self.assertEqual(
+            ['cs:~hatch/bionic/mariadb-1', 'cs:~hatch/mysql-router-3'],
+            results)
+        results = ids(self.index.search('mariadb'))
+        self.assertEqual(['cs:~hatch/bionic/mariadb-1'], results)
+
+    def test_filters(self):
+        search = self.index.search
+        self.assertEqual(['cs:bundle/wiki-simple-3'],
+                         ids(search(doc_type='bundle')))
+        self.assertEqual(4, len(search(doc_type='charm')))
+        self.assertEqual(3, len(search(promulgated_only=True)))
+        self.assertEqual(2, len(search(owner='hatch')))
+        self.assertEqual(['cs:trusty/wordpress-4'],
+                         ids(search(tags='applications')))
+        self.assertEqual(4, len(search(tags=['databases', 'wiki'])))
+        self.assertEqual(
+            ['cs:~hatch/bionic/mariadb-1', 'cs:~hatch/mysql-router-3'],
+            ids(search(series='bionic')))
+        self.assertEqual(3, len(search(series='bionic,trusty')))
+
+    def test_sort(self):
+        self.assertEqual(
+            ['mariadb-1', 'mysql-57', 'mysql-router-3', 'wiki-simple-3',
+             'wordpress-4'],
+            [id.split('/')[-1] for id in ids(self.index.search(sort='name'))])
+        self.assertEqual(
+            'cs:trusty/wordpress-4', ids(self.index.search(sort='-name'))[0])
+        self.assertEqual(
+            ['cs:bundle/wiki-simple-3', 'cs:~hatch/bionic/mariadb-1',
+             'cs:~hatch/mysql-router-3'],
+            ids(self.index.search(sort='owner,name', limit=3)))
+
+    def test_invalid_sort(self):
+        with self.assertRaises(ValueError):
+            self.index.search(sort='popularity')
+
+    def test_limit(self):
+        self.assertEqual(2, len(self.index.search(limit=2)))
+
+    def test_returns_entities(self):
+        self.assertIs(ENTITIES[2], self.index.search('blog')[0])
+
+    def test_replace_and_remove(self):
+        self.index.add(charm('cs:xenial/mysql-57', 'Other summary'))
+        self.assertEqual(5, len(self.index))
+        self.assertEqual([], self.index.search('database'))
+        self.index.remove('cs:xenial/mysql-57')
+        self.assertEqual([], self.index.search('other'))
+        self.assertEqual(['cs:~hatch/mysql-router-3'],
+                         ids(self.index.search('mysq', autocomplete=True)))
+        with self.assertRaises(KeyError):
+            self.index.remove('cs:xenial/mysql-57')
+
+    def test_records(self):
+        index = SearchIndex(Entity.from_dict(e) for e in ENTITIES)
+        results = index.search('blog')
+        self.assertEqual([Entity.from_dict(ENTITIES[2])], results)
+
+    def test_from_charmstore(self):
+        charmstore = Mock()
+        charmstore.list.return_value = iter(ENTITIES)
+        index = SearchIndex.from_charmstore(charmstore, promulgated_only=True)
+        self.assertEqual(5, len(index))
+        charmstore.list.assert_called_once_with(
+            stream=True, includes=INDEX_INCLUDES, promulgated_only=True)
@@ -0,0 +1,69 @@
+import threading
+import time
+from unittest import TestCase
+
+from theblues.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        self.group = SingleFlight()
+        self.calls = []
+        self.release = threading.Event()
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_threads(self, key, value, count=5):
+        results = []
+
+        def call():
+            try:
+                results.append(self.group.do(key, self.slow, value))
+            except Exception as err:
+                results.append(err)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        # Give the followers time to join the call in flight.
+        while not self.calls:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_call(self):
+        self.assertEqual(42, self.group.do('key', lambda: 42))
+
+    def test_concurrent_calls_shared(self):
+        results = self.run_threads('key', 'result')
+        self.assertEqual(['result'], self.calls)
+        self.assertEqual(['result'] * 5, results)
+        self.assertEqual(0, self.group.in_flight())
+
+    def test_concurrent_errors_shared(self):
+        error = ValueError('bad wolf')
+        results = self.run_threads('key', error)
+        self.assertEqual([error], self.calls)
+        self.assertEqual([error] * 5, results)
+        self.assertEqual(0, self.group.in_flight())
+
+    def test_sequential_calls_not_shared(self):
+        self.release.set()
+        self.group.do('key', self.slow, 1)
+        self.group.do('key', self.slow, 2)
+        self.assertEqual([1, 2], self.calls)
+
+    def test_different_keys(self):
+        self.release.set()
+        self.assertEqual(1, self.group.do('a', self.slow, 1))
+        self.assertEqual(2, self.group.do('b', self.slow, 2))
+        self.assertEqual([1, 2], self.calls)
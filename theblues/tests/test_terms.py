@@ -10,14 +10,19 @@ from theblues.terms import (
     Terms,
 )
 from theblues.errors import ServerError
-from theblues.utils import DEFAULT_TIMEOUT
+from theblues.utils import (
+    DEFAULT_TIMEOUT,
+    Transport,
+)
 
 
 class TestTerms(TestCase):
 
     def setUp(self):
         self.client = httpbakery.Client()
-        self.terms = Terms('http://example.com', client=self.client)
+        self.transport = Transport()
+        self.terms = Terms('http://example.com', client=self.client,
+                           transport=self.transport)
 
     def test_init(self):
         self.assertEqual(self.terms.url, 'http://example.com/v1/')
@@ -39,7 +44,8 @@ class TestTerms(TestCase):
         mocked.assert_called_once_with(
             'http://example.com/v1/terms/name_of_terms?revision=3',
             timeout=DEFAULT_TIMEOUT,
-            client=self.client
+            client=self.client,
+            transport=self.transport,
         )
 
     @patch('theblues.terms.make_request')
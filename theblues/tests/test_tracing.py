@@ -0,0 +1,283 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from httmock import (
+    HTTMock,
+    urlmatch,
+)
+
+from theblues.charmstore import CharmStore
+from theblues.metrics import (
+    CACHE_HIT,
+    CACHE_MISS,
+)
+from theblues.terms import Terms
+from theblues.tracing import (
+    attach,
+    current_context,
+    current_span,
+    FileExporter,
+    InMemoryExporter,
+    SpanContext,
+    Tracer,
+    url_template,
+)
+from theblues.utils import Transport
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTracer(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.exporter = InMemoryExporter()
+        self.tracer = Tracer(self.exporter, clock=self.clock)
+
+    def test_nested_spans(self):
+        with self.tracer.span('parent', bundle='wiki') as parent:
+            self.assertIs(parent, current_span())
+            self.clock.now += 1
+            with self.tracer.span('child') as child:
+                self.clock.now += 2
+            self.assertIs(parent, current_span())
+        self.assertIsNone(current_span())
+        self.assertEqual([child, parent], self.exporter.spans)
+        self.assertEqual(parent.trace_id, child.trace_id)
+        self.assertEqual(parent.span_id, child.parent_id)
+        self.assertIsNone(parent.parent_id)
+        self.assertEqual(3, parent.duration)
+        self.assertEqual(2, child.duration)
+        self.assertEqual({'bundle': 'wiki'}, parent.attributes)
+        self.assertEqual(32, len(parent.trace_id))
+        self.assertEqual(16, len(parent.span_id))
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span('failing'):
+                raise ValueError('bad wolf')
+        self.assertEqual(
+            'ValueError: bad wolf', self.exporter.spans[0].error)
+
+    def test_new_traces(self):
+        with self.tracer.span('first') as first:
+            pass
+        with self.tracer.span('second') as second:
+            pass
+        self.assertNotEqual(first.trace_id, second.trace_id)
+
+    def test_explicit_parent(self):
+        context = SpanContext('a' * 32, 'b' * 16)
+        span = self.tracer.start_span('remote', parent=context)
+        span.finish()
+        self.assertEqual('a' * 32, span.trace_id)
+        self.assertEqual('b' * 16, span.parent_id)
+
+    def test_attach_thread(self):
+        spans = []
+        with self.tracer.span('parent') as parent:
+            def work():
+                with attach(parent):
+                    with self.tracer.span('child') as child:
+                        spans.append(child)
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertEqual(parent.span_id, spans[0].parent_id)
+
+    def test_attach_context(self):
+        context = SpanContext('a' * 32, 'b' * 16)
+        with attach(context):
+            self.assertEqual(context, current_context())
+            self.assertIsNone(current_span())
+        self.assertIsNone(current_context())
+
+    def test_finish_once(self):
+        span = self.tracer.start_span('once')
+        span.finish()
+        span.finish()
+        self.assertEqual(1, len(self.exporter.spans))
+
+    def test_hooks(self):
+        with self.tracer.span('operation') as span:
+            self.clock.now += 5
+            self.tracer.request(
+                'terms.get_terms', 'GET', 'http://example.com/?a=1', 200,
+                2, 42, 1)
+            self.tracer.decode('terms.get_terms', 0.5)
+            self.tracer.cache('terms.get_terms', CACHE_HIT)
+            self.tracer.cache('terms.get_terms', CACHE_HIT)
+            self.tracer.cache('terms.get_terms', CACHE_MISS)
+            self.tracer.throttle('terms.get_terms', 'example.com', 0.25)
+        request = self.exporter.spans[0]
+        self.assertEqual('HTTP GET', request.name)
+        self.assertEqual(span.span_id, request.parent_id)
+        self.assertEqual(1003, request.start)
+        self.assertEqual(2, request.duration)
+        self.assertEqual({
+            'operation': 'terms.get_terms',
+            'http.method': 'GET',
+            'http.url': 'http://example.com/?a=1',
+            'http.url_template': 'http://example.com/?a={}',
+            'http.status_code': 200,
+            'http.response_size': 42,
+            'http.retries': 1,
+        }, request.attributes)
+        self.assertEqual({
+            'json.decode_time': 0.5,
+            'cache.hits': 2,
+            'cache.misses': 1,
+            'ratelimit.wait': 0.25,
+        }, span.attributes)
+
+    def test_generator_operation(self):
+        @urlmatch(path='/list')
+        def list_(url, request):
+            self.clock.now += 1
+            return {'status_code': 200, 'content': {'Results': [
+                {'Id': 'cs:foo-{}'.format(i)} for i in range(2)]}}
+
+        cs = CharmStore('http://example.com', instrumentation=self.tracer)
+        with HTTMock(list_):
+            results = cs.iter_list(page_size=2)
+            self.assertEqual({'Id': 'cs:foo-0'}, next(results))
+        # The span ends with the last item read, once the generator is
+        # closed.
+        self.clock.now += 10
+        self.assertEqual(['HTTP GET'], [
+            span.name for span in self.exporter.spans])
+        results.close()
+        request, operation = self.exporter.spans
+        self.assertEqual('charmstore.iter_list', operation.name)
+        self.assertEqual(operation.span_id, request.parent_id)
+        self.assertEqual(1001, operation.end)
+
+    def test_make_request(self):
+        @urlmatch(path='/v1/terms/.*')
+        def terms(url, request):
+            return {
+                'status_code': 200,
+                'content': [{
+                    'name': 'license',
+                    'revision': 1,
+                    'created-on': '2016-06-09T22:07:24Z',
+                    'content': 'terms',
+                }],
+            }
+
+        terms_client = Terms(
+            'http://example.com',
+            transport=Transport(instrumentation=self.tracer))
+        with HTTMock(terms):
+            with self.tracer.span('deploy') as deploy:
+                term = terms_client.get_terms('license')
+        self.assertEqual('license', term.name)
+        request, operation, _ = self.exporter.spans
+        self.assertEqual('terms.get_terms', operation.name)
+        self.assertEqual(deploy.span_id, operation.parent_id)
+        self.assertEqual(operation.span_id, request.parent_id)
+        self.assertEqual(200, request.attributes['http.status_code'])
+
+
+class TestSpanContext(TestCase):
+
+    def test_traceparent(self):
+        context = SpanContext('0af7651916cd43dd8448eb211c80319c',
+                              'b7ad6b7169203331')
+        self.assertEqual(
+            '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+            context.traceparent)
+        self.assertEqual(
+            context, SpanContext.from_traceparent(context.traceparent))
+
+    def test_invalid_traceparent(self):
+        with self.assertRaises(ValueError):
+            SpanContext.from_traceparent('00-bad-wolf-01')
+
+
+class TestExporters(TestCase):
+
+    def test_in_memory_max_spans(self):
+        exporter = InMemoryExporter(max_spans=2)
+        tracer = Tracer(exporter)
+        for name in ('a', 'b', 'c'):
+            tracer.start_span(name).finish()
+        self.assertEqual(['b', 'c'], [s.name for s in exporter.spans])
+        exporter.clear()
+        self.assertEqual([], exporter.spans)
+
+    def test_trace(self):
+        exporter = InMemoryExporter()
+        tracer = Tracer(exporter)
+        with tracer.span('parent') as parent:
+            with tracer.span('child'):
+                pass
+        tracer.start_span('other').finish()
+        self.assertEqual(
+            ['parent', 'child'],
+            [span.name for span in exporter.trace(parent.trace_id)])
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'spans.json')
+        exporter = FileExporter(path)
+        tracer = Tracer(exporter, clock=FakeClock())
+        with tracer.span('parent', bundle='wiki'):
+            with tracer.span('child'):
+                pass
+        exporter.close()
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(['child', 'parent'], [s['name'] for s in spans])
+        self.assertEqual({'bundle': 'wiki'}, spans[1]['attributes'])
+        self.assertEqual(0, spans[1]['duration'])
+
+
+class TestUrlTemplate(TestCase):
+
+    def test_query(self):
+        self.assertEqual(
+            'http://example.com/meta/any?id={}&include={}',
+            url_template(
+                'http://example.com/meta/any?id=a&id=b&include=owner'))
+
+    def test_no_query(self):
+        url = 'http://example.com/debug'
+        self.assertEqual(url, url_template(url))
+
+    def test_entity(self):
+        for path in ('mysql', 'mysql-3', 'xenial/mysql-3', '~bob/mysql',
+                     '~bob/xenial/mysql-3'):
+            for endpoint, template in (
+                    ('/meta/any?include=owner', '/meta/any?include={}'),
+                    ('/meta/hash256', '/meta/hash256'),
+                    ('/archive', '/archive'),
+                    ('/archive/hooks/install', '/archive/hooks/install'),
+                    ('/icon.svg?channel=edge', '/icon.svg?channel={}'),
+                    ('/diagram.svg', '/diagram.svg'),
+                    ('/readme', '/readme')):
+                self.assertEqual(
+                    'https://api.jujucharms.com/charmstore/v5/{}' + template,
+                    url_template('https://api.jujucharms.com/charmstore/v5/' +
+                                 path + endpoint))
+
+    def test_no_entity(self):
+        for url in ('http://example.com/v5/meta/any?id={}',
+                    'http://example.com/v5/search?text={}',
+                    'http://example.com/v5/debug/status'):
+            self.assertEqual(url, url_template(url))
+        self.assertEqual(
+            'http://example.com/{}/meta/any',
+            url_template('http://example.com/precise/mysql-1/meta/any'))
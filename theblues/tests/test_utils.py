@@ -3,8 +3,20 @@ from unittest import TestCase
 from httmock import HTTMock
 import mock
 
-from theblues.errors import ServerError
-from theblues.utils import make_request
+from theblues.circuitbreaker import CircuitBreakerRegistry
+from theblues.errors import (
+    CircuitOpenError,
+    RateLimitError,
+    ServerError,
+)
+from theblues.metrics import Collector
+from theblues.ratelimit import RateLimiterRegistry
+from theblues.retry import RetryPolicy
+from theblues.utils import (
+    make_request,
+    make_session,
+    Transport,
+)
 from theblues.tests import helpers
 
 URL = 'http://example.com/'
@@ -140,3 +152,199 @@ class TestUtils(TestCase, helpers.TimeoutTestsMixin):
         with self.assertRaises(ValueError) as ctx:
             make_request('http://1.2.3.4', method='bad')
         self.assertEqual('invalid method bad', ctx.exception.args[0])
+
+    def test_make_request_with_cookies(self):
+        def handler(url, request):
+            self.assertEqual('foo=bar', request.headers['Cookie'])
+            return {'status_code': 200}
+        with HTTMock(handler):
+            make_request(URL, cookies={'foo': 'bar'})
+
+    def test_make_request_with_transport(self):
+        transport = Transport()
+        with HTTMock(self.subscription_response):
+            with mock.patch.object(
+                    transport, 'request',
+                    wraps=transport.request) as mock_request:
+                response = make_request(
+                    URL, query={'uuid': 'foo'}, transport=transport)
+        self.assertEqual({u'foo': u'bar', u'baz': u'bax'}, response)
+        mock_request.assert_called_once_with(
+            'GET', 'http://example.com/?uuid=foo', timeout=10, headers={},
+            auth=None)
+
+    def test_make_request_with_transport_unexpected_error(self):
+        transport = Transport()
+        with mock.patch.object(transport.session, 'request') as mock_request:
+            mock_request.side_effect = ValueError('bad wolf')
+            with patch_log_error():
+                with self.assertRaises(ServerError) as ctx:
+                    make_request(URL, method='DELETE', transport=transport)
+        self.assertEqual(
+            'Error during request: http://example.com/ message: bad wolf',
+            ctx.exception.args[0])
+
+
+class TestTransport(TestCase):
+
+    def test_pool_size(self):
+        transport = Transport(pool_connections=3, pool_maxsize=42)
+        for prefix in ('http://', 'https://'):
+            adapter = transport.session.get_adapter(prefix + 'example.com')
+            self.assertEqual(3, adapter._pool_connections)
+            self.assertEqual(42, adapter._pool_maxsize)
+
+    def test_session_reused(self):
+        transport = Transport()
+
+        def handler(url, request):
+            return {'status_code': 200, 'content': b'{}'}
+
+        with HTTMock(handler):
+            with mock.patch.object(
+                    transport.session, 'send',
+                    wraps=transport.session.send) as mock_send:
+                for _ in range(3):
+                    make_request(URL, transport=transport)
+        self.assertEqual(3, mock_send.call_count)
+
+    def test_retry(self):
+        statuses = [503, 200]
+
+        def handler(url, request):
+            return {'status_code': statuses.pop(0), 'content': b'{}'}
+
+        transport = Transport(retry=RetryPolicy(sleep=lambda delay: None))
+        with HTTMock(handler):
+            with mock.patch('theblues.retry.log'):
+                self.assertEqual({}, make_request(URL, transport=transport))
+        self.assertEqual([], statuses)
+
+
+class TestMakeRequestRetry(TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.retry = RetryPolicy(sleep=lambda delay: None)
+
+    def handler(self, url, request):
+        self.calls += 1
+        return {'status_code': 503, 'content': b'unavailable'}
+
+    def test_retry_idempotent(self):
+        with HTTMock(self.handler):
+            with mock.patch('theblues.retry.log'):
+                with patch_log_error():
+                    with self.assertRaises(ServerError) as ctx:
+                        make_request(URL, method='PUT', retry=self.retry)
+        self.assertEqual(503, ctx.exception.args[0])
+        self.assertEqual(3, self.calls)
+
+    def test_no_retry_post(self):
+        with HTTMock(self.handler):
+            with patch_log_error():
+                with self.assertRaises(ServerError):
+                    make_request(URL, method='POST', retry=self.retry,
+                                 transport=Transport())
+        self.assertEqual(1, self.calls)
+
+
+class TestTransportCircuitBreaker(TestCase):
+
+    def test_fail_fast(self):
+        calls = []
+
+        def handler(url, request):
+            calls.append(url)
+            return {'status_code': 503, 'content': b'unavailable'}
+
+        registry = CircuitBreakerRegistry(failure_threshold=2)
+        transport = Transport(circuit_breakers=registry)
+        with HTTMock(handler):
+            with patch_log_error():
+                with mock.patch('theblues.circuitbreaker.log'):
+                    for _ in range(2):
+                        with self.assertRaises(ServerError):
+                            make_request(URL, transport=transport)
+                    with self.assertRaises(CircuitOpenError):
+                        make_request(URL, transport=transport)
+        self.assertEqual(2, len(calls))
+        self.assertEqual('open', registry.states()['example.com'].state)
+
+
+class TestTransportRateLimit(TestCase):
+
+    def handler(self, url, request):
+        return {'status_code': 200, 'content': b'{}'}
+
+    def test_shared_limit(self):
+        registry = RateLimiterRegistry(rate=1, burst=2, blocking=False)
+        first = Transport(rate_limits=registry)
+        second = Transport(rate_limits=registry)
+        with HTTMock(self.handler):
+            make_request(URL, transport=first)
+            make_request(URL + 'other', transport=second)
+            with patch_log_error() as mock_log:
+                with self.assertRaises(RateLimitError) as ctx:
+                    make_request(URL, transport=first)
+        self.assertEqual('example.com', ctx.exception.host)
+        mock_log.assert_called_once_with(ctx.exception.args[0])
+        stats = registry.stats()['example.com']
+        self.assertEqual(2, stats.acquired)
+        self.assertEqual(1, stats.rejected)
+
+    def test_wait_reported(self):
+        collector = Collector()
+        transport = Transport(
+            rate_limits=RateLimiterRegistry(max_in_flight=1),
+            instrumentation=collector)
+        with HTTMock(self.handler):
+            make_request(URL, transport=transport)
+        stats = collector.operations()['unknown']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual(0, stats.throttle_wait)
+        self.assertIn('theblues_rate_limit_wait_seconds_count',
+                      collector.expose())
+
+
+class TestMakeSession(TestCase):
+
+    def test_pools(self):
+        session = make_session(pool_connections=3, pool_maxsize=20)
+        for scheme in ('http://', 'https://'):
+            adapter = session.get_adapter(scheme + 'example.com')
+            self.assertEqual(3, adapter._pool_connections)
+            self.assertEqual(20, adapter._pool_maxsize)
+
+
+class TestTransportAuthCache(TestCase):
+
+    def test_cached_auth(self):
+        client = mock.Mock()
+        auth_cache = mock.Mock()
+
+        def authorize(request):
+            request.headers['Cookie'] = 'macaroon-store=cached'
+            return request
+
+        auth_cache.auth.return_value = authorize
+        cookies = []
+
+        def handler(url, request):
+            cookies.append(request.headers.get('Cookie'))
+            return {'status_code': 200, 'content': b'{}'}
+
+        transport = Transport(auth_cache=auth_cache)
+        with HTTMock(handler):
+            make_request(
+                URL, query={'q': 'x'}, client=client, transport=transport)
+        auth_cache.auth.assert_called_once_with(client, URL + '?q=x')
+        self.assertFalse(client.auth.called)
+        self.assertEqual(['macaroon-store=cached'], cookies)
+
+    def test_no_client(self):
+        auth_cache = mock.Mock()
+        transport = Transport(auth_cache=auth_cache)
+        with HTTMock(lambda url, request: {'status_code': 200}):
+            make_request(URL, transport=transport)
+        self.assertFalse(auth_cache.auth.called)
@@ -0,0 +1,434 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import random
+import re
+import threading
+import time
+try:
+    from urlparse import (
+        parse_qsl,
+        urlsplit,
+        urlunsplit,
+    )
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import (
+        parse_qsl,
+        urlencode,
+        urlsplit,
+        urlunsplit,
+    )
+
+from theblues.metrics import (
+    CACHE_HIT,
+    CACHE_MISS,
+    CACHE_REVALIDATED,
+    Instrumentation,
+)
+
+
+# The names of the span attributes counting the cache lookups.
+_CACHE_ATTRIBUTES = {
+    CACHE_HIT: 'cache.hits',
+    CACHE_MISS: 'cache.misses',
+    CACHE_REVALIDATED: 'cache.revalidated',
+}
+
+_TRACEPARENT_RE = re.compile(
+    r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+# The entity id in the path of a charmstore url, as in
+# /v5/~bob/xenial/mysql-3/meta/any: an optional user, an optional series and
+# a name, followed by an entity endpoint. The API version segment (e.g. v5)
+# belongs to the base url and is never part of the id.
+_ENTITY_PATH_RE = re.compile(
+    r'^(.*?)/((?:~[^/]+/)?(?:(?!v\d+/)[^/~]+/)?(?!v\d+/)[^/~]+)'
+    r'(/(?:meta/.*|archive(?:/.*)?|icon\.svg|diagram\.svg|readme))$')
+# Ids are drawn from the system entropy source, so that they are not
+# repeated by forked processes.
+_random = random.SystemRandom()
+_local = threading.local()
+
+
+class SpanContext(namedtuple('SpanContext', ['trace_id', 'span_id'])):
+    """The identity of a span, used to parent other spans.
+
+    A context can be sent to another process in a W3C traceparent header,
+    so that the spans created there belong to the same trace.
+    """
+
+    __slots__ = ()
+
+    @property
+    def traceparent(self):
+        """The context as a W3C traceparent header value."""
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    @classmethod
+    def from_traceparent(cls, value):
+        """Return the context in a W3C traceparent header value.
+
+        @raise ValueError if the value is not valid.
+        """
+        match = _TRACEPARENT_RE.match(value.strip().lower())
+        if match is None:
+            raise ValueError('invalid traceparent: {!r}'.format(value))
+        return cls(*match.groups())
+
+
+class Span(object):
+    """A timed step of a trace, like an operation or a request."""
+
+    def __init__(self, tracer, name, context, parent_id, start,
+                 attributes=None):
+        """Initializer; spans are created by Tracer.start_span.
+
+        @param tracer The Tracer exporting the span once finished.
+        @param name The span name.
+        @param context The SpanContext of the span.
+        @param parent_id The span id of the parent, or None.
+        @param start The start time in seconds since the epoch.
+        @param attributes A dict of attributes.
+        """
+        self._tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.start = start
+        self.end = None
+        self.error = None
+        self.attributes = dict(attributes or {})
+        self._lock = threading.Lock()
+
+    @property
+    def trace_id(self):
+        return self.context.trace_id
+
+    @property
+    def span_id(self):
+        return self.context.span_id
+
+    @property
+    def duration(self):
+        """The duration in seconds, or None if the span is not finished."""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set_attribute(self, key, value):
+        """Set an attribute of the span."""
+        with self._lock:
+            self.attributes[key] = value
+
+    def add(self, key, value):
+        """Add value to a numeric attribute of the span."""
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    @contextmanager
+    def activate(self):
+        """Make the span the current one in this thread within the block."""
+        outer = getattr(_local, 'span', None)
+        _local.span = self
+        try:
+            yield self
+        finally:
+            _local.span = outer
+
+    def finish(self, error=None, end=None):
+        """End the span and export it.
+
+        Further calls are ignored.
+        @param error The exception which made the step fail, if any.
+        @param end The end time, defaulting to now.
+        """
+        with self._lock:
+            if self.end is not None:
+                return
+            self.end = self._tracer.clock() if end is None else end
+            if error is not None:
+                self.error = '{}: {}'.format(type(error).__name__, error)
+        self._tracer.exporter.export(self)
+
+    def to_dict(self):
+        """Return the span as a JSON serializable dict."""
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+    def __repr__(self):
+        return '<Span {} {}/{}>'.format(self.name, self.trace_id, self.span_id)
+
+
+class _OperationSpan(Span):
+    """The span of a client operation.
+
+    The span ends when the operation last ran, rather than when it is
+    finished. Operations returning a generator, like CharmStore.iter_search,
+    run while the generator is consumed, and are only finished once it is
+    exhausted, closed or garbage collected: their span covers the call and
+    the reading of the items, up to the last one read.
+    """
+
+    _last_active = None
+
+    @contextmanager
+    def activate(self):
+        try:
+            with super(_OperationSpan, self).activate():
+                yield self
+        finally:
+            self._last_active = self._tracer.clock()
+
+    def finish(self, error=None, end=None):
+        if end is None:
+            end = self._last_active
+        super(_OperationSpan, self).finish(error, end)
+
+
+class Tracer(Instrumentation):
+    """Record the operations of the clients as tracing spans.
+
+    A tracer is an instrumentation: pass it to CharmStore or Transport in
+    place of a metrics.Collector. Each client operation (e.g.
+    charmstore.entity) is a span, whose children are the HTTP requests it
+    sends, with their method, url template, status code, size and retries.
+    The cache lookups, JSON decode time and rate limiter waits of an
+    operation are attributes of its span.
+
+    Spans are parented to the current span of the thread, so that callers
+    can group operations:
+
+        tracer = Tracer(FileExporter('/tmp/spans.json'))
+        charmstore = CharmStore(instrumentation=tracer)
+        with tracer.span('deploy-bundle', bundle=bundle_id):
+            bundle = charmstore.bundle(bundle_id)
+            charms = charmstore.entities(charm_ids)
+
+    Use attach to parent spans to a span created in another thread, or to
+    a SpanContext received from another process.
+    """
+
+    def __init__(self, exporter=None, clock=time.time):
+        """Initializer.
+
+        @param exporter The exporter of the finished spans, defaulting to a
+            new InMemoryExporter.
+        @param clock A function returning the current time in seconds.
+        """
+        if exporter is None:
+            exporter = InMemoryExporter()
+        self.exporter = exporter
+        self.clock = clock
+
+    def start_span(self, name, parent=None, **attributes):
+        """Start a span, without making it current.
+
+        @param name The span name.
+        @param parent The parent Span or SpanContext, defaulting to the
+            current span or context of the thread. A span without a parent
+            starts a new trace.
+        @param attributes The span attributes.
+        @return the Span, which must be finished.
+        """
+        return self._start_span(Span, name, parent, attributes)
+
+    def _start_span(self, cls, name, parent, attributes):
+        """Start a span of the given Span class; see start_span."""
+        if parent is None:
+            parent = current_context()
+        elif isinstance(parent, Span):
+            parent = parent.context
+        if parent is None:
+            context = SpanContext(_new_id(16), _new_id(8))
+            parent_id = None
+        else:
+            context = SpanContext(parent.trace_id, _new_id(8))
+            parent_id = parent.span_id
+        return cls(self, name, context, parent_id, self.clock(), attributes)
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """Run the block in a new current span; see start_span.
+
+        The span records the exception raised by the block, if any.
+        """
+        span = self.start_span(name, parent, **attributes)
+        try:
+            with span.activate():
+                yield span
+        except BaseException as err:
+            span.finish(err)
+            raise
+        span.finish()
+
+    def start_operation(self, operation):
+        return self._start_span(
+            _OperationSpan, operation, None, {'operation': operation})
+
+    def request(self, operation, method, url, status, latency, size,
+                retries=0):
+        end = self.clock()
+        span = self.start_span(
+            'HTTP {}'.format(method), operation=operation)
+        span.start = end - latency
+        span.attributes.update({
+            'http.method': method,
+            'http.url': url,
+            'http.url_template': url_template(url),
+            'http.status_code': status,
+            'http.response_size': size,
+            'http.retries': retries,
+        })
+        span.finish(end=end)
+
+    def decode(self, operation, duration):
+        span = current_span()
+        if span is not None:
+            span.add('json.decode_time', duration)
+
+    def cache(self, operation, outcome):
+        span = current_span()
+        if span is not None:
+            span.add(_CACHE_ATTRIBUTES.get(outcome, 'cache.' + outcome), 1)
+
+    def throttle(self, operation, host, wait):
+        span = current_span()
+        if span is not None:
+            span.add('ratelimit.wait', wait)
+
+
+class InMemoryExporter(object):
+    """Keep the finished spans in memory, e.g. for tests or debugging."""
+
+    def __init__(self, max_spans=None):
+        """Initializer.
+
+        @param max_spans The maximum number of spans kept, the oldest being
+            dropped first, or None to keep them all.
+        """
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._spans = []
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span)
+            if (self.max_spans is not None and
+                    len(self._spans) > self.max_spans):
+                del self._spans[0]
+
+    @property
+    def spans(self):
+        """The finished spans, in the order they finished."""
+        with self._lock:
+            return list(self._spans)
+
+    def trace(self, trace_id):
+        """Return the spans of a trace, in the order they started."""
+        return sorted(
+            (span for span in self.spans if span.trace_id == trace_id),
+            key=lambda span: span.start)
+
+    def clear(self):
+        """Forget the finished spans."""
+        with self._lock:
+            del self._spans[:]
+
+
+class FileExporter(object):
+    """Append the finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        """Initializer.
+
+        @param path The path of the file, created if needed.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        """Close the file."""
+        with self._lock:
+            self._file.close()
+
+
+def current_span():
+    """Return the current Span of the thread, or None."""
+    span = getattr(_local, 'span', None)
+    return span if isinstance(span, Span) else None
+
+
+def current_context():
+    """Return the SpanContext of the current span of the thread, or None."""
+    span = getattr(_local, 'span', None)
+    if isinstance(span, Span):
+        return span.context
+    return span
+
+
+@contextmanager
+def attach(parent):
+    """Parent the spans started in the block to the given span or context.
+
+    For instance, to trace the work of another thread as part of the
+    current span:
+
+        span = current_span()
+
+        def work():
+            with attach(span):
+                charmstore.entity(entity_id)
+
+    @param parent A Span, a SpanContext, or None to start new traces.
+    """
+    outer = getattr(_local, 'span', None)
+    _local.span = parent
+    try:
+        yield
+    finally:
+        _local.span = outer
+
+
+def url_template(url):
+    """Return the url with its entity id and query values replaced by
+    placeholders.
+
+    For instance http://example.com/meta/any?id=a&id=b&include=owner
+    becomes http://example.com/meta/any?id={}&include={}, and
+    http://example.com/v5/~bob/xenial/mysql-3/meta/any?include=owner
+    becomes http://example.com/v5/{}/meta/any?include={}.
+    """
+    parts = urlsplit(url)
+    match = _ENTITY_PATH_RE.match(parts.path)
+    if match is not None:
+        parts = parts._replace(
+            path='{}/{{}}{}'.format(match.group(1), match.group(3)))
+    if not parts.query:
+        return urlunsplit(parts)
+    keys = []
+    for key, _ in parse_qsl(parts.query, keep_blank_values=True):
+        if key not in keys:
+            keys.append(key)
+    query = urlencode([(key, '') for key in keys]).replace('=', '={}')
+    return urlunsplit(parts._replace(query=query))
+
+
+def _new_id(size):
+    """Return a random hex id of the given size in bytes."""
+    return '{:0{}x}'.format(_random.getrandbits(size * 8), size * 2)
@@ -1,4 +1,5 @@
 import collections
+import functools
 import json
 try:
     from urllib import urlencode
@@ -6,17 +7,28 @@ except ImportError:
     from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
 from theblues.errors import (
+    CircuitOpenError,
     log,
+    RateLimitError,
     ServerError,
     timeout_error,
 )
+from theblues.metrics import (
+    observe_decode,
+    observe_request,
+)
 
 
 API_URL = 'https://api.jujucharms.com/charmstore/v5'
 DEFAULT_TIMEOUT = 3.05
+# The number of per-host connection pools kept by a transport, and the number
+# of keep-alive connections kept in each of them.
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
 _error_message = 'Error during request: {url} message: {message}'
 
 
@@ -27,9 +39,116 @@ def _server_error_message(url, message):
     return msg
 
 
+class Transport(object):
+    """A reusable HTTP transport with keep-alive connection pooling.
+
+    Clients hold a transport and pass it to make_request, so that successive
+    requests to the same host reuse established TCP/TLS connections rather
+    than paying for a new handshake each time. A transport can be shared by
+    several clients.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, retry=None,
+                 circuit_breakers=None, instrumentation=None,
+                 rate_limits=None, auth_cache=None):
+        """Initializer.
+
+        @param pool_connections The number of hosts for which a connection
+            pool is kept.
+        @param pool_maxsize The maximum number of connections kept alive for
+            each host; it should be at least the number of threads sharing
+            the transport.
+        @param retry The optional retry.RetryPolicy applied to the requests
+            sent with the transport.
+        @param circuit_breakers The optional
+            circuitbreaker.CircuitBreakerRegistry used to fail fast when a
+            host keeps failing. Share it between transports to share the
+            breakers.
+        @param instrumentation The optional metrics.Instrumentation (e.g. a
+            metrics.Collector) to which make_request reports the requests
+            sent with the transport.
+        @param rate_limits The optional ratelimit.RateLimiterRegistry
+            bounding the request rate and concurrency per host. Share it
+            between transports and charmstore.CharmStore instances to share
+            the limits.
+        @param auth_cache The optional auth.AuthCache keeping the macaroons
+            discharged by the clients passed to make_request, so that they
+            are sent with every request instead of being discharged again
+            when refused.
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retry = retry
+        self.circuit_breakers = circuit_breakers
+        self.instrumentation = instrumentation
+        self.rate_limits = rate_limits
+        self.auth_cache = auth_cache
+        self.session = make_session(pool_connections, pool_maxsize)
+
+    def request(self, method, url, **kwargs):
+        """Send a request, reusing a pooled connection if available.
+
+        @param method The HTTP request method.
+        @param url The url to make the request to.
+        @param kwargs Any other argument accepted by requests.
+        @return the requests response.
+        @raise CircuitOpenError if the circuit of the host is open.
+        @raise RateLimitError if the rate limit of the host is reached.
+        """
+        return self.send(method, url, self.retry, **kwargs)
+
+    def send(self, method, url, retry, **kwargs):
+        """Send a request with the given retry policy; see request.
+
+        @param retry The retry.RetryPolicy to use, or None.
+        """
+        def send():
+            return self.session.request(method, url, **kwargs)
+
+        if self.rate_limits is not None:
+            limiter = self.rate_limits.for_url(url)
+            send = functools.partial(
+                limiter.call, send, instrumentation=self.instrumentation)
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.for_url(url)
+            send = functools.partial(breaker.call, send)
+        if retry is None:
+            return send()
+        return retry.call(method, send, url)
+
+    def close(self):
+        """Close all the pooled connections."""
+        self.session.close()
+
+
+def make_session(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Return a requests session keeping connections alive in pools.
+
+    The session can be used from several threads at once: each request
+    takes a connection from the pool of its host, or opens a new one. A
+    connection opened when all the pooled ones are in use is closed after
+    its request if the pool is full, so pool_maxsize should be at least the
+    number of threads sending requests to the same host.
+
+    @param pool_connections The number of hosts for which a connection
+        pool is kept.
+    @param pool_maxsize The maximum number of connections kept alive for
+        each host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def make_request(
         url, method='GET', query=None, body=None, auth=None, timeout=10,
-        client=None, macaroons=None):
+        client=None, macaroons=None, cookies=None, transport=None,
+        retry=None):
     """Make a request with the provided data.
 
     @param url The url to make the request to.
@@ -43,6 +162,13 @@ def make_request(
     requests with macaroons.
     @param macaroons Optional JSON serialized, base64 encoded macaroons to be
         included in the request header.
+    @param cookies Optional cookies (which act as dict) to be sent with the
+        request.
+    @param transport The optional Transport used to send the request. If
+        None, a new connection is made for the request. The macaroons of
+        client are cached in the auth cache of the transport, if any.
+    @param retry The optional retry.RetryPolicy used to retry the request,
+        in place of the one of the transport.
 
     POST/PUT request bodies are assumed to be in JSON format.
     Return the response content as a JSON decoded object, or an empty dict.
@@ -67,14 +193,39 @@ def make_request(
     if macaroons is not None:
         headers['Macaroons'] = macaroons
 
-    kwargs['auth'] = auth if client is None else client.auth()
+    if cookies is not None:
+        kwargs['cookies'] = cookies
+
+    auth_cache = getattr(transport, 'auth_cache', None)
+    if client is None:
+        kwargs['auth'] = auth
+    elif auth_cache is None:
+        kwargs['auth'] = client.auth()
+    else:
+        kwargs['auth'] = auth_cache.auth(client, url)
+
+    def send():
+        if transport is not None and retry is None:
+            return transport.request(method, url, **kwargs)
+        if transport is not None:
+            return transport.send(method, url, retry, **kwargs)
+        if retry is not None:
+            return retry.call(
+                method, lambda: requests.request(method, url, **kwargs), url)
+        return getattr(requests, method.lower())(url, **kwargs)
 
-    api_method = getattr(requests, method.lower())
+    instrumentation = getattr(transport, 'instrumentation', None)
     # Perform the request.
     try:
-        response = api_method(url, **kwargs)
+        if instrumentation is None:
+            response = send()
+        else:
+            response = observe_request(instrumentation, method, url, send)
     except requests.exceptions.Timeout:
         raise timeout_error(url, timeout)
+    except (CircuitOpenError, RateLimitError) as err:
+        log.error(err.args[0])
+        raise
     except Exception as err:
         msg = _server_error_message(url, err)
         raise ServerError(msg)
@@ -92,7 +243,7 @@ def make_request(
         return {}
     # Assume the response body is a JSON encoded string.
     try:
-        return response.json()
+        return observe_decode(instrumentation, response.json)
     except Exception as err:
         msg = 'Error decoding JSON response: {} message: {}'.format(url, err)
         log.error(msg)